@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import torch
+
+from torchfly.common.move_to_device import move_to_device
+
+# pylint:disable=no-member
+
+DEVICES = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+
+def assert_same_result(planned, expected):
+    "The planned transfer must return what the recursive traversal returns"
+    assert type(planned) is type(expected)
+    if isinstance(expected, torch.Tensor):
+        assert planned.device == expected.device
+        assert planned.dtype == expected.dtype
+        assert planned.shape == expected.shape
+        assert torch.equal(planned, expected)
+    elif isinstance(expected, dict):
+        assert list(planned) == list(expected)
+        for key in expected:
+            assert_same_result(planned[key], expected[key])
+    elif isinstance(expected, (list, tuple)):
+        assert len(planned) == len(expected)
+        for planned_item, expected_item in zip(planned, expected):
+            assert_same_result(planned_item, expected_item)
+    else:
+        assert planned is expected
+
+
+def make_batches():
+    return [
+        torch.arange(6).view(2, 3),
+        {
+            "input_ids": torch.randint(0, 100, (4, 16)),
+            "attention_mask": torch.ones(4, 16, dtype=torch.bool),
+            "labels": [torch.randn(3), torch.randn(5)],
+            "pair": (torch.zeros(2), 1),
+            "nested": {"scores": np.random.rand(4).astype(np.float32), "name": "batch"},
+        },
+        {
+            "ids": np.arange(4),
+            "texts": np.array(["a", "bc"]),
+            "raw": np.array([b"x", b"yz"]),
+            "objects": np.array([None, 1], dtype=object),
+            "index": np.int64(3),
+            "weight": np.float32(0.5),
+            "none": None,
+        },
+        [torch.ones(2, 2), {"x": torch.zeros(3, dtype=torch.float16)}, 2.0],
+    ]
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("coalesce", [False, True])
+def test_plan_matches_recursive(device, coalesce):
+    for batch in make_batches():
+        expected = move_to_device(batch, device)
+        # the second call runs the cached plan
+        for _ in range(2):
+            assert_same_result(move_to_device(batch, device, use_plan=True, coalesce=coalesce), expected)
+
+
+@pytest.mark.parametrize("device", DEVICES)
+def test_plan_falls_back_on_different_structure(device):
+    move_to_device({"a": torch.ones(2), "b": torch.zeros(2)}, device, use_plan=True)
+    batch = {"a": [torch.ones(2)], "b": "text"}
+    assert_same_result(move_to_device(batch, device, use_plan=True), move_to_device(batch, device))
+
+
+def test_unsupported_numpy_values_are_kept():
+    batch = {"texts": np.array(["a", "bc"]), "index": np.int64(3)}
+    for use_plan in [False, True]:
+        moved = move_to_device(batch, "cpu", use_plan=use_plan)
+        assert moved["texts"] is batch["texts"]
+        assert moved["index"] is batch["index"]
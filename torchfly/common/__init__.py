@@ -2,5 +2,9 @@ from .async_save import async_save, async_wait
 from .move_to_device import move_to_device
 from .logging_util import configure_logging
 from .random_seeding import set_random_seed
-from .launch_distributed import launch_distributed
-from .get_rank import get_rank
\ No newline at end of file
+from .launch_distributed import launch_distributed, get_distributed_config, find_free_port
+from .get_rank import get_rank, get_world_size
+from .device_prefetcher import DevicePrefetcher
+from .log_accumulator import LogAccumulator
+from .sharded_checkpoint import ShardedCheckpointWriter, load_sharded_checkpoint, validate_sharded_checkpoint
+from .shard_dataloader import shard_dataloader, ShardSampler
@@ -0,0 +1,161 @@
+import time
+import queue
+import threading
+from typing import Any, Callable, Iterable
+import torch
+import logging
+
+from .move_to_device import move_to_device
+
+logger = logging.getLogger(__name__)
+
+# pylint:disable=no-member
+
+_END = object()
+
+
+class _ExceptionWrapper:
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+def apply_to_tensors(data: Any, func: Callable[[torch.Tensor], torch.Tensor]) -> Any:
+    "Apply `func` to every tensor in a nested list, tuple or dict"
+    if isinstance(data, torch.Tensor):
+        return func(data)
+    elif isinstance(data, dict):
+        return {key: apply_to_tensors(value, func) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [apply_to_tensors(item, func) for item in data]
+    elif isinstance(data, tuple):
+        return tuple(apply_to_tensors(item, func) for item in data)
+    else:
+        return data
+
+
+def pin_memory(data: Any) -> Any:
+    "Copy CPU tensors to page-locked memory, so that they can be copied asynchronously"
+    return apply_to_tensors(
+        data, lambda tensor: tensor.pin_memory() if tensor.device.type == "cpu" and not tensor.is_pinned() else tensor
+    )
+
+
+class DevicePrefetcher:
+    """
+    Wraps a dataloader and moves the next `num_prefetch` batches to `device` in a background thread.
+    Batches are copied to pinned memory first, so that the `non_blocking` copies overlap with compute.
+    On CUDA, the copies are issued on a side stream and the training stream waits on an event
+    recorded after each batch, so a batch is never used before its copy finishes.
+
+    Example:
+        for batch in DevicePrefetcher(dataloader, device):
+            ...
+    """
+    def __init__(
+        self,
+        iterable: Iterable,
+        device: torch.device,
+        num_prefetch: int = 2,
+        pin_memory: bool = True,
+        coalesce: bool = False,
+        exclude_keys=None
+    ):
+        self.iterable = iterable
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.pin_memory = pin_memory and self.device.type == "cuda"
+        self.coalesce = coalesce
+        self.exclude_keys = exclude_keys
+        # seconds the training loop spent waiting for batches
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def pop_wait_time(self) -> float:
+        "Returns the waiting time since the last call"
+        wait_time = self.wait_time
+        self.wait_time = 0.0
+        return wait_time
+
+    def _put(self, out_queue: queue.Queue, item: Any, stop_event: threading.Event) -> bool:
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _resolve_device(self) -> torch.device:
+        "Called in the main thread, whose current CUDA device is the one the training uses"
+        if self.device.type == "cuda" and self.device.index is None:
+            return torch.device("cuda", torch.cuda.current_device())
+        return self.device
+
+    def _get(self, out_queue: queue.Queue, thread: threading.Thread) -> Any:
+        while True:
+            try:
+                return out_queue.get(timeout=1.0)
+            except queue.Empty:
+                # the worker may have put its last item just before exiting
+                if not thread.is_alive() and out_queue.empty():
+                    raise RuntimeError("DevicePrefetcher worker thread exited without finishing the dataloader")
+
+    def _worker(self, device: torch.device, out_queue: queue.Queue, stop_event: threading.Event):
+        try:
+            stream = None
+            if device.type == "cuda":
+                # the current device is per thread
+                torch.cuda.set_device(device)
+                stream = torch.cuda.Stream(device)
+
+            for batch in self.iterable:
+                if self.pin_memory:
+                    batch = pin_memory(batch)
+
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = move_to_device(batch, device, self.exclude_keys, use_plan=True, coalesce=self.coalesce)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = move_to_device(batch, device, self.exclude_keys, use_plan=True)
+                    event = None
+
+                if not self._put(out_queue, (batch, event), stop_event):
+                    return
+            self._put(out_queue, _END, stop_event)
+        except Exception as e:
+            self._put(out_queue, _ExceptionWrapper(e), stop_event)
+
+    def __iter__(self):
+        device = self._resolve_device()
+        out_queue = queue.Queue(maxsize=self.num_prefetch)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(device, out_queue, stop_event), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = self._get(out_queue, thread)
+                self.wait_time += time.perf_counter() - start_time
+
+                if item is _END:
+                    break
+                elif isinstance(item, _ExceptionWrapper):
+                    raise item.exception
+
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(device)
+                    current_stream.wait_event(event)
+                    # the memory was allocated on the side stream
+                    apply_to_tensors(
+                        batch, lambda tensor: tensor.record_stream(current_stream) if tensor.is_cuda else None
+                    )
+                yield batch
+        finally:
+            stop_event.set()
+            thread.join()
@@ -1,19 +1,34 @@
 import os
 
+
+def get_world_size() -> int:
+    "Total number of processes in the distributed group"
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
 def get_rank():
     """
     We use environment variables to pass the rank info
+    Missing ranks are derived from `NODE_RANK` and `LOCAL_WORLD_SIZE`, assuming ranks are assigned node by node
     Returns:
         rank: rank in the multi-node system 
         local_rank: local rank on a node
     """
-    if "RANK" not in os.environ or "LOCAL_RANK" not in os.environ:
-        rank = 0
-        local_rank = 0
-        os.environ["RANK"] = str(0)
-        os.environ["LOCAL_RANK"] = str(0)
-    else:
+    if "RANK" in os.environ and "LOCAL_RANK" in os.environ:
         rank = int(os.environ["RANK"])
         local_rank = int(os.environ["LOCAL_RANK"])
+    elif "RANK" in os.environ:
+        rank = int(os.environ["RANK"])
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", get_world_size()))
+        local_rank = rank % local_world_size
+    elif "LOCAL_RANK" in os.environ:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        rank = int(os.environ.get("NODE_RANK", 0)) * local_world_size + local_rank
+    else:
+        rank = 0
+        local_rank = 0
 
-    return rank, local_rank
\ No newline at end of file
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    return rank, local_rank
@@ -1,24 +1,73 @@
 import os
 import sys
+import socket
 import subprocess
-from omegaconf import OmegaConf
+from omegaconf import OmegaConf, DictConfig
 from torchfly.flyconfig import GlobalFlyConfig
-from typing import Callable
+from typing import Any, Callable, Dict
 import logging
 
 logger = logging.getLogger(__name__)
 
-# TODO: We only support single machine multi gpu distributed training
-#       Also, MASTER_PORT and MASTER_ADDR are fixed for now
+DEFAULT_MASTER_PORT = 29500
+
+
+def find_free_port() -> int:
+    "Ask the OS for an unused TCP port"
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("", 0))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock.getsockname()[1]
+
+
+def get_distributed_config(config: DictConfig) -> Dict[str, Any]:
+    """
+    Read `config.training.distributed`. The environment variables `NODE_RANK`, `MASTER_ADDR`
+    and `MASTER_PORT` take priority, so that the same config can be used on every node.
+    Returns:
+        num_nodes: number of machines
+        node_rank: rank of this machine
+        num_procs_per_node: number of GPUs, or `distributed.num_procs_per_node` processes on CPU
+        master_addr: address of the node 0
+        master_port: None if it should be discovered
+        backend: "nccl" with GPUs, otherwise "gloo"
+    """
+    distributed_config = config.training.distributed
+    if distributed_config is None:
+        distributed_config = OmegaConf.create({})
+
+    num_gpus_per_node = config.training.num_gpus_per_node
+    if num_gpus_per_node > 0:
+        num_procs_per_node = num_gpus_per_node
+    else:
+        num_procs_per_node = distributed_config.num_procs_per_node or 1
+
+    master_port = os.environ.get("MASTER_PORT", distributed_config.master_port)
+
+    return {
+        "num_nodes": int(distributed_config.num_nodes or 1),
+        "node_rank": int(os.environ.get("NODE_RANK", distributed_config.node_rank or 0)),
+        "num_procs_per_node": int(num_procs_per_node),
+        "master_addr": os.environ.get("MASTER_ADDR", distributed_config.master_addr or "127.0.0.1"),
+        "master_port": int(master_port) if master_port is not None else None,
+        "backend": distributed_config.backend or ("nccl" if num_gpus_per_node > 0 else "gloo"),
+    }
 
 
 def launch_distributed(config_path: str, worker_fn: Callable, *args, **kwargs):
+    """
+    Spawn `num_procs_per_node` workers on this node. For multi-node training, run the same command
+    on every node with a different `training.distributed.node_rank` (or `NODE_RANK`).
+    """
     config_manager = GlobalFlyConfig(config_path=config_path, disable_chdir=True, disable_logging=True)
     config = config_manager.user_config
 
-    num_gpus_per_node = config.training.num_gpus_per_node
+    distributed_config = get_distributed_config(config)
+    num_nodes = distributed_config["num_nodes"]
+    node_rank = distributed_config["node_rank"]
+    num_procs_per_node = distributed_config["num_procs_per_node"]
 
-    if num_gpus_per_node <= 1:
+    if num_procs_per_node * num_nodes <= 1:
         GlobalFlyConfig._instances.clear()
         config = GlobalFlyConfig(config_path=config_path).user_config
         worker_fn(*args, **kwargs)
@@ -26,11 +75,21 @@ def launch_distributed(config_path: str, worker_fn: Callable, *args, **kwargs):
         # Distributed Training
         current_env = os.environ.copy()
 
-        # TODO: the port should be able to be adjusted manually
-        current_env["MASTER_ADDR"] = "127.0.0.1"
-        current_env["MASTER_PORT"] = "29500"
+        master_port = distributed_config["master_port"]
+        if master_port is None:
+            if num_nodes == 1:
+                master_port = find_free_port()
+            else:
+                # every node has to agree on the port
+                master_port = DEFAULT_MASTER_PORT
+                logger.warning(f"training.distributed.master_port is not set. Using {master_port}")
+
+        current_env["MASTER_ADDR"] = distributed_config["master_addr"]
+        current_env["MASTER_PORT"] = str(master_port)
 
-        current_env["WORLD_SIZE"] = str(num_gpus_per_node)
+        current_env["WORLD_SIZE"] = str(num_procs_per_node * num_nodes)
+        current_env["LOCAL_WORLD_SIZE"] = str(num_procs_per_node)
+        current_env["NODE_RANK"] = str(node_rank)
         current_env["FLY_DISTRIBUTED_INIT"] = str(1)
 
         processes = []
@@ -46,8 +105,8 @@ def launch_distributed(config_path: str, worker_fn: Callable, *args, **kwargs):
                 "*****************************************".format(current_env["OMP_NUM_THREADS"])
             )
 
-        for local_rank in range(0, num_gpus_per_node):
-            dist_rank = local_rank
+        for local_rank in range(0, num_procs_per_node):
+            dist_rank = node_rank * num_procs_per_node + local_rank
             current_env["RANK"] = str(dist_rank)
             current_env["LOCAL_RANK"] = str(local_rank)
 
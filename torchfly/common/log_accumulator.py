@@ -0,0 +1,67 @@
+from typing import Any, Dict, Union
+import torch
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pylint:disable=no-member
+
+
+class LogAccumulator:
+    """
+    Keeps running sums of logged scalars without leaving their devices.
+    Tensors are detached and summed on the device, and only copied to the host in `materialize`,
+    so accumulating every step does not force a device synchronization.
+    """
+    def __init__(self):
+        self.sums: Dict[str, Union[torch.Tensor, float]] = {}
+        self.counts: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.sums)
+
+    def add(self, key: str, value: Union[torch.Tensor, float]):
+        if isinstance(value, torch.Tensor):
+            if value.numel() != 1:
+                raise ValueError(f"{key} must be a scalar to be logged")
+            value = value.detach().reshape(()).float()
+
+        if key in self.sums:
+            self.sums[key] = self.sums[key] + value
+            self.counts[key] += 1
+        else:
+            self.sums[key] = value
+            self.counts[key] = 1
+
+    def update(self, log_dict: Dict[str, Union[torch.Tensor, float]]):
+        for key, value in log_dict.items():
+            self.add(key, value)
+
+    def materialize(self, reset: bool = True) -> Dict[str, float]:
+        """Returns the mean of every key since the last reset
+           All tensors on the same device are copied with a single transfer
+        """
+        results = {}
+        tensor_keys: Dict[torch.device, list] = {}
+
+        for key, value in self.sums.items():
+            if isinstance(value, torch.Tensor):
+                tensor_keys.setdefault(value.device, []).append(key)
+            else:
+                results[key] = float(value) / self.counts[key]
+
+        for keys in tensor_keys.values():
+            values = torch.stack([self.sums[key] for key in keys]).tolist()
+            for key, value in zip(keys, values):
+                results[key] = value / self.counts[key]
+
+        # keep the order in which keys are logged
+        results = {key: results[key] for key in self.sums}
+
+        if reset:
+            self.reset()
+        return results
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
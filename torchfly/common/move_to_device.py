@@ -1,20 +1,30 @@
-import os
+import threading
+import numpy as np
 import torch
 import logging
+from typing import Any, Callable, Dict, List, Tuple
 
 logger = logging.getLogger(__name__)
 
+# pylint:disable=no-member
 
-def move_to_device(data, device, exclude_keys=None):
+
+def move_to_device(data, device, exclude_keys=None, use_plan=False, coalesce=False):
     """
     Args:
         data: a list, dict, or torch.Tensor
         device: the target torch.device
         exclude_keys: remove unwanted keys
+        use_plan: move the batch in a single pass with a plan cached by the type and keys of the batch.
+            The result is the same as without it
+        coalesce: with `use_plan`, copy small CPU tensors to CUDA through one pinned buffer per dtype
     """
     if exclude_keys is None:
         exclude_keys = []
 
+    if use_plan and not isinstance(data, torch.nn.Module):
+        return _move_with_plan(data, device, coalesce)
+
     # send data to device
     if isinstance(data, list):
         new_data = []
@@ -26,13 +36,10 @@ def move_to_device(data, device, exclude_keys=None):
         data = new_data
 
     elif isinstance(data, tuple):
-        new_data = ()
-        for item in data:
-            if isinstance(item, torch.Tensor):
-                new_data = new_data + (item.to(device, non_blocking=True), )
-            else:
-                new_data = new_data + (move_to_device(item, device, exclude_keys), )
-        data = new_data
+        data = tuple(
+            item.to(device, non_blocking=True) if isinstance(item, torch.Tensor) else
+            move_to_device(item, device, exclude_keys) for item in data
+        )
 
     elif isinstance(data, dict):
         new_data = {}
@@ -45,10 +52,171 @@ def move_to_device(data, device, exclude_keys=None):
 
     elif isinstance(data, torch.Tensor) or isinstance(data, torch.nn.Module):
         data = data.to(device, non_blocking=True)
-    elif isinstance(data, int) or isinstance(data, float):
+    elif isinstance(data, np.ndarray) and data.dtype.kind in _TENSOR_DTYPE_KINDS:
+        data = torch.from_numpy(data).to(device, non_blocking=True)
+    elif isinstance(data, (int, float, str, bytes, np.ndarray, np.generic, type(None))):
         data = data
     else:
         logger.error(f"{type(data)} cannot be sent to device")
         raise NotImplementedError
 
-    return data
\ No newline at end of file
+    return data
+
+
+# numpy arrays of other kinds, e.g. strings, are not supported by torch and are kept as they are
+_TENSOR_DTYPE_KINDS = "biufc"
+
+# (type, keys) of a batch -> function which moves batches of that structure
+_plan_cache: Dict[Tuple, Callable] = {}
+_MAX_CACHED_PLANS = 1024
+
+# per thread, e.g. of a prefetcher, dtype -> (pinned buffer, event of the last copy from it)
+_pinned_buffers = threading.local()
+
+
+class _Transfer:
+    "The target device of one call, and the small tensors waiting to be copied together"
+    def __init__(self, device: torch.device, coalesce: bool, coalesce_max_bytes: int = 1 << 16):
+        self.device = device
+        self.coalesce = coalesce and device.type == "cuda"
+        self.coalesce_max_bytes = coalesce_max_bytes
+        # (container, key, tensor), the container entry is replaced in `finish`
+        self.pending: List[Tuple[Any, Any, torch.Tensor]] = []
+
+    def move(self, tensor: torch.Tensor, container=None, key=None) -> torch.Tensor:
+        if self.coalesce and container is not None and tensor.device.type == "cpu" and \
+                tensor.numel() * tensor.element_size() <= self.coalesce_max_bytes:
+            self.pending.append((container, key, tensor))
+            return tensor
+        return tensor.to(self.device, non_blocking=True)
+
+    def finish(self):
+        groups: Dict[torch.dtype, List[Tuple[Any, Any, torch.Tensor]]] = {}
+        for item in self.pending:
+            groups.setdefault(item[2].dtype, []).append(item)
+
+        for items in groups.values():
+            if len(items) == 1:
+                container, key, tensor = items[0]
+                container[key] = tensor.to(self.device, non_blocking=True)
+                continue
+            moved = _coalesced_copy([tensor for _, _, tensor in items], self.device)
+            for (container, key, _), tensor in zip(items, moved):
+                container[key] = tensor
+        self.pending = []
+
+
+def _move_any(data, transfer: _Transfer, container=None, key=None):
+    "The same traversal as the recursive `move_to_device`, for parts without a specialized plan"
+    if isinstance(data, torch.Tensor):
+        return transfer.move(data, container, key)
+    elif isinstance(data, dict):
+        result = {}
+        for k, v in data.items():
+            result[k] = _move_any(v, transfer, result, k)
+        return result
+    elif isinstance(data, list):
+        result = [None] * len(data)
+        for idx, item in enumerate(data):
+            result[idx] = _move_any(item, transfer, result, idx)
+        return result
+    elif isinstance(data, tuple):
+        # tuples are immutable, so their tensors are not coalesced
+        return tuple(_move_any(item, transfer) for item in data)
+    elif isinstance(data, np.ndarray) and data.dtype.kind in _TENSOR_DTYPE_KINDS:
+        return transfer.move(torch.from_numpy(data), container, key)
+    elif isinstance(data, (int, float, str, bytes, np.ndarray, np.generic, type(None))):
+        return data
+    else:
+        logger.error(f"{type(data)} cannot be sent to device")
+        raise NotImplementedError
+
+
+def _move_tensor(data, transfer: _Transfer, container=None, key=None):
+    if type(data) is torch.Tensor:
+        return transfer.move(data, container, key)
+    return _move_any(data, transfer, container, key)
+
+
+def _compile_plan(data) -> Callable:
+    """
+    Returns a function which moves data with the structure of `data`.
+    Dict keys and leaf types are resolved once, and every node falls back to `_move_any`
+    when a batch does not match, so the result never depends on the cached structure.
+    """
+    if type(data) is torch.Tensor:
+        return _move_tensor
+    elif type(data) is dict:
+        keys = tuple(data)
+        children = tuple(_compile_plan(value) for value in data.values())
+
+        def move_dict(value, transfer: _Transfer, container=None, key=None):
+            if type(value) is not dict or tuple(value) != keys:
+                return _move_any(value, transfer, container, key)
+            result = {}
+            for k, child in zip(keys, children):
+                result[k] = child(value[k], transfer, result, k)
+            return result
+
+        return move_dict
+    else:
+        # lists are usually of varying lengths, and other leaves are rare
+        return _move_any
+
+
+def get_transfer_plan(data) -> Callable:
+    "The cached plan for batches with the type and keys of `data`"
+    cache_key = (type(data), tuple(data)) if type(data) is dict else type(data)
+    plan = _plan_cache.get(cache_key)
+    if plan is None:
+        if len(_plan_cache) >= _MAX_CACHED_PLANS:
+            _plan_cache.clear()
+        plan = _compile_plan(data)
+        _plan_cache[cache_key] = plan
+    return plan
+
+
+def _get_thread_pinned_buffers() -> Dict[torch.dtype, Tuple[torch.Tensor, Any]]:
+    "Buffers are never shared between threads, so that a copy from one thread cannot overwrite another one"
+    buffers = getattr(_pinned_buffers, "buffers", None)
+    if buffers is None:
+        buffers = {}
+        _pinned_buffers.buffers = buffers
+    return buffers
+
+
+def _get_pinned_buffer(dtype: torch.dtype, numel: int) -> torch.Tensor:
+    buffers = _get_thread_pinned_buffers()
+    buffer, event = buffers.get(dtype, (None, None))
+    if event is not None:
+        # the previous copy from this buffer must finish before it is overwritten
+        event.synchronize()
+    if buffer is None or buffer.numel() < numel:
+        buffer = torch.empty(max(numel, 1 << 16), dtype=dtype).pin_memory()
+        buffers[dtype] = (buffer, None)
+    return buffer
+
+
+def _coalesced_copy(tensors: List[torch.Tensor], device: torch.device) -> List[torch.Tensor]:
+    "Copy tensors of the same dtype with a single host to device transfer"
+    sizes = [tensor.numel() for tensor in tensors]
+    buffer = _get_pinned_buffer(tensors[0].dtype, sum(sizes))[:sum(sizes)]
+    torch.cat([tensor.reshape(-1) for tensor in tensors], out=buffer)
+
+    device_buffer = buffer.to(device, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record(torch.cuda.current_stream(device))
+    buffers = _get_thread_pinned_buffers()
+    buffers[tensors[0].dtype] = (buffers[tensors[0].dtype][0], event)
+
+    return [
+        chunk.view(tensor.shape) for chunk, tensor in zip(torch.split(device_buffer, sizes), tensors)
+    ]
+
+
+def _move_with_plan(data, device, coalesce: bool):
+    transfer = _Transfer(torch.device(device), coalesce)
+    moved = get_transfer_plan(data)(data, transfer)
+    transfer.finish()
+    return moved
+
@@ -0,0 +1,63 @@
+import itertools
+import torch
+from torch.utils.data import DataLoader, Sampler, IterableDataset
+from typing import Iterable, Iterator
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ShardSampler(Sampler):
+    """
+    Every `num_shards`-th index starting from `shard_id`, in order.
+    Unlike `DistributedSampler`, shards are not padded, so no example is counted twice.
+    """
+    def __init__(self, data_source, shard_id: int, num_shards: int):
+        self.data_source = data_source
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.shard_id, len(self.data_source), self.num_shards))
+
+    def __len__(self) -> int:
+        return len(range(self.shard_id, len(self.data_source), self.num_shards))
+
+
+class StridedIterable:
+    "Every `num_shards`-th batch of an iterable starting from `shard_id`"
+
+    def __init__(self, iterable: Iterable, shard_id: int, num_shards: int):
+        self.iterable = iterable
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+
+    def __iter__(self):
+        return itertools.islice(self.iterable, self.shard_id, None, self.num_shards)
+
+
+def shard_dataloader(dataloader: Iterable, shard_id: int, num_shards: int) -> Iterable:
+    """
+    Split an evaluation dataloader across processes.
+    A `DataLoader` over a map-style dataset is rebuilt with a `ShardSampler`, so each process only loads its shard.
+    Other iterables are strided by batches.
+    """
+    if num_shards <= 1:
+        return dataloader
+
+    if isinstance(dataloader, DataLoader) and not isinstance(dataloader.dataset, IterableDataset) \
+        and dataloader.batch_size is not None:
+        return DataLoader(
+            dataloader.dataset,
+            batch_size=dataloader.batch_size,
+            sampler=ShardSampler(dataloader.dataset, shard_id, num_shards),
+            num_workers=dataloader.num_workers,
+            collate_fn=dataloader.collate_fn,
+            pin_memory=dataloader.pin_memory,
+            drop_last=dataloader.drop_last,
+            timeout=dataloader.timeout,
+            worker_init_fn=dataloader.worker_init_fn,
+        )
+
+    logger.info("Cannot rebuild the dataloader with a sampler. Batches are strided across processes.")
+    return StridedIterable(dataloader, shard_id, num_shards)
@@ -0,0 +1,454 @@
+import os
+import json
+import zlib
+import pickle
+import threading
+import concurrent.futures
+import numpy as np
+import torch
+import logging
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# pylint:disable=no-member
+
+MANIFEST_NAME = "manifest.json"
+OBJECTS_NAME = "objects.pkl"
+TENSORS_DIR = "tensors"
+FORMAT_VERSION = 1
+
+# dtypes without a numpy equivalent are written through a view with the same element size
+_NUMPY_VIEW_DTYPES = {torch.bfloat16: torch.int16}
+
+DELTA_ENCODINGS = ["raw", "xor_zlib"]
+
+
+class TensorRef:
+    "Placeholder of a tensor in the pickled state tree"
+
+    def __init__(self, index: int):
+        self.index = index
+
+
+def _split_tensors(states: Any, tensors: List[torch.Tensor]) -> Any:
+    "Replace tensors with `TensorRef` and collect them in order"
+    if isinstance(states, torch.Tensor):
+        tensors.append(states)
+        return TensorRef(len(tensors) - 1)
+    elif isinstance(states, dict):
+        # keep the dict type, e.g. OrderedDict
+        result = type(states)()
+        for key, value in states.items():
+            result[key] = _split_tensors(value, tensors)
+        return result
+    elif isinstance(states, list):
+        return [_split_tensors(item, tensors) for item in states]
+    elif isinstance(states, tuple):
+        return tuple(_split_tensors(item, tensors) for item in states)
+    else:
+        return states
+
+
+def _merge_tensors(states: Any, tensors: List[torch.Tensor]) -> Any:
+    if isinstance(states, TensorRef):
+        return tensors[states.index]
+    elif isinstance(states, dict):
+        for key, value in states.items():
+            states[key] = _merge_tensors(value, tensors)
+        return states
+    elif isinstance(states, list):
+        return [_merge_tensors(item, tensors) for item in states]
+    elif isinstance(states, tuple):
+        return tuple(_merge_tensors(item, tensors) for item in states)
+    else:
+        return states
+
+
+def _dtype_name(dtype: torch.dtype) -> str:
+    return str(dtype).split(".")[-1]
+
+
+def _to_numpy(tensor: torch.Tensor) -> np.ndarray:
+    "A numpy view of a contiguous CPU tensor"
+    if tensor.dtype in _NUMPY_VIEW_DTYPES:
+        tensor = tensor.view(_NUMPY_VIEW_DTYPES[tensor.dtype])
+    return tensor.numpy()
+
+
+def _fsync_write(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _crc32(array: np.ndarray) -> int:
+    return zlib.crc32(memoryview(np.ascontiguousarray(array).reshape(-1).view(np.uint8))) & 0xffffffff
+
+
+def is_sharded_checkpoint(path: str) -> bool:
+    "A sharded checkpoint is only valid once its manifest exists"
+    return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+
+class ShardedCheckpointWriter:
+    """
+    Saves nested state dicts as one raw file per tensor, written by a background thread pool.
+    `save` only copies tensors into reusable (pinned, when CUDA is available) host buffers,
+    and returns once the snapshot is taken. Two sets of buffers are used in turn, so that a save
+    only waits for the one before the previous save. The manifest is written last with `os.replace`,
+    so a checkpoint directory is either complete or ignored by `load_sharded_checkpoint`.
+
+    Layout:
+        path/manifest.json    tensor dtypes, shapes and crc32 checksums
+        path/objects.pkl      the state tree with tensors replaced by `TensorRef`
+        path/tensors/*.bin    raw tensor data
+
+    A delta checkpoint only writes the tensors that changed since its parent. Its manifest entries
+    of unchanged tensors point to the files of earlier checkpoints, listed in "sources".
+    """
+    def __init__(self, num_workers: int = 4):
+        self.num_workers = num_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        self.pending: List[concurrent.futures.Future] = []
+        # host buffers are reused across saves of the same states, alternating between two sets
+        self._buffers: List[Dict[int, torch.Tensor]] = [{}, {}]
+        # the futures of the last save reading each set of buffers
+        self._buffer_futures: List[List[concurrent.futures.Future]] = [[], []]
+        self._buffer_paths: List[str] = [None, None]
+        self._buffer_set = 0
+        self._lock = threading.Lock()
+
+    def _get_buffer(self, buffer_set: int, index: int, tensor: torch.Tensor) -> torch.Tensor:
+        buffers = self._buffers[buffer_set]
+        buffer = buffers.get(index)
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.shape != tensor.shape:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype)
+            if torch.cuda.is_available():
+                buffer = buffer.pin_memory()
+            buffers[index] = buffer
+        return buffer
+
+    def snapshot(self, states: Any, buffer_set: int = 0) -> Tuple[bytes, List[torch.Tensor], Any]:
+        """Copy all tensors to host buffers
+        Args:
+            buffer_set: which set of buffers to copy into, no pending save may read it
+        Returns:
+            objects: the pickled state tree
+            buffers: host copies of the tensors
+            event: a CUDA event to wait for before reading the buffers, or None
+        """
+        tensors = []
+        objects = pickle.dumps(_split_tensors(states, tensors), protocol=pickle.HIGHEST_PROTOCOL)
+
+        buffers = []
+        has_cuda_tensor = False
+        for index, tensor in enumerate(tensors):
+            tensor = tensor.detach()
+            buffer = self._get_buffer(buffer_set, index, tensor)
+            if tensor.is_cuda:
+                has_cuda_tensor = True
+                buffer.copy_(tensor, non_blocking=True)
+            else:
+                buffer.copy_(tensor)
+            buffers.append(buffer)
+
+        event = None
+        if has_cuda_tensor:
+            event = torch.cuda.Event()
+            event.record()
+        return objects, buffers, event
+
+    def save(
+        self, states: Any, path: str, parent_path: str = None, delta_encoding: str = "raw"
+    ) -> concurrent.futures.Future:
+        """
+        Args:
+            states: a nested dict/list of tensors and picklable objects
+            path: the checkpoint directory
+            parent_path: save a delta checkpoint against this checkpoint in the same storage directory.
+                Unchanged tensors are not written but point to the parent's data. The parent is read
+                by the background threads once earlier saves are written, and a full checkpoint is saved
+                if it is not a valid checkpoint by then
+            delta_encoding: how changed tensors of a delta checkpoint are stored.
+                "raw" writes them as they are, "xor_zlib" compresses the xor with the parent (lossless)
+        Returns:
+            future: completes after the manifest is written
+        """
+        if delta_encoding not in DELTA_ENCODINGS:
+            raise NotImplementedError(f"Unknown delta encoding {delta_encoding}")
+
+        buffer_set = self._buffer_set
+        self._buffer_set = 1 - buffer_set
+        # the buffers can only be reused once the save before the previous one is written.
+        # Its errors are raised by `wait`
+        concurrent.futures.wait(self._buffer_futures[buffer_set])
+
+        parent_future = None
+        if parent_path is not None:
+            with self._lock:
+                earlier_futures = list(self.pending)
+            # submitted before the tensors, so it is already running when they wait for it
+            parent_future = self.executor.submit(self._read_parent, parent_path, earlier_futures)
+
+        objects, buffers, event = self.snapshot(states, buffer_set)
+        os.makedirs(os.path.join(path, TENSORS_DIR), exist_ok=True)
+
+        tensor_futures = []
+        for index, buffer in enumerate(buffers):
+            entry = {
+                "file": os.path.join(TENSORS_DIR, f"{index:06d}.bin"),
+                "dtype": _dtype_name(buffer.dtype),
+                "shape": list(buffer.shape),
+                "nbytes": buffer.numel() * buffer.element_size(),
+            }
+            tensor_futures.append(
+                self.executor.submit(
+                    self._write_tensor, path, index, entry, buffer, event, parent_future, delta_encoding
+                )
+            )
+
+        manifest = {"version": FORMAT_VERSION, "objects": OBJECTS_NAME}
+        future = self.executor.submit(self._finalize, path, objects, manifest, tensor_futures, parent_future)
+
+        futures = tensor_futures + [future]
+        if parent_future is not None:
+            futures.append(parent_future)
+        self._buffer_futures[buffer_set] = futures
+        self._buffer_paths[buffer_set] = path
+        with self._lock:
+            self.pending.extend(futures)
+        return future
+
+    @staticmethod
+    def _read_parent(parent_path: str, earlier_futures: List[concurrent.futures.Future]) -> Tuple[List, List]:
+        """
+        Returns:
+            parent_entries: the manifest entries of the parent, resolved relative to the storage directory
+            sources: the checkpoints the delta depends on, empty to save a full checkpoint
+        """
+        # the parent may be one of the saves still being written
+        concurrent.futures.wait(earlier_futures)
+        if not is_sharded_checkpoint(parent_path):
+            logger.warning(f"The parent checkpoint {parent_path} is missing. A full checkpoint is saved instead.")
+            return [], []
+
+        parent_manifest = read_manifest(parent_path)
+        parent_name = os.path.basename(os.path.normpath(parent_path))
+        parent_entries = [_with_source(entry, parent_name) for entry in parent_manifest["tensors"]]
+        return parent_entries, [parent_name] + parent_manifest.get("sources", [])
+
+    @staticmethod
+    def _write_tensor(
+        path: str, index: int, entry: Dict[str, Any], buffer: torch.Tensor, event,
+        parent_future: concurrent.futures.Future, delta_encoding: str
+    ) -> Dict[str, Any]:
+        "Returns the manifest entry with the crc32 of the tensor data"
+        if event is not None:
+            event.synchronize()
+        array = _to_numpy(buffer)
+        entry["crc32"] = _crc32(array)
+
+        parent_entry = None
+        if parent_future is not None:
+            parent_entries, _ = parent_future.result()
+            if index < len(parent_entries) and parent_entries[index]["dtype"] == entry["dtype"] and \
+                    parent_entries[index]["shape"] == entry["shape"]:
+                parent_entry = parent_entries[index]
+
+        if parent_entry is not None and entry["nbytes"] > 0:
+            storage_dir = os.path.dirname(os.path.normpath(path))
+            parent_data = None
+            # the checksum rejects most changed tensors without reading the parent
+            if parent_entry.get("crc32") == entry["crc32"]:
+                parent_data = _read_bytes(storage_dir, parent_entry, mmap=True)
+                if np.array_equal(parent_data, _as_bytes(array)):
+                    return parent_entry
+
+            if delta_encoding == "xor_zlib":
+                if parent_data is None:
+                    parent_data = _read_bytes(storage_dir, parent_entry, mmap=True)
+                delta = zlib.compress((parent_data ^ _as_bytes(array)).tobytes(), 1)
+                # keep the raw data if the tensor changed too much to compress
+                if len(delta) < entry["nbytes"]:
+                    _fsync_write(os.path.join(path, entry["file"]), delta)
+                    entry.update({"encoding": "xor_zlib", "stored_nbytes": len(delta), "base": parent_entry})
+                    return entry
+
+        with open(os.path.join(path, entry["file"]), "wb") as f:
+            array.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        return entry
+
+    @staticmethod
+    def _finalize(
+        path: str, objects: bytes, manifest: Dict[str, Any], tensor_futures: List[concurrent.futures.Future],
+        parent_future: concurrent.futures.Future
+    ):
+        # raise if any tensor failed, and leave the checkpoint without a manifest
+        manifest["tensors"] = [future.result() for future in tensor_futures]
+        manifest["sources"] = parent_future.result()[1] if parent_future is not None else []
+        if len(manifest["sources"]) > 0:
+            manifest["parent"] = manifest["sources"][0]
+
+        manifest["objects_crc32"] = zlib.crc32(objects) & 0xffffffff
+        _fsync_write(os.path.join(path, OBJECTS_NAME), objects)
+        temp_path = os.path.join(path, MANIFEST_NAME + ".tmp")
+        _fsync_write(temp_path, json.dumps(manifest).encode("utf-8"))
+        os.replace(temp_path, os.path.join(path, MANIFEST_NAME))
+        logger.debug(f"Checkpoint {path} is saved")
+
+    def is_writing(self, path: str) -> bool:
+        "Whether a save to `path` is not written yet"
+        for buffer_path, futures in zip(self._buffer_paths, self._buffer_futures):
+            if buffer_path == path and not all(future.done() for future in futures):
+                return True
+        return False
+
+    def wait(self):
+        "Block until every pending save is written"
+        with self._lock:
+            pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def release_buffers(self):
+        self.wait()
+        self._buffers = [{}, {}]
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    with open(os.path.join(path, MANIFEST_NAME), "r") as f:
+        manifest = json.load(f)
+
+    if manifest["version"] != FORMAT_VERSION:
+        raise ValueError(f"Unknown checkpoint version {manifest['version']}")
+    return manifest
+
+
+def _with_source(entry: Dict[str, Any], name: str) -> Dict[str, Any]:
+    "Make an entry read from the checkpoint `name` usable from another checkpoint"
+    if "source" in entry:
+        return entry
+    return dict(entry, source=name)
+
+
+def _entry_path(storage_dir: str, path: str, entry: Dict[str, Any]) -> str:
+    if "source" in entry:
+        return os.path.join(storage_dir, entry["source"], entry["file"])
+    return os.path.join(path, entry["file"])
+
+
+def _as_bytes(array: np.ndarray) -> np.ndarray:
+    return array.reshape(-1).view(np.uint8)
+
+
+def _read_bytes(storage_dir: str, entry: Dict[str, Any], mmap: bool, path: str = None) -> np.ndarray:
+    "Decode the data of an entry as a flat uint8 array"
+    if entry["nbytes"] == 0:
+        # empty files cannot be memory-mapped
+        return np.zeros(0, dtype=np.uint8)
+
+    file_path = _entry_path(storage_dir, path, entry)
+    encoding = entry.get("encoding", "raw")
+    if encoding == "raw":
+        if mmap:
+            # copy-on-write, so the tensors are writable while the file stays untouched
+            return np.memmap(file_path, dtype=np.uint8, mode="c")
+        return np.fromfile(file_path, dtype=np.uint8)
+    elif encoding == "xor_zlib":
+        base = _read_bytes(storage_dir, entry["base"], mmap)
+        with open(file_path, "rb") as f:
+            delta = np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8)
+        if delta.shape != base.shape:
+            raise ValueError(f"{file_path} does not match its base")
+        return base ^ delta
+    else:
+        raise ValueError(f"Unknown encoding {encoding}")
+
+
+def _check_sizes(storage_dir: str, path: str, entry: Dict[str, Any]):
+    if entry["nbytes"] == 0:
+        return
+    file_path = _entry_path(storage_dir, path, entry)
+    if os.path.getsize(file_path) != entry.get("stored_nbytes", entry["nbytes"]):
+        raise ValueError(f"{file_path} does not match the manifest")
+    if "base" in entry:
+        _check_sizes(storage_dir, path, entry["base"])
+
+
+def validate_sharded_checkpoint(path: str, verify_checksums: bool = False) -> Dict[str, Any]:
+    """Check a checkpoint before anything is loaded
+    The file sizes, including the files of parent checkpoints, and the checksum of the (small)
+    pickled state tree are always checked.
+    Tensor checksums read every tensor file, so they are only checked with `verify_checksums`.
+    Returns:
+        manifest
+    Raises:
+        FileNotFoundError: the checkpoint is incomplete
+        ValueError: a file does not match the manifest
+    """
+    manifest = read_manifest(path)
+    storage_dir = os.path.dirname(os.path.normpath(path))
+
+    for entry in manifest["tensors"]:
+        _check_sizes(storage_dir, path, entry)
+
+    objects_path = os.path.join(path, manifest["objects"])
+    if "objects_crc32" in manifest:
+        with open(objects_path, "rb") as f:
+            if zlib.crc32(f.read()) & 0xffffffff != manifest["objects_crc32"]:
+                raise ValueError(f"{objects_path} is corrupted")
+
+    if verify_checksums:
+        for entry in manifest["tensors"]:
+            if "crc32" not in entry:
+                continue
+            if _crc32(_read_bytes(storage_dir, entry, mmap=True, path=path)) != entry["crc32"]:
+                raise ValueError(f"{_entry_path(storage_dir, path, entry)} is corrupted")
+    return manifest
+
+
+def _load_tensor(path: str, entry: Dict[str, Any], mmap: bool) -> torch.Tensor:
+    dtype = getattr(torch, entry["dtype"])
+    numpy_dtype = _to_numpy(torch.empty(0, dtype=dtype)).dtype
+    array = _read_bytes(os.path.dirname(os.path.normpath(path)), entry, mmap, path=path)
+
+    tensor = torch.from_numpy(array.view(numpy_dtype))
+    if dtype in _NUMPY_VIEW_DTYPES:
+        tensor = tensor.view(dtype)
+    return tensor.reshape(entry["shape"])
+
+
+def load_sharded_checkpoint(path: str, map_location="cpu", mmap: bool = False, verify_checksums: bool = False) -> Any:
+    """Load the states saved by `ShardedCheckpointWriter`
+    Args:
+        path: the checkpoint directory
+        map_location: the device of the loaded tensors
+        mmap: memory-map the tensor files instead of reading them. Pages are only read when a tensor
+            is used, e.g. copied by `load_state_dict`, and are shared by all processes on a node
+        verify_checksums: check the crc32 of every tensor file before loading
+    Delta checkpoints are rebuilt from the checkpoints they depend on, which must be
+    in the same storage directory.
+    Raises:
+        FileNotFoundError: the checkpoint is incomplete
+        ValueError: a file does not match the manifest
+    """
+    manifest = validate_sharded_checkpoint(path, verify_checksums)
+
+    tensors = []
+    for entry in manifest["tensors"]:
+        tensor = _load_tensor(path, entry, mmap)
+        if map_location is not None:
+            tensor = tensor.to(map_location)
+        tensors.append(tensor)
+
+    with open(os.path.join(path, manifest["objects"]), "rb") as f:
+        states = pickle.load(f)
+    return _merge_tensors(states, tensors)
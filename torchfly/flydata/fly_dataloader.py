@@ -37,12 +37,18 @@ class FlyDataLoader:
             self.env.step_async()
             self.started = True
 
+        if self.collate_func is None:
+            # the observations returned by the last call are no longer used
+            self.env.release_shared_results()
+
         observations, infos, dones = self.env.step_wait()
 
         # all env has ended
         if self.drop_last and any(dones):
+            self.env.release_shared_results()
             raise StopIteration
         elif all(dones):
+            self.env.release_shared_results()
             raise StopIteration
         else:
             pass
@@ -53,8 +59,12 @@ class FlyDataLoader:
             observations = self.plasma_client.get(observations)
 
         if self.collate_func is not None:
-            return self.collate_func(observations, infos, dones)
+            batch = self.collate_func(observations, infos, dones)
+            # `collate_func` must copy the observations it keeps, e.g. by stacking them
+            self.env.release_shared_results()
+            return batch
         else:
+            # observations may be views of shared memory, which are valid until the next batch
             return observations, infos, dones
 
     def __del__(self):
@@ -15,6 +15,8 @@ class Average(Metric):
     the metric for you, for instance, you can use this to report the average result using our
     `Metric` API.
     """
+    _state_names = ["_total_value", "_count"]
+
     def __init__(self) -> None:
         self._total_value = 0.0
         self._count = 0
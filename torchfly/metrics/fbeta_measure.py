@@ -42,6 +42,8 @@ class FBetaMeasure(Metric):
         multi-class average ignoring a majority negative class. Labels not present
         in the data will result in 0 components in a macro average.
     """
+    _state_names = ["_true_positive_sum", "_true_sum", "_pred_sum", "_total_sum"]
+
     def __init__(self, beta: float = 1.0, average: str = None, labels: List[int] = None) -> None:
         average_options = (None, "micro", "macro")
         if average not in average_options:
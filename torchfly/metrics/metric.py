@@ -1,14 +1,22 @@
+import numpy as np
 import torch
+import torch.distributed as dist
+import logging
 from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 from ..common.registrable import Registrable
 
+logger = logging.getLogger(__name__)
+
 
 class Metric(Registrable):
     """
     A very general abstract class representing a metric which can be
     accumulated. (allennlp/training/metrics/metric.py)
     """
+    # names of the accumulator attributes, which are summed across processes by `reduce_distributed`
+    _state_names: List[str] = []
+
     def __call__(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -25,6 +33,56 @@ class Metric(Registrable):
         """
         raise NotImplementedError
 
+    def reduce_distributed(self, device: torch.device = None) -> None:
+        """
+        Sum the accumulators of all processes, so that `get_metric` covers the whole sharded dataset.
+        It must be called by every process, in the same order.
+        Args:
+            device: where to communicate, it must be a CUDA device for the NCCL backend
+        """
+        if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+            return
+
+        if len(self._state_names) == 0:
+            # only warn once per metric, as this is called at every evaluation
+            if not getattr(self, "_warned_no_states", False):
+                logger.warning(
+                    f"{type(self).__name__} declares no `_state_names`, so it is not reduced across processes "
+                    "and only covers the data of this process."
+                )
+                self._warned_no_states = True
+            return
+
+        for name in self._state_names:
+            value = getattr(self, name)
+            if isinstance(value, torch.Tensor):
+                tensor = value.detach().to(device=device, dtype=torch.float64).reshape(-1)
+            elif value is None:
+                # not called on this process yet
+                tensor = torch.zeros(0, dtype=torch.float64, device=device)
+            else:
+                tensor = torch.tensor([float(value)], dtype=torch.float64, device=device)
+
+            # processes which have not seen any data do not know the size of the state
+            size = torch.tensor([tensor.numel()], dtype=torch.float64, device=device)
+            dist.all_reduce(size, op=dist.ReduceOp.MAX)
+            size = int(size.item())
+            if size == 0:
+                continue
+            if tensor.numel() == 0:
+                tensor = torch.zeros(size, dtype=torch.float64, device=device)
+            dist.all_reduce(tensor)
+
+            if isinstance(value, torch.Tensor):
+                value = tensor.to(device=value.device, dtype=value.dtype).reshape(value.shape)
+            elif value is None:
+                value = tensor.float().cpu()
+            elif isinstance(value, (int, np.integer)):
+                value = int(tensor.item())
+            else:
+                value = tensor.item()
+            setattr(self, name, value)
+
     @staticmethod
     def detach_tensors(*tensors: torch.Tensor) -> Iterable[torch.Tensor]:
         """
@@ -0,0 +1,135 @@
+import torch
+from typing import List, Tuple
+
+# pylint:disable=no-member
+
+
+class StaticKVCacheLayer:
+    """
+    A view of one layer inside `StaticKVCache`.
+    Attention layers call `update` instead of concatenating `layer_past`.
+    """
+    def __init__(self, cache: "StaticKVCache", layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def update(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            key: (batch, head, seq_length, head_features)
+            value: (batch, head, seq_length, head_features)
+        Returns:
+            key, value: views of all cached positions including the new ones
+        """
+        return self.cache.write(self.layer_idx, key, value)
+
+
+class StaticKVCache:
+    """
+    Preallocated key/value cache for incremental decoding.
+    Every layer owns a buffer of shape (2, batch_size, num_heads, max_length, head_features).
+    New keys and values are written in place at `length`, and the model calls `advance`
+    once all layers have been updated, so no memory is reallocated during decoding.
+    """
+    def __init__(
+        self,
+        num_layers: int,
+        batch_size: int,
+        num_heads: int,
+        max_length: int,
+        head_features: int,
+        dtype: torch.dtype = torch.float,
+        device: torch.device = None
+    ):
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.max_length = max_length
+        self.head_features = head_features
+        self.buffers = [
+            torch.empty(2, batch_size, num_heads, max_length, head_features, dtype=dtype, device=device)
+            for _ in range(num_layers)
+        ]
+        self.layers = [StaticKVCacheLayer(self, idx) for idx in range(num_layers)]
+        # number of active rows and cached positions
+        self.batch_size = batch_size
+        self.length = 0
+
+    @classmethod
+    def from_past(cls, past: List[torch.Tensor], max_length: int) -> "StaticKVCache":
+        """Build a cache from the list-of-tensors `past` format
+        Args:
+            past: a list of tensors with shape (2, batch_size, num_heads, seq_length, head_features)
+            max_length: the total number of positions to preallocate
+        """
+        _, batch_size, num_heads, seq_length, head_features = past[0].shape
+        cache = cls(
+            len(past), batch_size, num_heads, max(max_length, seq_length), head_features, past[0].dtype,
+            past[0].device
+        )
+        for buffer, item in zip(cache.buffers, past):
+            buffer[:, :, :, :seq_length].copy_(item)
+        cache.length = seq_length
+        return cache
+
+    def __len__(self):
+        return self.num_layers
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __getitem__(self, layer_idx: int) -> torch.Tensor:
+        "Returns the valid part of a layer with the same layout as the list-of-tensors `past`"
+        return self.buffers[layer_idx][:, :self.batch_size, :, :self.length]
+
+    def write(self, layer_idx: int, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        seq_length = key.shape[-2]
+        end = self.length + seq_length
+        if end > self.max_length:
+            raise ValueError(f"StaticKVCache overflows: {end} positions > max_length {self.max_length}")
+
+        buffer = self.buffers[layer_idx]
+        buffer[0, :self.batch_size, :, self.length:end] = key
+        buffer[1, :self.batch_size, :, self.length:end] = value
+        return buffer[0, :self.batch_size, :, :end], buffer[1, :self.batch_size, :, :end]
+
+    def advance(self, seq_length: int) -> None:
+        "Move the length pointer after all layers have been written"
+        self.length += seq_length
+
+    def rewind_(self, num_positions: int) -> "StaticKVCache":
+        "Discard the last cached positions, e.g. rejected tokens in speculative decoding"
+        self.length = max(self.length - num_positions, 0)
+        return self
+
+    def index_select_(self, batch_indices: torch.Tensor) -> "StaticKVCache":
+        """Keep or reorder rows in place
+        Args:
+            batch_indices: indices of rows to keep, used by both sequence popping and beam reordering
+        """
+        batch_indices = batch_indices.to(self.buffers[0].device)
+        num_rows = batch_indices.shape[0]
+        for buffer in self.buffers:
+            buffer[:, :num_rows, :, :self.length] = buffer[:, batch_indices, :, :self.length]
+        self.batch_size = num_rows
+        return self
+
+    def expand_(self, num_beams: int) -> "StaticKVCache":
+        """Repeat every row `num_beams` times for beam search
+        This is the only operation which needs new buffers.
+        """
+        for idx, buffer in enumerate(self.buffers):
+            buffer = buffer[:, :self.batch_size].repeat_interleave(num_beams, dim=1)
+            self.buffers[idx] = buffer
+        self.batch_size = self.batch_size * num_beams
+        return self
+
+    def is_compatible(self, batch_size: int, max_length: int, dtype: torch.dtype, device: torch.device) -> bool:
+        "Check if the buffers can be reused for a new generation"
+        buffer = self.buffers[0]
+        return buffer.shape[1] >= batch_size and self.max_length >= max_length and buffer.dtype == dtype \
+            and buffer.device == device
+
+    def reset(self, batch_size: int = None) -> None:
+        "Reuse the buffers for a new generation"
+        self.length = 0
+        self.batch_size = batch_size if batch_size is not None else self.buffers[0].shape[1]
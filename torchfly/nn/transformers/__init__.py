@@ -1,5 +1,7 @@
 from .cached_bert_model import CachedBertEncoder, CachedBertDecoder, CachedBertDecoderLM
 from .modeling_gpt2 import GPT2Model, GPT2LMHeadModel
 from .bert_model import BertModel
+from ..static_kv_cache import StaticKVCache
+from .attention_mask import build_causal_attention_mask
 # from .gpt_model import GPT2Model, GPT2SimpleLM
 from .model_configs import *
@@ -0,0 +1,37 @@
+import torch
+from typing import Dict
+
+# pylint:disable=no-member
+
+# lower triangle templates shared by all models, one per device
+_causal_templates: Dict[torch.device, torch.Tensor] = {}
+
+
+def get_causal_template(length: int, device: torch.device) -> torch.Tensor:
+    """
+    Returns a cached (length, length) lower triangle boolean matrix.
+    The template only grows when a longer sequence is requested.
+    """
+    template = _causal_templates.get(device)
+    if template is None or template.shape[0] < length:
+        template = torch.ones(length, length, dtype=torch.bool, device=device).tril_()
+        _causal_templates[device] = template
+    return template[:length, :length]
+
+
+def build_causal_attention_mask(mask: torch.BoolTensor, query_length: int) -> torch.BoolTensor:
+    """
+    Fast way to compute lower triangle attention mask without per-head copies
+    Args:
+        mask: (batch, key_length) padding mask,
+            or (batch, key_length, key_length) pairwise mask, e.g. block-diagonal for packed sequences
+        query_length: number of positions being computed (the last positions of the keys)
+    Returns:
+        mask: (batch, 1, query_length, key_length) which broadcasts over the heads
+    """
+    key_length = mask.shape[-1]
+    causal = get_causal_template(key_length, mask.device)[key_length - query_length:]
+    if mask.dim() == 3:
+        return causal & mask[:, None, key_length - query_length:, :]
+    # a position is visible only if both the query and the key are not padded
+    return causal & mask[:, None, None, :] & mask[:, None, key_length - query_length:, None]
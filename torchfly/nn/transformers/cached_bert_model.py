@@ -10,6 +10,8 @@ try:
 except:
     warnings.warn("Install apex to improve your performance!")
 
+from .attention_mask import build_causal_attention_mask
+
 # pylint:disable=no-member
 
 
@@ -24,6 +26,7 @@ class CachedBertDecoderEmbeddings(nn.Module):
     """
     def __init__(self, config):
         super().__init__()
+        self.config = config
         self.word_embeddings = nn.Embedding(config.vocab_size, config.hidden_size)
         self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
@@ -60,6 +63,7 @@ class CachedBertEncoderEmbeddings(nn.Module):
     """
     def __init__(self, config):
         super().__init__()
+        self.config = config
         self.word_embeddings = nn.Embedding(config.vocab_size, config.hidden_size)
         self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
@@ -134,7 +138,7 @@ class CachedBertSelfAttention(nn.Module):
         attention_scores = attention_scores / math.sqrt(self.num_attention_heads)
 
         nd, ns = attention_scores.size(-2), attention_scores.size(-1)
-        mask = mask[:, :, ns - nd:ns, :ns]
+        mask = mask[:, :, -nd:, :ns]
 
         # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
         attention_scores = attention_scores.masked_fill_(~mask, -1e4)
@@ -250,7 +254,7 @@ class CachedBertDecoder(nn.Module):
         # past length calculation and dealing with past
         if past is None:
             past_length = input_ids.shape[1]
-            past = [None] * 12
+            past = [None] * len(self.encoder.layer)
         else:
             # count self
             past_length = past[0].shape[3] + input_ids.shape[1]
@@ -260,9 +264,8 @@ class CachedBertDecoder(nn.Module):
             mask = torch.ones(input_ids.shape[0], past_length, dtype=torch.bool, device=input_ids.device)
 
         # Fast way to compute lower triangle attention mask
-        mask = mask.view(input_ids.shape[0], 1, 1, mask.shape[1]).repeat(1, self.num_attention_heads, mask.shape[1], 1)
-        mask = mask & mask.permute(0, 1, 3, 2)
-        mask = torch.tril(mask)
+        # shape: (batch, 1, query_length, key_length)
+        mask = build_causal_attention_mask(mask, input_ids.shape[1])
 
         # calculate embedding output
         embedding_output = self.embeddings(input_ids, position_ids=position_ids)
@@ -290,7 +293,7 @@ class CachedBertDecoderLM(nn.Module):
         """
         self.projection.weight = self.transformer.embeddings.word_embeddings.weight
 
-    def forward(self, input_ids, mask, past=None, position_ids=None):
+    def forward(self, input_ids, mask=None, past=None, position_ids=None):
         hidden_states, presents = self.transformer(input_ids, mask=mask, past=past, position_ids=position_ids)
         lm_logits = self.projection(hidden_states)
         return lm_logits, presents
@@ -311,7 +314,7 @@ class CachedBertEncoder(nn.Module):
         # past length calculation and dealing with past
         if past is None:
             past_length = input_ids.shape[1]
-            past = [None] * 12
+            past = [None] * len(self.encoder.layer)
         else:
             # count self
             past_length = past[0].shape[3] + input_ids.shape[1]
@@ -321,9 +324,8 @@ class CachedBertEncoder(nn.Module):
             mask = torch.ones(input_ids.shape[0], past_length, dtype=torch.bool, device=input_ids.device)
 
         # Fast way to compute lower triangle attention mask
-        mask = mask.view(input_ids.shape[0], 1, 1, mask.shape[1]).repeat(1, self.num_attention_heads, mask.shape[1], 1)
-        mask = mask & mask.permute(0, 1, 3, 2)
-        mask = torch.tril(mask)
+        # shape: (batch, 1, query_length, key_length)
+        mask = build_causal_attention_mask(mask, input_ids.shape[1])
 
         # calculate embedding output
         embedding_output = self.embeddings(input_ids, position_ids=position_ids)
@@ -10,6 +10,9 @@ import math
 from apex.normalization.fused_layer_norm import FusedLayerNorm as LayerNorm
 # from cudatest import GPT_GELU
 
+from ..static_kv_cache import StaticKVCache, StaticKVCacheLayer
+from .attention_mask import build_causal_attention_mask
+
 # pylint:disable=no-member
 
 
@@ -87,13 +90,19 @@ class Attention(nn.Module):
         query = self.split_heads(query)
         key = self.split_heads(key, k=True)
         value = self.split_heads(value)
-        if layer_past is not None:
-            # transpose back cf below
-            past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]
-            key = torch.cat((past_key, key), dim=-1)
-            value = torch.cat((past_value, value), dim=-2)
-        # transpose to have same shapes for stacking
-        present = torch.stack((key.transpose(-2, -1), value))
+        if isinstance(layer_past, StaticKVCacheLayer):
+            # write into the preallocated cache in place
+            key, value = layer_past.update(key.transpose(-2, -1), value)
+            key = key.transpose(-2, -1)
+            present = layer_past
+        else:
+            if layer_past is not None:
+                # transpose back cf below
+                past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]
+                key = torch.cat((past_key, key), dim=-1)
+                value = torch.cat((past_value, value), dim=-2)
+            # transpose to have same shapes for stacking
+            present = torch.stack((key.transpose(-2, -1), value))
 
         a = self._attn(query, key, value, mask)
         a = self.merge_heads(a)
@@ -216,12 +225,17 @@ class GPT2Model(nn.Module):
 
         for block, layer_past in zip(self.h, past):
             # added gradient checkpointing
-            if self.gradient_checkpointing:
+            if self.gradient_checkpointing and not isinstance(past, StaticKVCache):
                 hidden_states, present = torch.utils.checkpoint.checkpoint(block, hidden_states, layer_past, mask)
             else:
                 hidden_states, present = block(hidden_states, layer_past, mask)
             presents.append(present)
 
+        # the static cache is updated in place
+        if isinstance(past, StaticKVCache):
+            past.advance(input_shape[-1])
+            presents = past
+
         hidden_states = self.ln_f(hidden_states)
         output_shape = position_ids.shape + (hidden_states.size(-1), )
         return hidden_states.view(*output_shape), presents
@@ -266,11 +280,8 @@ class GPT2SimpleLM(nn.Module):
             mask = torch.ones(input_ids.shape[0], past_length, dtype=torch.bool, device=input_ids.device)
 
         # Fast way to compute lower triangle attention mask
-        # shape: (batch, num_head, key_length, query_length/seq_length)
-        mask = mask.view(input_ids.shape[0], 1, 1, mask.shape[1]).repeat(1, self.config.n_head, mask.shape[1], 1)
-        mask = mask & mask.permute(0, 1, 3, 2)
-        mask = torch.tril(mask)
-        mask = mask[:, :, -input_ids.shape[1]:, :]
+        # shape: (batch, 1, query_length/seq_length, key_length)
+        mask = build_causal_attention_mask(mask, input_ids.shape[1])
 
         hidden_states, presents = self.transformer(input_ids, position_ids, past, mask)
         lm_logits = self.lm_head(hidden_states)
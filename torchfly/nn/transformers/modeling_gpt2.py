@@ -11,6 +11,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss
 
+from ..static_kv_cache import StaticKVCache, StaticKVCacheLayer
+from .attention_mask import build_causal_attention_mask
+
 # pylint:disable=no-member
 
 logger = logging.getLogger(__name__)
@@ -96,11 +99,17 @@ class Attention(nn.Module):
         query = self.split_heads(query)
         key = self.split_heads(key, k=True)
         value = self.split_heads(value)
-        if layer_past is not None:
-            past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
-            key = torch.cat((past_key, key), dim=-1)
-            value = torch.cat((past_value, value), dim=-2)
-        present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
+        if isinstance(layer_past, StaticKVCacheLayer):
+            # write into the preallocated cache in place
+            key, value = layer_past.update(key.transpose(-2, -1), value)
+            key = key.transpose(-2, -1)
+            present = layer_past
+        else:
+            if layer_past is not None:
+                past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
+                key = torch.cat((past_key, key), dim=-1)
+                value = torch.cat((past_value, value), dim=-2)
+            present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
 
         attn_outputs = self._attn(query, key, value, attention_mask)
         a = attn_outputs[0]
@@ -236,13 +245,9 @@ class GPT2Model(nn.Module):
         if attention_mask is None:
             attention_mask = input_ids != self.config.pad_token_id
 
-        attention_mask = attention_mask.view(input_ids.shape[0], 1, 1, attention_mask.shape[1]).repeat(
-            1, self.config.n_head, attention_mask.shape[1], 1
-        )
-        attention_mask = attention_mask & attention_mask.permute(0, 1, 3, 2)
         # only keep the lower triangle for language model
-        attention_mask = torch.tril(attention_mask)
-        attention_mask = attention_mask[:, :, -input_ids.shape[1]:, :]
+        # shape: (batch, 1, query_length, key_length)
+        attention_mask = build_causal_attention_mask(attention_mask, input_shape[-1])
 
         if inputs_embeds is None:
             inputs_embeds = self.wte(input_ids)
@@ -277,6 +282,11 @@ class GPT2Model(nn.Module):
 
         hidden_states = self.ln_f(hidden_states)
 
+        # the static cache is updated in place
+        if isinstance(past, StaticKVCache):
+            past.advance(input_shape[-1])
+            presents = past
+
         hidden_states = hidden_states.view(*output_shape)
         # Add last hidden state
         if self.output_hidden_states:
@@ -12,6 +12,7 @@ import logging
 
 from .vector_env import VectorEnv
 from .utils import CloudpickleWrapper
+from .shared_memory import SharedMemoryRing
 
 logger = logging.getLogger(__name__)
 
@@ -33,17 +34,30 @@ class AsyncVectorEnv(VectorEnv):
         action_space=None,
         context: str = 'spawn',
         in_series: int = 1,
-        plasma_config: OmegaConf = None
+        plasma_config: OmegaConf = None,
+        shared_memory_slots: int = 0,
+        shared_memory_slot_size: int = 64 * 1024 * 1024,
+        copy_shared_results: bool = False
     ):
         """
         Args:
             env_fns: iterable of callables -  functions that create environments to run in subprocesses. Need to be cloud-pickleable
             in_series: number of environments to run in series in a single process
                 (e.g. when len(env_fns) == 12 and in_series == 3, it will run 4 processes, each running 3 envs in series)
+            shared_memory_slots: if larger than 0, workers write the arrays and tensors of step results
+                into a ring of this many shared-memory slots and only send descriptors through the pipe.
+                The returned observations are views of the slots, which stay valid until
+                `release_shared_results` is called. Workers fall back to the pipe while all slots are held
+            shared_memory_slot_size: bytes per slot for the results of all the environments of a worker
+            copy_shared_results: copy the results out of the slots in `step_wait` and release them right away
         """
         super().__init__(num_envs=len(env_funcs), observation_space=observation_space, action_space=action_space)
         self.closed = False
         self.in_series = in_series
+        self.copy_shared_results = copy_shared_results
+
+        if shared_memory_slots > 0 and plasma_config:
+            raise ValueError("Choose either the plasma store or shared memory slots to return observations")
 
         num_envs = len(env_funcs)
 
@@ -58,11 +72,21 @@ class AsyncVectorEnv(VectorEnv):
 
         self.manager_pipes, self.worker_pipes = zip(*[ctx.Pipe() for _ in range(self.num_subproc)])
 
+        if shared_memory_slots > 0:
+            self.shared_rings = [
+                SharedMemoryRing(shared_memory_slots, shared_memory_slot_size) for _ in range(self.num_subproc)
+            ]
+        else:
+            self.shared_rings = [None] * self.num_subproc
+        # slots of the returned results, for each worker
+        self._held_slots = [[] for _ in range(self.num_subproc)]
+
         self.processes = [
             ctx.Process(
-                target=worker, args=(seg_ranks, worker_pipe, manager_pipe, CloudpickleWrapper(env_func), plasma_config)
-            ) for (worker_pipe, manager_pipe, env_func,
-                   seg_ranks) in zip(self.worker_pipes, self.manager_pipes, env_funcs, ranks)
+                target=worker,
+                args=(seg_ranks, worker_pipe, manager_pipe, CloudpickleWrapper(env_func), plasma_config, shared_ring)
+            ) for (worker_pipe, manager_pipe, env_func, seg_ranks,
+                   shared_ring) in zip(self.worker_pipes, self.manager_pipes, env_funcs, ranks, self.shared_rings)
         ]
 
         for process in self.processes:
@@ -114,12 +138,41 @@ class AsyncVectorEnv(VectorEnv):
         self._state = AsyncState.WAITING_STEP
 
     def step_wait(self):
+        """
+        Returns:
+            observations, infos and dones of all the environments. With shared memory slots and without
+            `copy_shared_results`, the arrays and tensors in them are views of the slots. They must not be
+            used after `release_shared_results` is called, and the workers only reuse a slot after that.
+        """
         results = [pipe.recv() for pipe in self.manager_pipes]
+        if self.shared_rings[0] is not None:
+            results = self._read_shared_results(results)
         results = _flatten_list(results)
         observations, infos, dones = zip(*results)
         self._state = AsyncState.DEFAULT
         return observations, infos, dones
 
+    def _read_shared_results(self, payloads):
+        results = []
+        for worker_idx, (ring, (slot, result)) in enumerate(zip(self.shared_rings, payloads)):
+            results.append(ring.read(result, copy=self.copy_shared_results))
+            if slot is not None:
+                self._held_slots[worker_idx].append(slot)
+
+        if self.copy_shared_results:
+            self.release_shared_results()
+        return results
+
+    def release_shared_results(self):
+        """
+        Give the shared slots of all the results returned by `step_wait` so far back to the workers.
+        Views of those results must not be used afterwards, e.g. call it after they are collated or copied.
+        """
+        for pipe, slots in zip(self.manager_pipes, self._held_slots):
+            if len(slots) > 0:
+                pipe.send(('release', slots))
+        self._held_slots = [[] for _ in range(self.num_subproc)]
+
     def seed(self, seeds=None):
         self._assert_is_running()
 
@@ -144,7 +197,12 @@ class AsyncVectorEnv(VectorEnv):
 
     def flush_pipe(self):
         if self._state == AsyncState.WAITING_RESET or self._state == AsyncState.WAITING_STEP:
-            [pipe.recv() for pipe in self.manager_pipes]
+            results = [pipe.recv() for pipe in self.manager_pipes]
+            if self._state == AsyncState.WAITING_STEP and self.shared_rings[0] is not None:
+                # nobody sees the discarded results
+                for pipe, (slot, _) in zip(self.manager_pipes, results):
+                    if slot is not None:
+                        pipe.send(('release', [slot]))
             self._state = AsyncState.DEFAULT
 
     def close_extras(self, timeout=None, terminate=False):
@@ -206,7 +264,8 @@ def worker(
     pipe: List[mp.Pipe],
     parent_pipe: List[mp.Pipe],
     env_fn_wrappers: List[Callable],
-    plasma_config: OmegaConf = None
+    plasma_config: OmegaConf = None,
+    shared_ring: SharedMemoryRing = None
 ):
     """
     """
@@ -231,7 +290,13 @@ def worker(
         while True:
             command, data = pipe.recv()
             if command == 'step':
-                pipe.send([step_env(env, action) for env, action in zip(envs, data)])
+                results = [step_env(env, action) for env, action in zip(envs, data)]
+                if shared_ring is not None:
+                    # (slot, results with descriptors)
+                    results = shared_ring.write(results)
+                pipe.send(results)
+            elif command == 'release':
+                shared_ring.release(data)
             elif command == 'reset':
                 pipe.send([env.reset() for env in envs])
             elif command == 'seed':
@@ -0,0 +1,189 @@
+import collections
+import numpy as np
+import torch
+import logging
+from typing import Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# pylint:disable=no-member
+
+# offsets are aligned so that every array view is aligned for its dtype
+ALIGNMENT = 64
+
+# dtypes without a numpy equivalent are copied through a view with the same element size
+_NUMPY_VIEW_DTYPES = {torch.bfloat16: torch.int16}
+
+
+class SlotRef:
+    "Placeholder of an array or a tensor written into a shared slot"
+    __slots__ = ("slot", "offset", "dtype", "shape", "torch_dtype")
+
+    def __init__(self, slot: int, offset: int, dtype: str, shape: Tuple[int, ...], torch_dtype: str = None):
+        self.slot = slot
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+        # None for numpy arrays
+        self.torch_dtype = torch_dtype
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def _as_numpy(value: Any) -> Tuple[np.ndarray, str]:
+    "Returns the array to copy and the torch dtype name, or None if the value cannot be stored"
+    if isinstance(value, torch.Tensor):
+        if value.is_cuda or value.is_sparse:
+            return None, None
+        tensor = value.detach()
+        torch_dtype = str(tensor.dtype).split(".")[-1]
+        if tensor.dtype in _NUMPY_VIEW_DTYPES:
+            tensor = tensor.view(_NUMPY_VIEW_DTYPES[tensor.dtype])
+        return tensor.numpy(), torch_dtype
+    elif isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return value, None
+    else:
+        return None, None
+
+
+def _rebuild_tuple(value: tuple, items: list) -> tuple:
+    # namedtuples take their fields as arguments
+    if hasattr(value, "_fields"):
+        return type(value)(*items)
+    return tuple(items)
+
+
+class SharedMemoryRing:
+    """
+    A ring of preallocated shared-memory slots owned by one worker process.
+    The worker copies the arrays and tensors of a result into a free slot and sends the rest of it,
+    with `SlotRef` descriptors in their places, through the pipe. The main process rebuilds the result
+    as views of the slot without copying.
+
+    A slot is only written again after the main process gives it back with `release`, so views are never
+    overwritten while they are used. When no slot is free, or an array does not fit in the remaining space
+    of a slot, the data is sent through the pipe instead.
+
+    Args:
+        num_slots: number of slots in the ring, at least 2 so that a step can run while the last result is used
+        slot_size: size of a slot in bytes, rounded up to `ALIGNMENT`
+    """
+    def __init__(self, num_slots: int, slot_size: int):
+        if num_slots < 2:
+            raise ValueError("SharedMemoryRing needs at least 2 slots")
+        self.num_slots = num_slots
+        # every slot starts aligned, so that the views in all slots are aligned for their dtype
+        self.slot_size = (slot_size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        # torch moves the storage to shared memory and passes its handle to the worker
+        self.buffer = torch.zeros((num_slots, self.slot_size), dtype=torch.uint8).share_memory_()
+        # only used by the worker
+        self._free_slots = collections.deque(range(num_slots))
+        self._offset = 0
+        self._array = None
+        self._warned_full = False
+        self._warned_size = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def _get_array(self) -> np.ndarray:
+        if self._array is None:
+            self._array = self.buffer.numpy()
+        return self._array
+
+    def write(self, result: Any) -> Tuple[Optional[int], Any]:
+        """
+        Called by the worker. Copies the result into a free slot.
+        Returns:
+            the slot, or None if nothing was written, and what to send through the pipe
+        """
+        if len(self._free_slots) == 0:
+            if not self._warned_full:
+                logger.warning(
+                    f"All {self.num_slots} shared slots are still used by the main process. "
+                    "Results are sent through the pipe until slots are released."
+                )
+                self._warned_full = True
+            return None, result
+
+        slot = self._free_slots.popleft()
+        self._offset = 0
+        result = self._write(result, slot)
+        if self._offset == 0:
+            # no array was stored
+            self._free_slots.appendleft(slot)
+            return None, result
+        return slot, result
+
+    def release(self, slots: List[int]):
+        "Called by the worker when the main process no longer uses the slots"
+        self._free_slots.extend(slots)
+
+    def _write(self, value: Any, slot: int) -> Any:
+        if isinstance(value, dict):
+            # keep the dict type, e.g. OrderedDict
+            result = type(value)()
+            for key, item in value.items():
+                result[key] = self._write(item, slot)
+            return result
+        elif isinstance(value, list):
+            return [self._write(item, slot) for item in value]
+        elif isinstance(value, tuple):
+            return _rebuild_tuple(value, [self._write(item, slot) for item in value])
+
+        array, torch_dtype = _as_numpy(value)
+        if array is None:
+            return value
+
+        offset = self._offset
+        end = offset + array.nbytes
+        if end > self.slot_size:
+            if not self._warned_size:
+                logger.warning(
+                    f"A result needs more than the {self.slot_size} bytes of a shared slot. "
+                    "The rest of it is sent through the pipe."
+                )
+                self._warned_size = True
+            return value
+
+        destination = self._get_array()[slot, offset:end].view(array.dtype).reshape(array.shape)
+        np.copyto(destination, array)
+        self._offset = (end + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        return SlotRef(slot, offset, array.dtype.str, array.shape, torch_dtype)
+
+    def read(self, result: Any, copy: bool = False) -> Any:
+        """
+        Called by the main process. Replaces the `SlotRef` in a result with views of the slots.
+        Args:
+            copy: copy the arrays out of the slots, so that the slots can be released right away
+        """
+        if isinstance(result, SlotRef):
+            dtype = np.dtype(result.dtype)
+            end = result.offset + dtype.itemsize * int(np.prod(result.shape, dtype=np.int64))
+            array = self._get_array()[result.slot, result.offset:end].view(dtype).reshape(result.shape)
+            if copy:
+                array = array.copy()
+            if result.torch_dtype is None:
+                return array
+            tensor = torch.from_numpy(array)
+            torch_dtype = getattr(torch, result.torch_dtype)
+            if tensor.dtype != torch_dtype:
+                tensor = tensor.view(torch_dtype)
+            return tensor
+        elif isinstance(result, dict):
+            for key, value in result.items():
+                result[key] = self.read(value, copy)
+            return result
+        elif isinstance(result, list):
+            return [self.read(item, copy) for item in result]
+        elif isinstance(result, tuple):
+            return _rebuild_tuple(result, [self.read(item, copy) for item in result])
+        else:
+            return result
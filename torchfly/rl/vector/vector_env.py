@@ -42,6 +42,12 @@ class VectorEnv(Env):
     def step_async(self, actions):
         pass
 
+    def release_shared_results(self):
+        r"""Give back the memory of the results returned so far, if they are views of memory shared
+        with the workers. Does nothing by default.
+        """
+        pass
+
     def step_wait(self, **kwargs):
         raise NotImplementedError()
 
@@ -1 +1,5 @@
-from .seq2seq_dataset import Seq2SeqDataset
\ No newline at end of file
+from .seq2seq_dataset import Seq2SeqDataset
+from .tokenized_corpus import TokenizedSeq2SeqDataset, pretokenize_seq2seq
+from .bucket_batch_sampler import BucketBatchSampler
+from .packing_collator import PackingCollator, pack_sequences, build_packed_attention_mask
+from .tokenization_cache import TokenizationCache
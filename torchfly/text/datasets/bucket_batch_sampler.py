@@ -0,0 +1,168 @@
+import numpy as np
+from torch.utils.data import Sampler
+from typing import Any, Dict, Iterator, List, Sequence
+import logging
+
+from torchfly.common import get_rank, get_world_size
+
+logger = logging.getLogger(__name__)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches examples of similar lengths under a token budget instead of a fixed batch size.
+
+    Every epoch, the indices are shuffled with `seed + epoch` and split into pools of `pool_size`
+    examples. Each pool is sorted by length and cut into batches whose padded size,
+    `batch_size * max_length` summed over the length columns, stays within `max_tokens`.
+    The batch order is then shuffled again, and every process takes every `num_replicas`-th batch.
+    Processes always get the same number of batches, so that they stay in sync.
+
+    A DataLoader with workers takes batches from the sampler ahead of the training loop. To resume
+    exactly, pass the number of batches the training loop consumed in the current pass to `state_dict`.
+
+    Args:
+        lengths: (num_examples,) or (num_examples, num_columns) lengths, e.g. source and target lengths
+        max_tokens: the token budget of a batch, including padding
+        max_batch_size: the maximum number of examples in a batch
+        pool_size: number of examples sorted together. Larger pools have less padding but less randomness
+        shuffle: shuffle the pools and batches
+        seed: the base seed, the same on every process
+        num_replicas: number of processes, the world size by default
+        rank: rank of this process
+        drop_last: drop the last batches which cannot be split evenly across processes
+            instead of repeating the first ones
+    """
+    def __init__(
+        self,
+        lengths: Sequence,
+        max_tokens: int,
+        max_batch_size: int = None,
+        pool_size: int = 10000,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: int = None,
+        rank: int = None,
+        drop_last: bool = False
+    ):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        if self.lengths.ndim == 1:
+            self.lengths = self.lengths[:, None]
+        if self.lengths.ndim != 2:
+            raise ValueError("lengths must have the shape (num_examples,) or (num_examples, num_columns)")
+
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()[0]
+        self.drop_last = drop_last
+
+        self.epoch = 0
+        # batches already yielded in the current epoch, used to resume
+        self.num_yielded = 0
+        self._cached_epoch = None
+        self._cached_batches = None
+        # epoch, first batch and number of batches of the pass being iterated
+        self._pass = None
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.num_yielded = 0
+        self.epoch = epoch
+
+    def _make_batches(self, indices: np.ndarray) -> List[List[int]]:
+        batches = []
+        batch = []
+        max_lengths = np.zeros(self.lengths.shape[1], dtype=np.int64)
+
+        for index in indices:
+            new_max_lengths = np.maximum(max_lengths, self.lengths[index])
+            cost = (len(batch) + 1) * int(new_max_lengths.sum())
+            is_full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+
+            if len(batch) > 0 and (cost > self.max_tokens or is_full):
+                batches.append(batch)
+                batch = []
+                new_max_lengths = self.lengths[index].copy()
+                if int(new_max_lengths.sum()) > self.max_tokens:
+                    logger.warning(f"Example {index} alone exceeds max_tokens {self.max_tokens}")
+
+            batch.append(int(index))
+            max_lengths = new_max_lengths
+
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def get_batches(self) -> List[List[int]]:
+        "All batches of this process in the current epoch"
+        if self._cached_epoch == self.epoch:
+            return self._cached_batches
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+        num_examples = len(self.lengths)
+        indices = rng.permutation(num_examples) if self.shuffle else np.arange(num_examples)
+        total_lengths = self.lengths.sum(axis=1)
+
+        batches = []
+        for start in range(0, num_examples, self.pool_size):
+            pool = indices[start:start + self.pool_size]
+            # stable, so that ties keep the shuffled order
+            pool = pool[np.argsort(total_lengths[pool], kind="stable")]
+            batches.extend(self._make_batches(pool))
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        # every process gets the same number of batches
+        remainder = len(batches) % self.num_replicas
+        if remainder > 0:
+            if self.drop_last:
+                batches = batches[:len(batches) - remainder]
+            else:
+                padding = self.num_replicas - remainder
+                batches = batches + (batches * (padding // len(batches) + 1))[:padding]
+
+        self._cached_epoch = self.epoch
+        self._cached_batches = batches[self.rank::self.num_replicas]
+        return self._cached_batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self.get_batches()
+        start = self.num_yielded
+        self._pass = (self.epoch, start, len(batches))
+        for batch in batches[start:]:
+            self.num_yielded += 1
+            yield batch
+        # the next epoch starts from the beginning
+        self.num_yielded = 0
+        self.epoch += 1
+
+    def __len__(self) -> int:
+        return len(self.get_batches())
+
+    def state_dict(self, num_consumed: int = None) -> Dict[str, Any]:
+        """
+        Args:
+            num_consumed: batches the training loop consumed since the current pass started.
+                Without it, the state counts the batches handed to the DataLoader,
+                which is only exact with `num_workers=0`
+        """
+        if num_consumed is None or self._pass is None:
+            return {"epoch": self.epoch, "num_yielded": self.num_yielded, "seed": self.seed}
+
+        epoch, start, num_batches = self._pass
+        num_yielded = start + num_consumed
+        if num_yielded >= num_batches:
+            # the pass is finished, the next one starts from the beginning
+            epoch, num_yielded = epoch + 1, 0
+        return {"epoch": epoch, "num_yielded": num_yielded, "seed": self.seed}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        self.epoch = state_dict["epoch"]
+        self.num_yielded = state_dict["num_yielded"]
+        self.seed = state_dict["seed"]
+        self._pass = None
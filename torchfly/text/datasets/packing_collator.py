@@ -0,0 +1,105 @@
+import torch
+from typing import Any, Dict, List, Sequence, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pylint: disable=no-member
+
+
+def pack_sequences(lengths: Sequence[int], max_length: int) -> List[List[int]]:
+    """
+    First-fit decreasing assignment of sequences to rows of `max_length` tokens
+    Returns:
+        rows: indices of the sequences in each row, in their original order
+    """
+    order = sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True)
+    rows = []
+    remaining = []
+    for index in order:
+        for row_idx, space in enumerate(remaining):
+            if lengths[index] <= space:
+                rows[row_idx].append(index)
+                remaining[row_idx] -= lengths[index]
+                break
+        else:
+            rows.append([index])
+            remaining.append(max_length - lengths[index])
+    return [sorted(row) for row in rows]
+
+
+def build_packed_attention_mask(segment_ids: torch.LongTensor) -> torch.BoolTensor:
+    """
+    Args:
+        segment_ids: (batch, length), 1, 2, ... for the packed examples and 0 for padding
+    Returns:
+        mask: (batch, length, length) block-diagonal causal mask. Padding attends to nothing
+    """
+    length = segment_ids.shape[1]
+    same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+    causal = torch.ones(length, length, dtype=torch.bool, device=segment_ids.device).tril_()
+    return same_segment & causal & (segment_ids > 0)[:, None, :]
+
+
+class PackingCollator:
+    """
+    Packs several short examples into fixed-length rows for causal language modeling,
+    so that no compute is spent on padding tokens.
+
+    Each example gets its own position ids starting from `position_offset`, and the block-diagonal
+    causal `mask` prevents attention across examples. It can be given to `GPT2SimpleLM` as `mask`.
+    `target_ids` are the next tokens, and `loss_mask` is 0 at the last token of every example and
+    on padding, to be used with `SequenceCrossEntropyLoss`. `example_indices` lists the examples of each row.
+
+    Args:
+        max_length: length of the packed rows. Longer examples are truncated
+        pad_token_id: token of the unused positions at the end of a row
+        input_key: the key of the token ids if examples are dicts
+        position_offset: the first position id, e.g. `padding_idx + 1` for RoBERTa-style embeddings
+    """
+    def __init__(self, max_length: int, pad_token_id: int, input_key: str = "input_ids", position_offset: int = 0):
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self.input_key = input_key
+        self.position_offset = position_offset
+
+    def get_token_ids(self, item: Any) -> torch.LongTensor:
+        if isinstance(item, dict):
+            item = item[self.input_key]
+        token_ids = torch.as_tensor(item, dtype=torch.long).view(-1)
+        if len(token_ids) > self.max_length:
+            token_ids = token_ids[:self.max_length]
+        return token_ids
+
+    def __call__(self, batch: List[Any]) -> Dict[str, torch.Tensor]:
+        sequences = [self.get_token_ids(item) for item in batch]
+        rows = pack_sequences([len(sequence) for sequence in sequences], self.max_length)
+
+        input_ids = torch.full((len(rows), self.max_length), self.pad_token_id, dtype=torch.long)
+        target_ids = torch.full((len(rows), self.max_length), self.pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros(len(rows), self.max_length, dtype=torch.long)
+        segment_ids = torch.zeros(len(rows), self.max_length, dtype=torch.long)
+        loss_mask = torch.zeros(len(rows), self.max_length)
+
+        for row_idx, row in enumerate(rows):
+            start = 0
+            for segment_idx, index in enumerate(row):
+                sequence = sequences[index]
+                end = start + len(sequence)
+                input_ids[row_idx, start:end] = sequence
+                target_ids[row_idx, start:end - 1] = sequence[1:]
+                position_ids[row_idx, start:end] = torch.arange(len(sequence)) + self.position_offset
+                segment_ids[row_idx, start:end] = segment_idx + 1
+                # the last token has nothing to predict inside its own example
+                loss_mask[row_idx, start:end - 1] = 1.0
+                start = end
+
+        return {
+            "input_ids": input_ids,
+            "position_ids": position_ids,
+            "segment_ids": segment_ids,
+            "mask": build_packed_attention_mask(segment_ids),
+            "target_ids": target_ids,
+            "loss_mask": loss_mask,
+            "example_indices": rows,
+        }
@@ -4,14 +4,22 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 from torch.nn.utils.rnn import pad_sequence
 
+from .tokenization_cache import TokenizationCache, hash_file, tokenizer_identity
+
 # pylint: disable=no-member
 
 
 class Seq2SeqDataset(Dataset):
     """
     A Simple Seq2Seq Dataset Implementation
+    Args:
+        cache_path: optional SQLite file to cache the tokenized examples across epochs and DataLoader workers.
+            Entries are keyed by the hash of the dataset file and the tokenizer
+        cache_memory_items: size of the in-memory LRU in front of the cache file
     """
-    def __init__(self, filename, tokenizer, add_bos_token=True, add_eos_token=True):
+    def __init__(
+        self, filename, tokenizer, add_bos_token=True, add_eos_token=True, cache_path=None, cache_memory_items=10000
+    ):
         with open(filename, "r") as f:
             self.data = f.readlines()
 
@@ -20,11 +28,30 @@ class Seq2SeqDataset(Dataset):
         self.add_bos_token = add_bos_token
         self.add_eos_token = add_eos_token
 
-    def __getitem__(self, index):
+        self.cache = None
+        if cache_path is not None:
+            namespace = hash_file(filename) + "-" + tokenizer_identity(tokenizer)
+            self.cache = TokenizationCache(cache_path, namespace, max_memory_items=cache_memory_items)
+
+    def encode(self, index):
+        "Returns the source and target token ids without special tokens"
+        if self.cache is not None:
+            cached = self.cache.get(index)
+            if cached is not None:
+                return cached
+
         item = self.data[index]
         source_token_ids = self.tokenizer.encode(item["source"], add_special_tokens=False)
         target_token_ids = self.tokenizer.encode(item["target"], add_special_tokens=False)
 
+        if self.cache is not None:
+            self.cache.put(index, source_token_ids, target_token_ids)
+        return source_token_ids, target_token_ids
+
+    def __getitem__(self, index):
+        item = self.data[index]
+        source_token_ids, target_token_ids = self.encode(index)
+
         if self.add_bos_token:
             target_token_ids.insert(0, self.tokenizer.bos_token_id)
 
@@ -41,6 +68,18 @@ class Seq2SeqDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def get_lengths(self):
+        """
+        Source and target token lengths of all examples, e.g. for `BucketBatchSampler`.
+        It tokenizes the whole dataset once, so prefer `TokenizedSeq2SeqDataset` for large corpora
+        """
+        if getattr(self, "_lengths", None) is None:
+            self._lengths = []
+            for index in range(len(self)):
+                item = self[index]
+                self._lengths.append((len(item["source_token_ids"]), len(item["target_token_ids"])))
+        return self._lengths
+
     def collate_fn(self, batch):
         new_batch = {}
         new_batch["source_text"] = [item["source_text"] for item in batch]
@@ -0,0 +1,119 @@
+import os
+import array
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(filename: str, chunk_size: int = 1 << 20) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def tokenizer_identity(tokenizer) -> str:
+    "A hash of the tokenizer class, name and vocabulary"
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(type(tokenizer).__name__.encode("utf-8"))
+    hasher.update(str(getattr(tokenizer, "name_or_path", "")).encode("utf-8"))
+    if hasattr(tokenizer, "get_vocab"):
+        for token, token_id in sorted(tokenizer.get_vocab().items(), key=lambda item: item[1]):
+            hasher.update(f"{token_id}\t{token}\n".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _to_blob(token_ids: List[int]) -> bytes:
+    return array.array("i", token_ids).tobytes()
+
+
+def _from_blob(blob: bytes) -> List[int]:
+    token_ids = array.array("i")
+    token_ids.frombytes(blob)
+    return token_ids.tolist()
+
+
+class TokenizationCache:
+    """
+    Caches the source and target token ids of examples in a SQLite file, with an in-memory LRU in front.
+    Entries are keyed by `namespace`, which should identify the dataset file and the tokenizer, and the index.
+    DataLoader workers share the file: every process opens its own connection after a fork,
+    and concurrent writes are serialized by SQLite in WAL mode.
+    """
+    def __init__(self, cache_path: str, namespace: str, max_memory_items: int = 10000):
+        self.cache_path = cache_path
+        self.namespace = namespace
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._connection = None
+        self._pid = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        # create the table once in the main process
+        self._get_connection()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # a connection cannot be used across a fork
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.cache_path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS tokens "
+                "(namespace TEXT, idx INTEGER, source BLOB, target BLOB, PRIMARY KEY (namespace, idx))"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        state["_memory"] = OrderedDict()
+        return state
+
+    def get(self, index: int) -> Optional[Tuple[List[int], List[int]]]:
+        "Returns new lists of the source and target token ids, or None"
+        item = self._memory.get(index)
+        if item is None:
+            row = self._get_connection().execute(
+                "SELECT source, target FROM tokens WHERE namespace = ? AND idx = ?", (self.namespace, index)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            item = (tuple(_from_blob(row[0])), tuple(_from_blob(row[1])))
+            self._remember(index, item)
+        else:
+            self._memory.move_to_end(index)
+
+        self.hits += 1
+        return list(item[0]), list(item[1])
+
+    def put(self, index: int, source_token_ids: List[int], target_token_ids: List[int]):
+        self._get_connection().execute(
+            "INSERT OR IGNORE INTO tokens (namespace, idx, source, target) VALUES (?, ?, ?, ?)",
+            (self.namespace, index, _to_blob(source_token_ids), _to_blob(target_token_ids))
+        )
+        self._remember(index, (tuple(source_token_ids), tuple(target_token_ids)))
+
+    def _remember(self, index: int, item: Tuple):
+        if self.max_memory_items <= 0:
+            return
+        self._memory[index] = item
+        self._memory.move_to_end(index)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        "Remove the entries of this namespace"
+        self._get_connection().execute("DELETE FROM tokens WHERE namespace = ?", (self.namespace, ))
+        self._memory.clear()
@@ -0,0 +1,248 @@
+"""
+Pre-tokenized seq2seq corpus stored as flat memory-mapped arrays
+
+Files written by `pretokenize_seq2seq` for a prefix:
+    prefix.json            metadata
+    prefix.tokens.bin      token ids of all examples, source followed by target
+    prefix.index.npy       int64 (num_examples, 3): token offset, source length, target length
+    prefix.text.bin        utf-8 source and target texts (optional)
+    prefix.text_index.npy  int64 (num_examples, 3): byte offset, source length, target length (optional)
+
+Example:
+    python -m torchfly.text.datasets.tokenized_corpus train.jsonl data/train --tokenizer roberta-base
+"""
+import os
+import json
+import array
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torch.nn.utils.rnn import pad_sequence
+from typing import Any, Dict
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pylint: disable=no-member
+
+FORMAT_VERSION = 1
+
+
+def _paths(prefix: str) -> Dict[str, str]:
+    return {
+        "meta": prefix + ".json",
+        "tokens": prefix + ".tokens.bin",
+        "index": prefix + ".index.npy",
+        "text": prefix + ".text.bin",
+        "text_index": prefix + ".text_index.npy",
+    }
+
+
+def pretokenize_seq2seq(
+    filename: str,
+    tokenizer,
+    output_prefix: str,
+    add_bos_token: bool = True,
+    add_eos_token: bool = True,
+    store_text: bool = True,
+    dtype: str = "int32"
+) -> Dict[str, Any]:
+    """
+    Tokenize a JSONL file with "source" and "target" fields once, streaming it line by line.
+    The files only appear under their final names when everything is written.
+    Returns:
+        metadata
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.dtype(np.int16), np.dtype(np.int32), np.dtype(np.int64)):
+        # torch cannot view unsigned integers other than uint8
+        raise ValueError(f"Unsupported dtype {dtype}")
+    paths = _paths(output_prefix)
+    os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+
+    # flat arrays, so that the index of a large corpus does not become millions of python objects
+    index = array.array("q")
+    text_index = array.array("q")
+    num_tokens = 0
+    num_text_bytes = 0
+    max_token_id = 0
+
+    text_file = open(paths["text"] + ".tmp", "wb") if store_text else None
+    try:
+        with open(filename, "r") as f, open(paths["tokens"] + ".tmp", "wb") as token_file:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                source_token_ids = tokenizer.encode(item["source"], add_special_tokens=False)
+                target_token_ids = tokenizer.encode(item["target"], add_special_tokens=False)
+
+                if add_bos_token:
+                    target_token_ids.insert(0, tokenizer.bos_token_id)
+
+                if add_eos_token:
+                    target_token_ids.append(tokenizer.eos_token_id)
+
+                token_ids = source_token_ids + target_token_ids
+                if len(token_ids) > 0:
+                    max_token_id = max(max_token_id, max(token_ids))
+                np.asarray(token_ids, dtype=dtype).tofile(token_file)
+                index.extend([num_tokens, len(source_token_ids), len(target_token_ids)])
+                num_tokens += len(token_ids)
+
+                if text_file is not None:
+                    source_bytes = item["source"].encode("utf-8")
+                    target_bytes = item["target"].encode("utf-8")
+                    text_file.write(source_bytes)
+                    text_file.write(target_bytes)
+                    text_index.extend([num_text_bytes, len(source_bytes), len(target_bytes)])
+                    num_text_bytes += len(source_bytes) + len(target_bytes)
+    finally:
+        if text_file is not None:
+            text_file.close()
+
+    if max_token_id > np.iinfo(dtype).max:
+        raise ValueError(f"Token id {max_token_id} does not fit in {dtype}")
+
+    np.save(paths["index"] + ".tmp.npy", np.frombuffer(index, dtype=np.int64).reshape(-1, 3))
+    if store_text:
+        np.save(paths["text_index"] + ".tmp.npy", np.frombuffer(text_index, dtype=np.int64).reshape(-1, 3))
+
+    metadata = {
+        "version": FORMAT_VERSION,
+        "dtype": dtype.name,
+        "num_examples": len(index) // 3,
+        "num_tokens": num_tokens,
+        "store_text": store_text,
+        "add_bos_token": add_bos_token,
+        "add_eos_token": add_eos_token,
+        "pad_token_id": tokenizer.pad_token_id,
+        "source_file": os.path.abspath(filename),
+    }
+
+    os.replace(paths["tokens"] + ".tmp", paths["tokens"])
+    os.replace(paths["index"] + ".tmp.npy", paths["index"])
+    if store_text:
+        os.replace(paths["text"] + ".tmp", paths["text"])
+        os.replace(paths["text_index"] + ".tmp.npy", paths["text_index"])
+    # the metadata marks the corpus as complete
+    with open(paths["meta"] + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(paths["meta"] + ".tmp", paths["meta"])
+
+    logger.info(f"Wrote {metadata['num_examples']} examples and {num_tokens} tokens to {output_prefix}")
+    return metadata
+
+
+class TokenizedSeq2SeqDataset(Dataset):
+    """
+    Serves the examples written by `pretokenize_seq2seq` as tensor views of memory-mapped files.
+    Nothing is read until an example is accessed, and DataLoader workers share the pages through
+    the page cache. Token ids keep the stored dtype until `collate_fn`.
+    """
+    def __init__(self, prefix: str, pad_token_id: int = None):
+        self.prefix = prefix
+        self.paths = _paths(prefix)
+
+        with open(self.paths["meta"], "r") as f:
+            self.metadata = json.load(f)
+        if self.metadata["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unknown corpus version {self.metadata['version']}")
+
+        self.pad_token_id = pad_token_id if pad_token_id is not None else self.metadata["pad_token_id"]
+        self.store_text = self.metadata["store_text"]
+        self._tokens = None
+        self._index = None
+        self._text = None
+        self._text_index = None
+
+    def _open(self):
+        # copy-on-write, so tensors are writable views while the files are never modified
+        if self.metadata["num_tokens"] > 0:
+            self._tokens = np.memmap(self.paths["tokens"], dtype=np.dtype(self.metadata["dtype"]), mode="c")
+        else:
+            self._tokens = np.zeros(0, dtype=np.dtype(self.metadata["dtype"]))
+        self._index = np.load(self.paths["index"], mmap_mode="r")
+        if self.store_text:
+            self._text = np.memmap(self.paths["text"], dtype=np.uint8, mode="r") \
+                if os.path.getsize(self.paths["text"]) > 0 else np.zeros(0, dtype=np.uint8)
+            self._text_index = np.load(self.paths["text_index"], mmap_mode="r")
+
+    def __getstate__(self):
+        # memory maps are reopened in each worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_index"] = None
+        state["_text"] = None
+        state["_text_index"] = None
+        return state
+
+    def __getitem__(self, index):
+        if self._tokens is None:
+            self._open()
+
+        offset, source_length, target_length = (int(value) for value in self._index[index])
+        source_end = offset + source_length
+
+        returned_item = {}
+        returned_item["source_token_ids"] = torch.from_numpy(self._tokens[offset:source_end])
+        returned_item["target_token_ids"] = torch.from_numpy(self._tokens[source_end:source_end + target_length])
+
+        if self.store_text:
+            text_offset, source_text_length, target_text_length = (int(value) for value in self._text_index[index])
+            text_end = text_offset + source_text_length
+            returned_item["source_text"] = self._text[text_offset:text_end].tobytes().decode("utf-8")
+            returned_item["target_text"] = self._text[text_end:text_end + target_text_length].tobytes().decode("utf-8")
+        return returned_item
+
+    def __len__(self):
+        return self.metadata["num_examples"]
+
+    def get_lengths(self) -> np.ndarray:
+        "Source and target lengths of all examples, with shape (num_examples, 2)"
+        if self._index is None:
+            self._open()
+        return np.asarray(self._index[:, 1:])
+
+    def collate_fn(self, batch):
+        new_batch = {}
+        if self.store_text:
+            new_batch["source_text"] = [item["source_text"] for item in batch]
+            new_batch["target_text"] = [item["target_text"] for item in batch]
+        new_batch["source_token_ids"] = pad_sequence(
+            [item["source_token_ids"] for item in batch], batch_first=True, padding_value=self.pad_token_id
+        ).long()
+        new_batch["target_token_ids"] = pad_sequence(
+            [item["target_token_ids"] for item in batch], batch_first=True, padding_value=self.pad_token_id
+        ).long()
+        return new_batch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-tokenize a seq2seq JSONL file")
+    parser.add_argument("input", type=str, help="JSONL file with `source` and `target` fields")
+    parser.add_argument("output_prefix", type=str)
+    parser.add_argument("--tokenizer", type=str, required=True, help="name or path for `AutoTokenizer`")
+    parser.add_argument("--no-bos", action="store_true")
+    parser.add_argument("--no-eos", action="store_true")
+    parser.add_argument("--no-text", action="store_true", help="do not store the raw texts")
+    parser.add_argument("--dtype", type=str, default="int32")
+    args = parser.parse_args(argv)
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    pretokenize_seq2seq(
+        args.input,
+        tokenizer,
+        args.output_prefix,
+        add_bos_token=not args.no_bos,
+        add_eos_token=not args.no_eos,
+        store_text=not args.no_text,
+        dtype=args.dtype
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,4 @@
-from .nucleus_sampling import top_k_top_p_filtering
-from .transformer_decoder import TransformerDecoder
\ No newline at end of file
+from .nucleus_sampling import top_k_top_p_filtering, fast_top_k_top_p_filtering
+from .transformer_decoder import TransformerDecoder
+from .continuous_batching import ContinuousBatchingEngine
+from .prefix_cache import PrefixKVCache
@@ -1,6 +1,9 @@
 from typing import List
+import torch
 import logging
 
+# pylint:disable=no-member
+
 
 class BeamHypotheses:
     def __init__(self, num_beams, max_steps, length_penalty, early_stopping=True):
@@ -49,4 +52,81 @@ class BeamHypotheses:
                 cur_len = self.max_steps
             cur_score = best_sum_logprobs / cur_len**self.length_penalty
             ret = self.worst_score >= cur_score
-            return ret
\ No newline at end of file
+            return ret
+
+class TensorBeamHypotheses:
+    def __init__(
+        self,
+        batch_size: int,
+        num_beams: int,
+        max_steps: int,
+        length_penalty: float,
+        early_stopping: bool = True,
+        output_log_probs: bool = False,
+        device: torch.device = None
+    ):
+        """
+        Initialize n-best lists of hypotheses for the whole batch.
+        Hypotheses are kept in fixed-size tensors sorted by score, so adding finished beams
+        is a single topk over the old and the new candidates.
+        """
+        self.max_steps = max_steps - 1  # ignoring bos_token
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.num_beams = num_beams
+
+        # empty slots have -inf scores
+        self.scores = torch.full((batch_size, num_beams), float("-inf"), device=device)
+        self.tokens = torch.full((batch_size, num_beams, max_steps), -1, dtype=torch.long, device=device)
+        self.log_probs = torch.zeros((batch_size, num_beams, max_steps), device=device) if output_log_probs else None
+        self.num_hyps = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def add(
+        self,
+        is_finished: torch.BoolTensor,
+        sum_logprobs: torch.Tensor,
+        cur_len: int,
+        token_sequences: torch.Tensor,
+        log_prob_sequences: torch.Tensor = None
+    ):
+        """
+        Add the finished beams to the lists.
+        Args:
+            is_finished: (batch_size, num_candidates) which candidates to add
+            sum_logprobs: (batch_size, num_candidates) cumulative log probs of the candidates
+            cur_len: length of the candidates used by the length penalty
+            token_sequences: (batch_size, num_candidates, max_steps)
+            log_prob_sequences: (batch_size, num_candidates, max_steps)
+        """
+        scores = sum_logprobs / cur_len**self.length_penalty
+        scores = scores.masked_fill(~is_finished, float("-inf"))
+
+        # shape: (batch_size, num_beams + num_candidates)
+        all_scores = torch.cat([self.scores, scores], dim=1)
+        self.scores, indices = torch.topk(all_scores, self.num_beams, dim=1, largest=True, sorted=True)
+
+        expanded_indices = indices.unsqueeze(2).expand(-1, -1, self.tokens.shape[2])
+        self.tokens = torch.gather(torch.cat([self.tokens, token_sequences], dim=1), 1, expanded_indices)
+        if self.log_probs is not None:
+            self.log_probs = torch.gather(torch.cat([self.log_probs, log_prob_sequences], dim=1), 1, expanded_indices)
+
+        self.num_hyps = (self.num_hyps + is_finished.sum(1)).clamp_(max=self.num_beams)
+
+    def is_done(self, best_sum_logprobs: torch.Tensor, cur_len: int = None) -> torch.BoolTensor:
+        """
+        If there are enough hypotheses and that none of the hypotheses being generated
+        can become better than the worst one in the list, then we are done with this sentence.
+        Args:
+            best_sum_logprobs: (batch_size,) best cumulative log probs of the unfinished beams
+        Returns:
+            done: (batch_size,)
+        """
+        is_full = self.num_hyps >= self.num_beams
+        if self.early_stopping:
+            return is_full
+
+        if cur_len is None:
+            cur_len = self.max_steps
+        cur_score = best_sum_logprobs / cur_len**self.length_penalty
+        # the worst hypothesis is the last one
+        return is_full & (self.scores[:, -1] >= cur_score)
@@ -0,0 +1,328 @@
+"""
+Decoding benchmark for `TransformerDecoder`
+Models are built from `model_configs.py` with random weights, so no checkpoint is needed.
+
+Example:
+    python -m torchfly.text.decode.benchmark --models tiny-gpt2,gpt2-small --batch-sizes 1,8 --output results.json
+"""
+import argparse
+import json
+import resource
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+import numpy as np
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from torchfly.nn.transformers.model_configs import (
+    UnifiedGPT2SmallConfig, UnifiedGPT2DistillConfig, UnifiedRobertaBaseConfig
+)
+from torchfly.nn.transformers.gpt_model import GPT2SimpleLM
+from torchfly.nn.transformers.cached_bert_model import CachedBertDecoderLM
+from .transformer_decoder import TransformerDecoder
+
+# pylint:disable=no-member
+
+
+class TinyGPT2Config(UnifiedGPT2SmallConfig):
+    n_embd = 128
+    n_layer = 2
+    n_head = 4
+
+
+class TinyBertDecoderConfig(UnifiedRobertaBaseConfig):
+    hidden_size = 128
+    num_attention_heads = 4
+    num_hidden_layers = 2
+    intermediate_size = 512
+
+
+def _no_checkpointing(config):
+    "Gradient checkpointing is useless for inference"
+    return type(config.__name__, (config, ), {"gradient_checkpointing": False})
+
+
+# name: (model class, config, position offset)
+MODELS = {
+    "tiny-gpt2": (GPT2SimpleLM, _no_checkpointing(TinyGPT2Config), 0),
+    "gpt2-distill": (GPT2SimpleLM, _no_checkpointing(UnifiedGPT2DistillConfig), 0),
+    "gpt2-small": (GPT2SimpleLM, _no_checkpointing(UnifiedGPT2SmallConfig), 0),
+    "tiny-bert-decoder": (CachedBertDecoderLM, TinyBertDecoderConfig, TinyBertDecoderConfig.padding_idx + 1),
+    "roberta-base-decoder": (CachedBertDecoderLM, UnifiedRobertaBaseConfig, UnifiedRobertaBaseConfig.padding_idx + 1),
+}
+
+STRATEGIES = {
+    "greedy": {"do_sample": False},
+    "sampling": {"do_sample": True, "top_k": -1, "top_p": 1.0},
+    "top_k_top_p": {"do_sample": True, "top_k": 50, "top_p": 0.9},
+    "beam_search": {"do_sample": False, "num_beams": 4},
+}
+
+DEFAULT_DECODE_CONFIG = {
+    "max_steps": 32,
+    "do_sample": False,
+    "num_beams": 1,
+    "early_stopping": True,
+    "temperature": 1.0,
+    "top_k": -1,
+    "top_p": 1.0,
+    "repetition_penalty": 1.0,
+    "length_penalty": 1.0,
+    "num_return_sequences": 1,
+    "bos_token_ids": None,
+    # never stops early, so every run generates `max_steps` tokens
+    "eos_token_ids": [-1],
+    "output_log_probs": False,
+    "use_static_cache": False,
+}
+
+
+class BenchmarkDecoder(TransformerDecoder):
+    def __init__(self, config, position_offset: int = 0):
+        super().__init__(config)
+        self.position_offset = position_offset
+
+    def prepare_model_inputs_for_generation(self, input_ids=None, model_inputs=None, num_return_sequences=1):
+        position_ids = torch.arange(input_ids.shape[1], device=input_ids.device) + self.position_offset
+        return {
+            "input_ids": input_ids,
+            "past": None,
+            "position_ids": position_ids.unsqueeze(0).expand_as(input_ids),
+        }
+
+
+class StepTimer:
+    "Wraps a generator and records when each forward pass starts"
+
+    def __init__(self, model: nn.Module, device: torch.device):
+        self.model = model
+        self.device = device
+        self.timestamps = []
+
+    def __call__(self, **kwargs):
+        synchronize(self.device)
+        self.timestamps.append(time.perf_counter())
+        return self.model(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def get_rss_mb() -> float:
+    "Current resident set size of the process, or its high-water mark where /proc is not available"
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * resource.getpagesize() / 2**20
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+class PeakMemory:
+    """
+    Measures the memory used by the runs inside the context.
+    On CUDA, it is the peak allocated memory. On CPU, the high-water mark of the process is never reset,
+    so a thread samples the resident set size instead and the peak increase over the start is reported.
+    """
+    def __init__(self, device: torch.device, interval: float = 0.005):
+        self.device = device
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._start_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self.peak_mb = max(self.peak_mb, get_rss_mb() - self._start_mb)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self._start_mb = get_rss_mb()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == "cuda":
+            self.peak_mb = torch.cuda.max_memory_allocated(self.device) / 2**20
+        else:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+
+def build_model(name: str, device: torch.device):
+    model_class, config, position_offset = MODELS[name]
+    model = model_class(config).to(device)
+    model.eval()
+    return model, config, position_offset
+
+
+def count_tokens(results: Dict[str, Any]) -> int:
+    # only the best sequence of each prompt is counted
+    return sum(len(batch_tokens[0]) for batch_tokens in results["tokens"])
+
+
+def benchmark_one(
+    decoder: BenchmarkDecoder,
+    timer: StepTimer,
+    vocab_size: int,
+    batch_size: int,
+    prompt_length: int,
+    repeats: int,
+    warmup: int,
+    device: torch.device,
+    decode_options: Dict[str, Any],
+) -> Dict[str, Any]:
+    step_latencies = []
+    run_times = []
+    num_tokens = 0
+
+    with PeakMemory(device) as peak_memory:
+        for run_idx in range(warmup + repeats):
+            input_ids = torch.randint(0, vocab_size, (batch_size, prompt_length), device=device)
+            timer.timestamps = []
+
+            synchronize(device)
+            start_time = time.perf_counter()
+            results = decoder.generate(input_ids=input_ids, **decode_options)
+            synchronize(device)
+            end_time = time.perf_counter()
+
+            if run_idx < warmup:
+                continue
+
+            run_times.append(end_time - start_time)
+            num_tokens += count_tokens(results)
+            # the first forward pass is the prompt, the rest are decoding steps
+            timestamps = timer.timestamps + [end_time]
+            step_latencies.extend(np.diff(timestamps[1:]).tolist())
+
+    step_latencies = np.array(step_latencies) * 1000.0
+    return {
+        "batch_size": batch_size,
+        "prompt_length": prompt_length,
+        "tokens_per_sec": num_tokens / sum(run_times),
+        "mean_run_time_sec": float(np.mean(run_times)),
+        "step_latency_ms": {
+            "mean": float(np.mean(step_latencies)) if len(step_latencies) else None,
+            "p50": float(np.percentile(step_latencies, 50)) if len(step_latencies) else None,
+            "p90": float(np.percentile(step_latencies, 90)) if len(step_latencies) else None,
+            "p99": float(np.percentile(step_latencies, 99)) if len(step_latencies) else None,
+        },
+        # on CPU, the peak increase of the resident set size during the runs
+        "peak_memory_mb": peak_memory.peak_mb,
+    }
+
+
+def run_benchmark(
+    models: List[str],
+    strategies: List[str],
+    batch_sizes: List[int],
+    prompt_lengths: List[int],
+    max_steps: int = 32,
+    repeats: int = 3,
+    warmup: int = 1,
+    device: str = "cpu",
+    use_static_cache: bool = False,
+    seed: int = 123,
+) -> List[Dict[str, Any]]:
+    device = torch.device(device)
+    records = []
+
+    for model_name in models:
+        torch.manual_seed(seed)
+        model, config, position_offset = build_model(model_name, device)
+
+        decode_config = dict(DEFAULT_DECODE_CONFIG, max_steps=max_steps)
+        # the static cache reads a GPT-2 style config
+        decode_config["use_static_cache"] = use_static_cache and hasattr(config, "n_layer")
+        decoder = BenchmarkDecoder(OmegaConf.create(decode_config), position_offset=position_offset)
+        timer = StepTimer(model, device)
+        decoder.register_generator(timer)
+
+        for strategy in strategies:
+            for batch_size in batch_sizes:
+                for prompt_length in prompt_lengths:
+                    record = benchmark_one(
+                        decoder, timer, config.vocab_size, batch_size, prompt_length, repeats, warmup, device,
+                        STRATEGIES[strategy]
+                    )
+                    record.update({"model": model_name, "strategy": strategy, "max_steps": max_steps})
+                    records.append(record)
+
+        del decoder, timer, model
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+    return records
+
+
+def _parse_list(value: str, type_fn=str) -> List:
+    return [type_fn(item) for item in value.split(",") if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark TransformerDecoder decoding strategies")
+    parser.add_argument("--models", type=str, default="tiny-gpt2,tiny-bert-decoder", help=",".join(MODELS))
+    parser.add_argument("--strategies", type=str, default=",".join(STRATEGIES), help=",".join(STRATEGIES))
+    parser.add_argument("--batch-sizes", type=str, default="1,8")
+    parser.add_argument("--prompt-lengths", type=str, default="16,128")
+    parser.add_argument("--max-steps", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--static-cache", action="store_true")
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--output", type=str, default=None, help="write the JSON results to a file")
+    args = parser.parse_args(argv)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    records = run_benchmark(
+        models=_parse_list(args.models),
+        strategies=_parse_list(args.strategies),
+        batch_sizes=_parse_list(args.batch_sizes, int),
+        prompt_lengths=_parse_list(args.prompt_lengths, int),
+        max_steps=args.max_steps,
+        repeats=args.repeats,
+        warmup=args.warmup,
+        device=args.device,
+        use_static_cache=args.static_cache,
+        seed=args.seed,
+    )
+
+    output = {
+        "torch_version": torch.__version__,
+        "device": args.device,
+        "num_threads": torch.get_num_threads(),
+        "results": records,
+    }
+    output = json.dumps(output, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Union
+import torch
+
+from .transformer_decoder import TransformerDecoder
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pylint:disable=no-member
+
+
+class GenerationRequest:
+    "A prompt waiting for or being processed by `ContinuousBatchingEngine`"
+
+    def __init__(self, input_ids: torch.Tensor, max_steps: int):
+        self.input_ids = input_ids
+        self.max_steps = max_steps
+        self.future = Future()
+        self.tokens = []
+        self.log_probs = []
+
+
+class ContinuousBatchingEngine:
+    """
+    In-flight batching around `TransformerDecoder`.
+    A background thread keeps a single running batch. After every decoding step, finished sequences
+    are removed with `filter_finished_model_inputs`, and waiting requests are prefilled and merged
+    into the freed slots with `concat_model_inputs`. Only sampling and greedy decoding are supported.
+
+    Example:
+        engine = ContinuousBatchingEngine(decoder, max_batch_size=32)
+        engine.start()
+        future = engine.submit(input_ids)
+        results = future.result()
+        engine.stop()
+    """
+    def __init__(self, decoder: TransformerDecoder, max_batch_size: int = 32):
+        if decoder.num_beams > 1:
+            raise ValueError("ContinuousBatchingEngine does not support beam search")
+        if decoder.use_static_cache:
+            raise ValueError("ContinuousBatchingEngine does not support the static key/value cache")
+
+        self.decoder = decoder
+        self.max_batch_size = max_batch_size
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._running = False
+
+        # the running batch
+        self._model_inputs = None
+        self._requests: List[GenerationRequest] = []
+        self._generated_token_sequences = None
+        self._timestep = 0
+
+    @property
+    def num_active(self) -> int:
+        return len(self._requests)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._reset_decoder_config()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ContinuousBatchingEngine", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        "Stop the background thread. Unfinished requests are cancelled"
+        if self._thread is None:
+            return
+        self._running = False
+        # wake up the thread if it is waiting for requests
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+        self._fail_all(RuntimeError("ContinuousBatchingEngine is stopped"))
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.future.cancel()
+
+    def submit(self, input_ids: Union[torch.Tensor, List[int]], max_steps: int = None) -> Future:
+        """
+        Args:
+            input_ids: 1-D prompt token ids
+            max_steps: number of tokens to generate at most, cannot exceed the decoder's `max_steps`
+        Returns:
+            a future of dict with "tokens" and optionally "log_probs"
+        """
+        if not isinstance(input_ids, torch.Tensor):
+            input_ids = torch.LongTensor(input_ids)
+        assert input_ids.dim() == 1
+
+        max_steps = min(max_steps, self.decoder.max_steps) if max_steps is not None else self.decoder.max_steps
+        request = GenerationRequest(input_ids, max_steps)
+        self._queue.put(request)
+        return request.future
+
+    def _reset_decoder_config(self):
+        # same as `TransformerDecoder.generate` without temporary configs
+        for key, value in self.decoder.decode_config.items():
+            setattr(self.decoder, key, value)
+        self._eos_token_ids = list(self.decoder.eos_token_ids)
+        self._device = next(self.decoder._generator.parameters()).device
+
+    def _run(self):
+        with torch.no_grad():
+            while self._running:
+                try:
+                    self._admit_requests()
+                    if self.num_active > 0:
+                        self._step()
+                except Exception as e:
+                    logger.exception("ContinuousBatchingEngine failed at step %d", self._timestep)
+                    self._fail_all(e)
+
+    def _admit_requests(self):
+        "Prefill waiting requests and merge them into the running batch"
+        while self._running and self.num_active < self.max_batch_size:
+            try:
+                # block only when there is nothing to decode
+                request = self._queue.get(block=self.num_active == 0, timeout=0.1)
+            except queue.Empty:
+                break
+
+            if request is None:
+                break
+            if not request.future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                self._admit(request)
+            except Exception as e:
+                # only this request fails, the running batch is not modified until the merge succeeds
+                logger.exception("ContinuousBatchingEngine failed to admit a request")
+                request.future.set_exception(e)
+
+    def _admit(self, request: GenerationRequest):
+        model_inputs, predicted_tokens, raw_log_probs = self._prefill(request)
+        self._record(request, predicted_tokens.item(), raw_log_probs)
+
+        if self._is_finished(request):
+            self._resolve(request)
+            return
+
+        generated_token_sequence = torch.full((1, self.decoder.max_steps), -1, dtype=torch.long)
+        generated_token_sequence[0, :len(request.tokens)] = torch.LongTensor(request.tokens)
+
+        if self._model_inputs is None:
+            merged_model_inputs = model_inputs
+            generated_token_sequences = generated_token_sequence
+        else:
+            merged_model_inputs = self.decoder.concat_model_inputs([self._model_inputs, model_inputs])
+            generated_token_sequences = torch.cat([self._generated_token_sequences, generated_token_sequence], dim=0)
+
+        self._model_inputs = merged_model_inputs
+        self._generated_token_sequences = generated_token_sequences
+        self._requests.append(request)
+
+    def _prefill(self, request: GenerationRequest):
+        input_ids = request.input_ids.to(self._device).unsqueeze(0)
+        model_inputs = self.decoder.prepare_model_inputs_for_generation(input_ids, None, 1)
+
+        # rows of different lengths are left padded when merged
+        mask_key = self.decoder.mask_key
+        if mask_key not in model_inputs:
+            model_inputs[mask_key] = torch.ones(input_ids.shape, dtype=torch.bool, device=self._device)
+        if "position_ids" not in model_inputs:
+            model_inputs["position_ids"] = torch.arange(input_ids.shape[1], device=self._device).unsqueeze(0)
+
+        generated_token_sequences = torch.full((1, self.decoder.max_steps), -1, dtype=torch.long)
+        logits, raw_log_probs = self.decoder.compute_logits(
+            timestep=0, model_inputs=model_inputs, generated_token_sequences=generated_token_sequences
+        )
+        predicted_tokens = self.decoder.sample_next_token(
+            timestep=0,
+            logits=logits,
+            model_inputs=model_inputs,
+            generated_token_sequences=generated_token_sequences
+        )
+        # only the position of the next token is needed from now on
+        model_inputs["position_ids"] = model_inputs["position_ids"][:, -1:]
+
+        if raw_log_probs is not None:
+            raw_log_probs = raw_log_probs.gather(-1, predicted_tokens).item()
+        return model_inputs, predicted_tokens, raw_log_probs
+
+    def _step(self):
+        self._timestep += 1
+        logits, raw_log_probs = self.decoder.compute_logits(
+            timestep=self._timestep,
+            model_inputs=self._model_inputs,
+            generated_token_sequences=self._generated_token_sequences,
+        )
+        predicted_tokens = self.decoder.sample_next_token(
+            timestep=self._timestep,
+            logits=logits,
+            model_inputs=self._model_inputs,
+            generated_token_sequences=self._generated_token_sequences,
+        )
+
+        # one transfer per step
+        tokens = predicted_tokens.squeeze(1).tolist()
+        if raw_log_probs is not None:
+            raw_log_probs = raw_log_probs.gather(-1, predicted_tokens).squeeze(1).tolist()
+
+        keeped_indices = []
+        for row_idx, request in enumerate(self._requests):
+            self._record(request, tokens[row_idx], raw_log_probs[row_idx] if raw_log_probs is not None else None)
+            self._generated_token_sequences[row_idx, len(request.tokens) - 1] = tokens[row_idx]
+
+            if self._is_finished(request):
+                self._resolve(request)
+            else:
+                keeped_indices.append(row_idx)
+
+        if len(keeped_indices) == 0:
+            self._clear()
+        elif len(keeped_indices) < len(self._requests):
+            self._requests = [self._requests[idx] for idx in keeped_indices]
+            keeped_indices = torch.LongTensor(keeped_indices)
+            self._generated_token_sequences = self._generated_token_sequences[keeped_indices]
+            self._model_inputs = self.decoder.filter_finished_model_inputs(self._model_inputs, keeped_indices)
+            self._trim_padding()
+
+    def _trim_padding(self):
+        "Drop the left columns which are padding for every remaining row"
+        mask_key = self.decoder.mask_key
+        mask = self._model_inputs[mask_key].bool()
+        num_padding = mask.any(0).nonzero()[0].item()
+        if num_padding > 0:
+            self._model_inputs[mask_key] = self._model_inputs[mask_key][:, num_padding:]
+            self._model_inputs["past"] = [item[:, :, :, num_padding:] for item in self._model_inputs["past"]]
+
+    def _record(self, request: GenerationRequest, token: int, log_prob: float = None):
+        request.tokens.append(token)
+        if log_prob is not None:
+            request.log_probs.append(log_prob)
+
+    def _is_finished(self, request: GenerationRequest) -> bool:
+        eos_token_len = len(self._eos_token_ids)
+        return len(request.tokens) >= request.max_steps or request.tokens[-eos_token_len:] == self._eos_token_ids
+
+    def _resolve(self, request: GenerationRequest):
+        results = {"tokens": torch.LongTensor(request.tokens)}
+        if self.decoder.output_log_probs:
+            results["log_probs"] = torch.FloatTensor(request.log_probs)
+        request.future.set_result(results)
+
+    def _fail_all(self, exception: Exception):
+        for request in self._requests:
+            if not request.future.done():
+                request.future.set_exception(exception)
+        self._clear()
+
+    def _clear(self):
+        self._model_inputs = None
+        self._requests = []
+        self._generated_token_sequences = None
@@ -71,4 +71,116 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=1.0, filter_value=-1e4, min_tok
         # scatter sorted tensors to original indexing
         indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
         logits[indices_to_remove] = filter_value
-    return logits
\ No newline at end of file
+    return logits
+
+def fast_top_k_top_p_filtering(
+    logits,
+    top_k=0,
+    top_p=1.0,
+    filter_value=-1e4,
+    min_tokens_to_keep=1,
+    is_log_probs=False,
+    num_candidates=256,
+    exact_fallback=False
+):
+    """ Same as `top_k_top_p_filtering`, but only sorts a bounded candidate set instead of the whole vocabulary
+        Args:
+            logits: logits distribution shape (batch size, vocabulary size), which is filtered in place
+            top_k: int or LongTensor of shape (batch size, ), top_k <= 0 means no top-k filtering for the row
+            top_p: float or FloatTensor of shape (batch size, ), top_p >= 1.0 means no nucleus filtering for the row
+            num_candidates: number of candidates for nucleus filtering when the row has no top-k.
+                Rows whose candidates do not reach `top_p` keep all of the candidates
+            exact_fallback: sort the whole vocabulary for those rows instead, which reads the rows on the host
+        Python scalars `top_k` and `top_p` never synchronize with the device.
+        Per-row tensors are read on the host once.
+    """
+    batch_size, vocab_size = logits.shape
+    device = logits.device
+
+    if isinstance(top_k, torch.Tensor) or isinstance(top_p, torch.Tensor):
+        if not isinstance(top_k, torch.Tensor):
+            top_k = torch.full((batch_size, ), int(top_k), dtype=torch.long, device=device)
+        if not isinstance(top_p, torch.Tensor):
+            top_p = torch.full((batch_size, ), float(top_p), dtype=logits.dtype, device=device)
+        top_k = top_k.to(device)
+        top_p = top_p.to(device=device, dtype=logits.dtype)
+
+        use_top_k = top_k > 0
+        use_top_p = top_p < 1.0
+        # the per-row settings are only read once
+        max_top_k, any_top_k, any_top_p, any_top_p_only = torch.stack(
+            [top_k.max(), use_top_k.any().long(), use_top_p.any().long(), (use_top_p & ~use_top_k).any().long()]
+        ).tolist()
+    else:
+        any_top_k = top_k > 0
+        any_top_p = top_p < 1.0
+        any_top_p_only = any_top_p and not any_top_k
+        max_top_k = int(top_k)
+        top_k = torch.full((batch_size, ), int(top_k), dtype=torch.long, device=device)
+        top_p = torch.full((batch_size, ), float(top_p), dtype=logits.dtype, device=device)
+        use_top_k = torch.full((batch_size, ), any_top_k, dtype=torch.bool, device=device)
+        use_top_p = torch.full((batch_size, ), any_top_p, dtype=torch.bool, device=device)
+
+    if not any_top_k and not any_top_p:
+        return logits
+
+    top_k = torch.where(use_top_k, top_k.clamp(min=min_tokens_to_keep, max=vocab_size), torch.full_like(top_k, vocab_size))
+    num_candidates = max(max_top_k, num_candidates) if any_top_p_only else max_top_k
+    num_candidates = min(max(num_candidates, min_tokens_to_keep), vocab_size)
+
+    # shape: (batch_size, num_candidates), sorted
+    candidate_logits, _ = torch.topk(logits, num_candidates, dim=-1)
+    positions = torch.arange(num_candidates, device=device).unsqueeze(0)
+    in_top_k = positions < top_k.unsqueeze(1)
+
+    # number of tokens kept in each row
+    num_keep = top_k.clamp(max=num_candidates)
+
+    if any_top_p:
+        # probabilities are normalized over the top-k tokens, or the whole vocabulary without top-k
+        if is_log_probs:
+            candidate_probs = torch.exp(candidate_logits)
+        else:
+            full_normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+            top_k_normalizer = torch.logsumexp(candidate_logits.masked_fill(~in_top_k, -float("inf")), dim=-1, keepdim=True)
+            normalizer = torch.where(use_top_k.unsqueeze(1), top_k_normalizer, full_normalizer)
+            candidate_probs = torch.exp(candidate_logits - normalizer)
+        candidate_probs.masked_fill_(~in_top_k, 0.0)
+        cumulative_probs = torch.cumsum(candidate_probs, dim=-1)
+
+        # keep tokens until the cumulative probability reaches top_p, including the first one above it.
+        # As in `top_k_top_p_filtering`, `min_tokens_to_keep > 1` is also shifted by the first one above it
+        num_below = (cumulative_probs <= top_p.unsqueeze(1)).sum(-1)
+        min_nucleus = min_tokens_to_keep + 1 if min_tokens_to_keep > 1 else 1
+        num_nucleus = (num_below + 1).clamp(min=min_nucleus, max=num_candidates)
+        num_keep = torch.where(use_top_p, torch.min(num_keep, num_nucleus), num_keep)
+
+        # rows whose candidates are not enough to cover top_p keep all of them, unless they are sorted again
+        if exact_fallback and any_top_p_only and num_candidates < vocab_size:
+            needs_full_sort = use_top_p & ~use_top_k & (cumulative_probs[:, -1] < top_p)
+        else:
+            needs_full_sort = None
+    else:
+        needs_full_sort = None
+
+    # everything smaller than the last kept candidate is removed in place
+    threshold = candidate_logits.gather(1, (num_keep - 1).unsqueeze(1))
+    keep_all = (~use_top_k & ~use_top_p) | (num_keep >= vocab_size)
+    threshold.masked_fill_(keep_all.unsqueeze(1), -float("inf"))
+
+    if needs_full_sort is not None and needs_full_sort.any():
+        fallback_indices = needs_full_sort.nonzero().squeeze(1)
+        for row_idx in fallback_indices.tolist():
+            top_k_top_p_filtering(
+                logits[row_idx:row_idx + 1],
+                top_k=0,
+                top_p=top_p[row_idx].item(),
+                filter_value=filter_value,
+                min_tokens_to_keep=min_tokens_to_keep,
+                is_log_probs=is_log_probs
+            )
+        # rows which are already filtered
+        threshold[fallback_indices] = -float("inf")
+
+    logits.masked_fill_(logits < threshold, filter_value)
+    return logits
@@ -0,0 +1,149 @@
+import hashlib
+from collections import Counter, OrderedDict
+from typing import List, Tuple, Union
+import numpy as np
+import torch
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pylint:disable=no-member
+
+
+class PrefixCacheEntry:
+    def __init__(self, length: int, past: List[torch.Tensor]):
+        # past of a single prompt, each layer has the shape (2, num_heads, length, head_features)
+        self.length = length
+        self.past = past
+        self.num_bytes = sum(item.numel() * item.element_size() for item in past)
+
+
+class PrefixKVCache:
+    """
+    Caches the key/value `past` of prompts keyed by the hash of their token ids.
+    A lookup returns the longest cached prefix of a prompt. Entries are evicted in
+    least recently used order once the total size exceeds `max_bytes`.
+    It assumes that the `past` of a prefix only depends on its tokens, and must be cleared
+    whenever the generator's weights change.
+    """
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        # cached prefix lengths, used to avoid hashing every possible prefix
+        self._lengths = Counter()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _to_bytes(token_ids: Union[torch.Tensor, List[int]]) -> bytes:
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.cpu().numpy()
+        return np.asarray(token_ids, dtype=np.int64).tobytes()
+
+    def _hash(self, token_ids: Union[torch.Tensor, List[int]]) -> str:
+        return hashlib.blake2b(self._to_bytes(token_ids), digest_size=16).hexdigest()
+
+    def lookup(
+        self,
+        token_ids: Union[torch.Tensor, List[int]],
+        max_length: int = None,
+        record_stats: bool = True
+    ) -> Tuple[int, List[torch.Tensor]]:
+        """Find the longest cached prefix
+        Args:
+            token_ids: 1-D prompt token ids
+            max_length: the longest prefix allowed. Entries up to the whole prompt still match,
+                e.g. a repeated prompt, and only their first `max_length` positions are used
+            record_stats: count a hit or a miss, callers which look up a batch can use `record_lookup` instead
+        Returns:
+            length: 0 if nothing is cached
+            past: cached past which can be longer than `length` when only part of it is needed
+        """
+        token_bytes = self._to_bytes(token_ids)
+        num_tokens = len(token_bytes) // 8
+        max_length = num_tokens if max_length is None else min(max_length, num_tokens)
+
+        # hash incrementally over the sorted cached lengths
+        best_key, best_length = None, 0
+        hasher = hashlib.blake2b(digest_size=16)
+        hashed_length = 0
+        for length in sorted(self._lengths):
+            if length > num_tokens:
+                break
+            hasher.update(token_bytes[hashed_length * 8:length * 8])
+            hashed_length = length
+            key = hasher.copy().hexdigest()
+            if key in self._entries:
+                best_key, best_length = key, length
+
+        if best_key is None or max_length == 0:
+            if record_stats:
+                self.record_lookup(False)
+            return 0, None
+
+        if record_stats:
+            self.record_lookup(True)
+        self._entries.move_to_end(best_key)
+        return min(best_length, max_length), self._entries[best_key].past
+
+    def record_lookup(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def insert(self, token_ids: Union[torch.Tensor, List[int]], past: List[torch.Tensor]):
+        """
+        Args:
+            token_ids: 1-D prompt token ids
+            past: a list of tensors with shape (2, num_heads, seq_length, head_features),
+                where `seq_length` is at least the number of tokens
+        """
+        length = len(token_ids)
+        key = self._hash(token_ids)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        entry = PrefixCacheEntry(length, [item[:, :, :length].clone() for item in past])
+        if entry.num_bytes > self.max_bytes:
+            return
+
+        self._entries[key] = entry
+        self._lengths[length] += 1
+        self.num_bytes += entry.num_bytes
+
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._remove_length(evicted.length)
+            self.num_bytes -= evicted.num_bytes
+            self.evictions += 1
+
+    def _remove_length(self, length: int):
+        self._lengths[length] -= 1
+        if self._lengths[length] == 0:
+            del self._lengths[length]
+
+    def clear(self):
+        "Drop all entries, e.g. after the generator is updated"
+        self._entries.clear()
+        self._lengths.clear()
+        self.num_bytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+            "evictions": self.evictions,
+            "num_entries": len(self._entries),
+            "num_bytes": self.num_bytes,
+        }
@@ -1,11 +1,14 @@
 from typing import Any, List, Dict, Iterator, Callable, Set
+import inspect
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from . import top_k_top_p_filtering
-from .beam_hypotheses import BeamHypotheses
+from torchfly.nn.static_kv_cache import StaticKVCache
+from . import top_k_top_p_filtering, fast_top_k_top_p_filtering
+from .beam_hypotheses import BeamHypotheses, TensorBeamHypotheses
+from .prefix_cache import PrefixKVCache
 
 import logging
 
@@ -15,20 +18,47 @@ logger = logging.getLogger(__name__)
 
 
 def penalize_repetition(next_token_logits, sampled_token_sequences, repetition_penalty):
-    """repetition penalty from CTRL paper (https://arxiv.org/abs/1909.05858)"""
-    #TODO: Fix bug in this function
-    if repetition_penalty != 1.0:
-        for i in range(next_token_logits.shape[0]):
-            for previous_token in set(sampled_token_sequences[i]):
-                # if score < 0 then repetition penalty has to be multiplied to reduce the previous
-                # token probability
-                if next_token_logits[i, previous_token] < 0:
-                    next_token_logits[i, previous_token] *= repetition_penalty
-                else:
-                    next_token_logits[i, previous_token] /= repetition_penalty
+    """repetition penalty from CTRL paper (https://arxiv.org/abs/1909.05858)
+    Args:
+        next_token_logits: (batch_size, vocab_size)
+        sampled_token_sequences: (batch_size, ..., steps) token buffer where -1 means empty
+        repetition_penalty: 1.0 means no penalty
+    """
+    if repetition_penalty != 1.0 and sampled_token_sequences is not None:
+        vocab_size = next_token_logits.shape[-1]
+        # shape: (batch_size, steps)
+        sampled_token_sequences = sampled_token_sequences.reshape(next_token_logits.shape[0], -1)
+        sampled_token_sequences = sampled_token_sequences.to(next_token_logits.device)
+        # empty slots are sent to an extra column which is dropped afterwards
+        sampled_token_sequences = sampled_token_sequences.masked_fill(sampled_token_sequences < 0, vocab_size)
+
+        # shape: (batch_size, vocab_size)
+        is_generated = torch.zeros(
+            next_token_logits.shape[0], vocab_size + 1, dtype=torch.bool, device=next_token_logits.device
+        )
+        is_generated.scatter_(1, sampled_token_sequences, True)
+        is_generated = is_generated[:, :vocab_size]
+
+        # if score < 0 then repetition penalty has to be multiplied to reduce the previous
+        # token probability
+        penalized_logits = torch.where(
+            next_token_logits < 0, next_token_logits * repetition_penalty, next_token_logits / repetition_penalty
+        )
+        next_token_logits = torch.where(is_generated, penalized_logits, next_token_logits)
     return next_token_logits
 
 
+def infer_mask_key(model) -> str:
+    "The name of the attention mask argument of the model's forward, e.g. `mask` for GPT2SimpleLM"
+    try:
+        parameters = inspect.signature(model.forward).parameters
+    except (TypeError, ValueError):
+        return "attention_mask"
+    if "attention_mask" not in parameters and "mask" in parameters:
+        return "mask"
+    return "attention_mask"
+
+
 class TransformerDecoder:
     """
     Modularized Design for Transformer Autoregresive Decoding
@@ -55,16 +85,36 @@ class TransformerDecoder:
         decode_config.eos_token_ids = decode_config.eos_token_ids if decode_config.eos_token_ids is not None else [-1]
 
         decode_config.output_log_probs = decode_config.output_log_probs if decode_config.output_log_probs is not None else False
+        decode_config.use_static_cache = decode_config.use_static_cache if decode_config.use_static_cache is not None else False
+        decode_config.keep_buffers_on_device = decode_config.keep_buffers_on_device if decode_config.keep_buffers_on_device is not None else False
+        decode_config.sync_interval = decode_config.sync_interval if decode_config.sync_interval is not None else 8
+        decode_config.speculative_steps = decode_config.speculative_steps if decode_config.speculative_steps is not None else 4
+        # None: inferred from the arguments of the generator's forward
+        decode_config.mask_key = decode_config.mask_key if decode_config.mask_key is not None else None
+        # None: exact top-k/top-p filtering with a full sort, otherwise the number of candidates of
+        # `fast_top_k_top_p_filtering`, which caps the nucleus without synchronizing with the device
+        decode_config.top_p_num_candidates = decode_config.top_p_num_candidates if decode_config.top_p_num_candidates is not None else None
 
         for key, value in decode_config.items():
             setattr(self, key, value)
 
     def register_generator(self, model):
         self._generator = model
+        if self.decode_config.mask_key is None:
+            self.mask_key = infer_mask_key(model)
 
     def register_tokenizer(self, tokenizer):
         self._tokenizer = tokenizer
 
+    def register_draft_generator(self, model):
+        "A smaller model with the same vocabulary which proposes tokens for speculative decoding"
+        self._draft_generator = model
+        self.speculative_stats = {"num_iterations": 0, "num_proposed": 0, "num_accepted": 0, "num_generated": 0}
+
+    def register_prefix_cache(self, prefix_cache: PrefixKVCache):
+        "Reuse the `past` of repeated prompts across `generate` calls"
+        self._prefix_cache = prefix_cache
+
     def prepare_model_inputs_for_generation(
         self,
         input_ids: torch.Tensor = None,
@@ -97,6 +147,11 @@ class TransformerDecoder:
         logits, past = self._generator(**model_inputs)
         logits = logits[:, -1, :]
 
+        # the first forward pass covers the whole prompts
+        if getattr(self, "_pending_prefixes", None) is not None:
+            self.cache_prefixes(self._pending_prefixes, past)
+            self._pending_prefixes = None
+
         if self.output_log_probs:
             raw_log_probs = torch.log_softmax(logits, dim=-1)
         else:
@@ -114,6 +169,18 @@ class TransformerDecoder:
 
         return logits, raw_log_probs
 
+    def filter_logits(self, logits: torch.Tensor, min_tokens_to_keep: int = 1) -> torch.Tensor:
+        "Top-k/top-p filtering in place. Overrides this function when necessary"
+        if self.top_p_num_candidates is None:
+            return top_k_top_p_filtering(logits, top_k=self.top_k, top_p=self.top_p, min_tokens_to_keep=min_tokens_to_keep)
+        return fast_top_k_top_p_filtering(
+            logits,
+            top_k=self.top_k,
+            top_p=self.top_p,
+            min_tokens_to_keep=min_tokens_to_keep,
+            num_candidates=self.top_p_num_candidates
+        )
+
     def sample_next_token(
         self,
         timestep: int,
@@ -124,7 +191,7 @@ class TransformerDecoder:
     ) -> Dict[str, torch.Tensor]:
         # Sample the next token
         if self.do_sample:
-            logits = top_k_top_p_filtering(logits, top_k=self.top_k, top_p=self.top_p, min_tokens_to_keep=2)
+            logits = self.filter_logits(logits, min_tokens_to_keep=2)
             # Sample
             # TODO: Test numpy.random.multinomial
             probs = torch.softmax(logits, -1)
@@ -168,6 +235,17 @@ class TransformerDecoder:
                 Exponential penalty to the length. Default to 1.
             num_return_sequences: (`optional`) int
                 The number of independently computed returned sequences for each element in the batch. Default to 1.
+            use_static_cache: (`optional`) bool
+                Preallocate the key/value cache for `max_steps` and update it in place. Default to False.
+            keep_buffers_on_device: (`optional`) bool
+                Keep the generated tokens, log probs and finished flags on the model's device,
+                and only copy them to CPU once generation ends. Default to False.
+            sync_interval: (`optional`) int
+                With `keep_buffers_on_device`, how many steps to run between checks for finished sequences.
+                Finished sequences keep running until the next check, but their outputs are discarded. Default to 8.
+            speculative_steps: (`optional`) int
+                Number of tokens proposed by the draft generator per step when one is registered.
+                0 disables speculative decoding. Default to 4.
         """
         # Pass temp configs
         for key, value in self.decode_config.items():
@@ -191,6 +269,24 @@ class TransformerDecoder:
         # Initialize history state if it is not initialized
         model_inputs = self.prepare_model_inputs_for_generation(input_ids, model_inputs, self.num_return_sequences)
 
+        use_speculative = getattr(self, "_draft_generator", None) is not None and self.speculative_steps > 0
+        if use_speculative:
+            if self.num_beams > 1:
+                raise ValueError("Speculative decoding does not support beam search")
+            if self.repetition_penalty != 1.0:
+                raise ValueError("Speculative decoding requires `repetition_penalty` to be 1.0")
+            # the draft generator keeps its own history state
+            draft_model_inputs = dict(model_inputs)
+
+        self._pending_prefixes = None
+        if getattr(self, "_prefix_cache", None) is not None and model_inputs.get("past") is None:
+            model_inputs = self.apply_prefix_cache(model_inputs)
+
+        if self.use_static_cache:
+            # one extra position for the last beam search step, and the rejected draft tokens
+            max_length = seq_len + self.max_steps + 1 + (self.speculative_steps if use_speculative else 0)
+            model_inputs["past"] = self.init_static_cache(model_inputs, max_length=max_length)
+
         # Effective batch size
         # We don't handle the num_return_sequences here
         # It should be done in prepare_model_inputs_for_generation
@@ -200,7 +296,9 @@ class TransformerDecoder:
         else:
             self.batch_size = batch_size
 
-        if self.num_beams <= 1:
+        if use_speculative:
+            results = self._generate_speculative(model_inputs, draft_model_inputs)
+        elif self.num_beams <= 1:
             results = self._generate_no_beam_search(model_inputs)
         else:
             results = self._generate_beam_search(model_inputs)
@@ -210,24 +308,36 @@ class TransformerDecoder:
         """
         High Performance Generation via Dynamic Batching 
         """
+        buffer_device = self.get_buffer_device(model_inputs)
+
         # record the index of each sequence for pop out
-        current_batch_indices = torch.arange(self.batch_size)
-        generated_token_sequences = torch.ones((self.batch_size, self.max_steps), dtype=torch.long) * -1
-        generated_log_prob_sequences = torch.zeros((self.batch_size, self.max_steps), dtype=torch.float)
+        current_batch_indices = torch.arange(self.batch_size, device=buffer_device)
+        generated_token_sequences = torch.full((self.batch_size, self.max_steps),
+                                               -1,
+                                               dtype=torch.long,
+                                               device=buffer_device)
+        generated_log_prob_sequences = torch.zeros((self.batch_size, self.max_steps),
+                                                   dtype=torch.float,
+                                                   device=buffer_device)
 
         if self.bos_token_ids is not None:
             start_position = len(self.bos_token_ids)
-            generated_token_sequences[:, :start_position] = self.bos_token_ids
+            generated_token_sequences[:, :start_position] = self.bos_token_ids.to(buffer_device)
         else:
             start_position = 0
 
+        if self.keep_buffers_on_device:
+            eos_token_ids = self.eos_token_ids.to(buffer_device)
+            # sequences that have ended since the last check
+            finished = torch.zeros(self.batch_size, dtype=torch.bool, device=buffer_device)
+
         # Main Decoding loop
         for timestep in range(start_position, self.max_steps):
             logits, raw_log_probs = self.compute_logits(
                 timestep=timestep,
                 model_inputs=model_inputs,
-                generated_token_sequences=generated_token_sequences,
-                generated_log_prob_sequences=generated_log_prob_sequences,
+                generated_token_sequences=generated_token_sequences[current_batch_indices],
+                generated_log_prob_sequences=generated_log_prob_sequences[current_batch_indices],
             )
 
             predicted_tokens = self.sample_next_token(
@@ -238,6 +348,34 @@ class TransformerDecoder:
                 generated_log_prob_sequences=generated_log_prob_sequences[current_batch_indices],
             )
 
+            if self.keep_buffers_on_device:
+                # finished sequences are still computed until the next check, but not recorded
+                generated_token_sequences[current_batch_indices,
+                                          timestep] = predicted_tokens.squeeze(1).masked_fill(finished, -1)
+
+                if self.output_log_probs:
+                    raw_log_probs = raw_log_probs.gather(-1, predicted_tokens).squeeze(1)
+                    generated_log_prob_sequences[current_batch_indices, timestep] = raw_log_probs.masked_fill(finished, 0.0)
+
+                if timestep + 1 >= len(eos_token_ids):
+                    finished = finished | torch.all(
+                        generated_token_sequences[current_batch_indices, timestep - len(eos_token_ids) + 1:timestep +
+                                                  1] == eos_token_ids,
+                        dim=1
+                    )
+
+                # the only host synchronization in the loop
+                if (timestep + 1 - start_position) % self.sync_interval == 0:
+                    num_finished = finished.sum().item()
+                    if num_finished == len(current_batch_indices):
+                        break
+                    elif num_finished > 0:
+                        keeped_batch_indices = (~finished).nonzero().squeeze(1)
+                        current_batch_indices = current_batch_indices[keeped_batch_indices]
+                        finished = finished[keeped_batch_indices]
+                        model_inputs = self.filter_finished_model_inputs(model_inputs, keeped_batch_indices)
+                continue
+
             # Collect the predicted token
             generated_token_sequences[current_batch_indices, timestep] = predicted_tokens.squeeze(1).cpu()
 
@@ -259,6 +397,14 @@ class TransformerDecoder:
             if len(current_batch_indices) == 0:
                 break
 
+        return self._collect_sequences(generated_token_sequences, generated_log_prob_sequences)
+
+    def _collect_sequences(self, generated_token_sequences: torch.Tensor, generated_log_prob_sequences: torch.Tensor):
+        "Convert the token and log prob buffers of non beam search generation to results"
+        # single transfer of the results
+        generated_token_sequences = generated_token_sequences.cpu()
+        generated_log_prob_sequences = generated_log_prob_sequences.cpu()
+
         final_generated_sequences = []
         for batch_idx in range(0, generated_token_sequences.shape[0], self.num_return_sequences):
             batch_tokens = []
@@ -282,29 +428,226 @@ class TransformerDecoder:
 
         return results
 
+    def _generate_speculative(
+        self, model_inputs: Dict[str, torch.Tensor], draft_model_inputs: Dict[str, torch.Tensor]
+    ):
+        """
+        Speculative decoding (https://arxiv.org/abs/2211.17192)
+        The draft generator proposes `speculative_steps` tokens, and the generator verifies them in one forward pass.
+        Accepted tokens follow exactly the same distribution as `_generate_no_beam_search`.
+        The whole batch keeps the smallest number of accepted tokens, so that every row stays aligned.
+        """
+        buffer_device = self.get_buffer_device(model_inputs)
+
+        current_batch_indices = torch.arange(self.batch_size, device=buffer_device)
+        generated_token_sequences = torch.full((self.batch_size, self.max_steps),
+                                               -1,
+                                               dtype=torch.long,
+                                               device=buffer_device)
+        generated_log_prob_sequences = torch.zeros((self.batch_size, self.max_steps),
+                                                   dtype=torch.float,
+                                                   device=buffer_device)
+
+        if self.bos_token_ids is not None:
+            start_position = len(self.bos_token_ids)
+            generated_token_sequences[:, :start_position] = self.bos_token_ids.to(buffer_device)
+        else:
+            start_position = 0
+
+        eos_token_ids = self.eos_token_ids.to(buffer_device)
+        eos_token_len = len(self.eos_token_ids)
+
+        timestep = start_position
+        while timestep < self.max_steps:
+            # the generator always adds one token after the accepted ones
+            num_draft_steps = min(self.speculative_steps, self.max_steps - timestep - 1)
+
+            # Draft proposals
+            draft_tokens = []
+            draft_probs = []
+            for draft_step in range(num_draft_steps):
+                draft_logits, draft_past = self._draft_generator(**draft_model_inputs)
+                probs = self.compute_speculative_probs(draft_logits[:, -1, :])
+                if self.do_sample:
+                    predicted_token = torch.multinomial(probs, num_samples=1)
+                else:
+                    predicted_token = torch.argmax(probs, dim=-1).unsqueeze(1)
+                draft_tokens.append(predicted_token)
+                draft_probs.append(probs)
+
+                if draft_step < num_draft_steps - 1:
+                    draft_model_inputs = self.advance_model_inputs(draft_model_inputs, draft_past, predicted_token)
+
+            # Verify all proposals in one forward pass
+            if num_draft_steps > 0:
+                # shape: (batch_size, num_draft_steps)
+                draft_tokens = torch.cat(draft_tokens, dim=1)
+                # shape: (batch_size, num_draft_steps, vocab_size)
+                draft_probs = torch.stack(draft_probs, dim=1)
+                model_inputs = self.extend_model_inputs(model_inputs, draft_tokens)
+
+            logits, past = self._generator(**model_inputs)
+
+            if getattr(self, "_pending_prefixes", None) is not None:
+                self.cache_prefixes(self._pending_prefixes, past)
+                self._pending_prefixes = None
+
+            # shape: (batch_size, num_draft_steps + 1, vocab_size)
+            logits = logits[:, -(num_draft_steps + 1):, :]
+            batch_size, _, vocab_size = logits.shape
+            probs = self.compute_speculative_probs(logits.reshape(-1, vocab_size)).reshape(batch_size, -1, vocab_size)
+
+            # Number of accepted draft tokens in each row
+            if num_draft_steps > 0:
+                if self.do_sample:
+                    # accept with probability min(1, p(x) / q(x))
+                    target_token_probs = probs[:, :-1].gather(-1, draft_tokens.unsqueeze(2)).squeeze(2)
+                    draft_token_probs = draft_probs.gather(-1, draft_tokens.unsqueeze(2)).squeeze(2)
+                    is_accepted = torch.rand_like(target_token_probs) * draft_token_probs < target_token_probs
+                else:
+                    is_accepted = draft_tokens == torch.argmax(probs[:, :-1], dim=-1)
+                num_row_accepted = torch.cumprod(is_accepted.long(), dim=1).sum(1)
+                # the only host synchronization in the step
+                num_accepted, num_total_accepted = torch.stack([num_row_accepted.min(), num_row_accepted.sum()]).tolist()
+            else:
+                num_row_accepted = torch.zeros(batch_size, dtype=torch.long, device=logits.device)
+                num_accepted, num_total_accepted = 0, 0
+
+            # The next token after the accepted ones
+            next_probs = probs[:, num_accepted]
+            if self.do_sample and num_accepted < num_draft_steps:
+                # resample from the residual distribution max(p - q, 0) for the rejected rows
+                residual_probs = (next_probs - draft_probs[:, num_accepted]).clamp_(min=0)
+                residual_sum = residual_probs.sum(-1, keepdim=True)
+                residual_probs = torch.where(residual_sum > 0, residual_probs / residual_sum.clamp(min=1e-12), next_probs)
+                next_token = torch.multinomial(residual_probs, num_samples=1)
+                # rows which accepted more keep their draft token
+                next_token = torch.where(
+                    (num_row_accepted > num_accepted).unsqueeze(1), draft_tokens[:, num_accepted:num_accepted + 1],
+                    next_token
+                )
+            elif self.do_sample:
+                next_token = torch.multinomial(next_probs, num_samples=1)
+            else:
+                next_token = torch.argmax(next_probs, dim=-1).unsqueeze(1)
+
+            # shape: (batch_size, num_accepted + 1)
+            predicted_tokens = next_token if num_accepted == 0 else torch.cat(
+                [draft_tokens[:, :num_accepted], next_token], dim=1
+            )
+            num_predicted = num_accepted + 1
+
+            self.speculative_stats["num_iterations"] += 1
+            self.speculative_stats["num_proposed"] += num_draft_steps * batch_size
+            self.speculative_stats["num_accepted"] += num_total_accepted
+            self.speculative_stats["num_generated"] += num_predicted * batch_size
+
+            # Collect the predicted tokens
+            generated_token_sequences[current_batch_indices, timestep:timestep + num_predicted] = \
+                predicted_tokens.to(buffer_device)
+
+            if self.output_log_probs:
+                raw_log_probs = torch.log_softmax(logits[:, :num_predicted], dim=-1)
+                raw_log_probs = raw_log_probs.gather(-1, predicted_tokens.unsqueeze(2)).squeeze(2)
+                generated_log_prob_sequences[current_batch_indices, timestep:timestep + num_predicted] = \
+                    raw_log_probs.to(buffer_device)
+
+            # Check EOS at every new position, tokens after EOS are dropped
+            finished = torch.zeros(len(current_batch_indices), dtype=torch.bool, device=buffer_device)
+            for position in range(timestep, timestep + num_predicted):
+                generated_token_sequences[current_batch_indices[finished], position] = -1
+                generated_log_prob_sequences[current_batch_indices[finished], position] = 0.0
+                if position + 1 >= eos_token_len:
+                    finished = finished | torch.all(
+                        generated_token_sequences[current_batch_indices, position - eos_token_len + 1:position +
+                                                  1] == eos_token_ids,
+                        dim=1
+                    )
+
+            timestep += num_predicted
+            if timestep >= self.max_steps:
+                break
+
+            # Discard the rejected positions and feed the next token
+            model_inputs = self.advance_model_inputs(
+                model_inputs, past, next_token, num_dropped=num_draft_steps - num_accepted
+            )
+            if num_draft_steps > 0:
+                if num_accepted == num_draft_steps:
+                    # the last draft token has not been fed to the draft generator
+                    draft_model_inputs = self.advance_model_inputs(
+                        draft_model_inputs, draft_past, torch.cat([draft_tokens[:, -1:], next_token], dim=1)
+                    )
+                else:
+                    draft_model_inputs = self.advance_model_inputs(
+                        draft_model_inputs, draft_past, next_token, num_dropped=num_draft_steps - 1 - num_accepted
+                    )
+
+            # Pop finished sequences
+            if finished.any():
+                keeped_batch_indices = (~finished).nonzero().squeeze(1)
+                if len(keeped_batch_indices) == 0:
+                    break
+                current_batch_indices = current_batch_indices[keeped_batch_indices]
+                model_inputs = self.filter_finished_model_inputs(model_inputs, keeped_batch_indices)
+                draft_model_inputs = self.filter_finished_model_inputs(draft_model_inputs, keeped_batch_indices)
+
+        return self._collect_sequences(generated_token_sequences, generated_log_prob_sequences)
+
+    def compute_speculative_probs(self, logits: torch.Tensor) -> torch.Tensor:
+        """The distribution used by both the draft and the generator in speculative decoding
+            It must match `compute_logits` and `sample_next_token`
+           Overrides this function when necessary
+        """
+        if self.temperature != 1.0:
+            logits = logits / self.temperature
+        elif self.do_sample:
+            # filtering is in place, while the raw logits are still needed for log probs
+            logits = logits.clone()
+        if self.do_sample:
+            logits = self.filter_logits(logits, min_tokens_to_keep=2)
+        return torch.softmax(logits, dim=-1)
+
+    def get_speculative_stats(self) -> Dict[str, float]:
+        stats = dict(self.speculative_stats)
+        stats["acceptance_rate"] = stats["num_accepted"] / max(stats["num_proposed"], 1)
+        stats["tokens_per_iteration"] = stats["num_generated"] / max(stats["num_iterations"], 1)
+        return stats
+
     def _generate_beam_search(self, model_inputs: Dict[str, torch.Tensor]):
         """
         High Performance Generation via Dynamic Batching 
         """
+        buffer_device = self.get_buffer_device(model_inputs)
+
         # Where to store all the beams
-        generated_hyps = [
-            BeamHypotheses(self.num_beams, self.max_steps, self.length_penalty, early_stopping=self.early_stopping)
-            for _ in range(self.batch_size)
-        ]
+        generated_hyps = TensorBeamHypotheses(
+            self.batch_size,
+            self.num_beams,
+            self.max_steps,
+            self.length_penalty,
+            early_stopping=self.early_stopping,
+            output_log_probs=self.output_log_probs,
+            device=buffer_device
+        )
 
         # Buffer for unfinished beams
-        beam_token_sequences_buffer = torch.ones((self.batch_size, self.num_beams, self.max_steps), dtype=int) * -1
-        beam_log_prob_sequences_buffer = torch.zeros((self.batch_size, self.num_beams, self.max_steps))
+        beam_token_sequences_buffer = torch.full((self.batch_size, self.num_beams, self.max_steps),
+                                                 -1,
+                                                 dtype=torch.long,
+                                                 device=buffer_device)
+        beam_log_prob_sequences_buffer = torch.zeros((self.batch_size, self.num_beams, self.max_steps),
+                                                     device=buffer_device)
 
         # Buffer to track scores for unfinished beams
         beam_log_prob_scores_1d = torch.zeros((self.batch_size * self.num_beams, 1))
-        done_sequences = [False for _ in range(self.batch_size)]
-        eos_token_ids = torch.LongTensor(self.eos_token_ids)
+        done_sequences = torch.zeros(self.batch_size, dtype=torch.bool, device=buffer_device)
+        eos_token_ids = self.eos_token_ids.to(buffer_device)
         eos_token_len = len(self.eos_token_ids)
 
         if self.bos_token_ids is not None:
             start_position = len(self.bos_token_ids)
-            beam_token_sequences_buffer[:, :, :start_position] = self.bos_token_ids
+            beam_token_sequences_buffer[:, :, :start_position] = self.bos_token_ids.to(buffer_device)
         else:
             start_position = 0
 
@@ -320,9 +663,7 @@ class TransformerDecoder:
         # Sample the next token
         if self.do_sample:
             # Top-p/top-k filtering, the scores here might be different from log_probs
-            logits = top_k_top_p_filtering(
-                logits, top_k=self.top_k, top_p=self.top_p, min_tokens_to_keep=self.num_beams
-            )
+            logits = self.filter_logits(logits, min_tokens_to_keep=self.num_beams)
             log_probs = torch.log_softmax(logits, dim=-1)
             probs = torch.exp(log_probs)
             # Sample
@@ -339,11 +680,11 @@ class TransformerDecoder:
             log_probs, predicted_tokens = torch.topk(log_probs, self.num_beams, dim=-1)
 
         # assign predicted token
-        beam_token_sequences_buffer[:, :, start_position] = predicted_tokens.cpu()
+        beam_token_sequences_buffer[:, :, start_position] = predicted_tokens.to(buffer_device)
         # assign predicted log probs
         if self.output_log_probs:
             beam_log_prob_sequences_buffer[:, :, start_position] = torch.gather(raw_log_probs, -1,
-                                                                                predicted_tokens).cpu()
+                                                                                predicted_tokens).to(buffer_device)
 
         # set log_prob scores before beam search
         beam_log_prob_scores_1d = log_probs.reshape(self.batch_size * self.num_beams, 1)
@@ -361,79 +702,42 @@ class TransformerDecoder:
                     beam_token_sequences_buffer[:, :, timestep - eos_token_len:timestep] == eos_token_ids, dim=2
                 )
 
-                # for all beams that end with eos
-                for batch_idx, beam_idx in (check_if_eos).nonzero():
-
-                    # convert 2d index to 1d
-                    beam_idx_1d = batch_idx * self.num_beams + beam_idx
-                    # get from buffer
-                    beam_token_sequence = beam_token_sequences_buffer[batch_idx, beam_idx]
-                    beam_log_prob_sequence = beam_log_prob_sequences_buffer[batch_idx, beam_idx]
-                    # clean the sequence
-                    beam_log_prob_sequence = beam_log_prob_sequence[beam_token_sequence != -1]
-                    beam_token_sequence = beam_token_sequence[beam_token_sequence != -1]
-                    # get the cumulative score
-                    beam_score = beam_log_prob_scores_1d[beam_idx_1d].item()
-                    # add the generated sequence to its corresponding prompt
-
-                    generated_hyps[batch_idx].add(
-                        {
-                            "tokens": beam_token_sequence.clone(),
-                            "log_probs": beam_log_prob_sequence.clone().detach() if self.output_log_probs else None
-                        }, beam_score
-                    )
+                # shape: (batch_size, num_beams)
+                beam_log_prob_scores = beam_log_prob_scores_1d.reshape(self.batch_size, self.num_beams).to(buffer_device)
 
-                    # avoid sampling from already ended beam any more
-                    beam_log_prob_scores_1d[beam_idx_1d] = -1e4
+                # add all beams that end with eos, finished prompts are left untouched
+                generated_hyps.add(
+                    check_if_eos & ~done_sequences.unsqueeze(1), beam_log_prob_scores, timestep,
+                    beam_token_sequences_buffer, beam_log_prob_sequences_buffer
+                )
 
-                    # check if batch is finished
-                    done_sequences[batch_idx] = done_sequences[batch_idx] or generated_hyps[batch_idx].is_done(
-                        beam_log_prob_scores_1d[batch_idx].max().item(), cur_len=timestep
-                    )
+                # avoid sampling from already ended beam any more
+                beam_log_prob_scores = beam_log_prob_scores.masked_fill(check_if_eos, -1e4)
+                beam_log_prob_scores_1d = beam_log_prob_scores_1d.masked_fill(
+                    check_if_eos.reshape(-1, 1).to(beam_log_prob_scores_1d.device), -1e4
+                )
+
+                # check if batch is finished
+                done_sequences = done_sequences | generated_hyps.is_done(
+                    beam_log_prob_scores.max(dim=1)[0], cur_len=timestep
+                )
 
                 # Cannot find enough sequences ended with eos under max_steps
                 # So we add all remaining beams to hypothesises
                 if timestep == self.max_steps:
-                    # shape: (batch_size, num_beams)
-                    beam_log_prob_scores = beam_log_prob_scores_1d.reshape(self.batch_size, self.num_beams)
-                    # shape: (batch_size, num_beams)
-                    beam_indices = torch.argsort(beam_log_prob_scores.cpu(), dim=1, descending=True)
-
-                    # add the unfinished sequences to the generated hypothesis
-                    for batch_idx in range(beam_indices.shape[0]):
-                        # compute max score in a batch
-                        max_score = beam_log_prob_scores_1d[batch_idx].max().item()
-
-                        for beam_idx in range(beam_indices.shape[1]):
-                            # convert 2d index to 1d
-                            beam_idx_1d = batch_idx * self.num_beams + beam_idx
-                            # get from buffer
-                            beam_token_sequence = beam_token_sequences_buffer[batch_idx, beam_idx]
-                            beam_log_prob_sequence = beam_log_prob_sequences_buffer[batch_idx, beam_idx]
-                            # clean the sequence
-                            beam_log_prob_sequence = beam_log_prob_sequence[beam_token_sequence != -1]
-                            beam_token_sequence = beam_token_sequence[beam_token_sequence != -1]
-                            # get the cumulative score
-                            beam_score = beam_log_prob_scores_1d[beam_idx_1d].item()
-                            # add the generated sequence to its corresponding prompt
-                            generated_hyps[batch_idx].add(
-                                {
-                                    "tokens":
-                                        beam_token_sequence.clone(),
-                                    "log_probs":
-                                        beam_log_prob_sequence.clone().detach() if self.output_log_probs else None
-                                }, beam_score
-                            )
-
-                            done_sequences[batch_idx] = done_sequences[batch_idx] or generated_hyps[batch_idx].is_done(
-                                max_score, cur_len=timestep
-                            )
+                    generated_hyps.add(
+                        ~done_sequences.unsqueeze(1).expand(-1, self.num_beams), beam_log_prob_scores, timestep,
+                        beam_token_sequences_buffer, beam_log_prob_sequences_buffer
+                    )
                     # Stop the generation
                     break
 
                 # if all sequences are finished with eos
-                if all(done_sequences):
-                    break
+                # with buffers on device, this is the only host synchronization in the loop,
+                # finished prompts are left untouched until then
+                if not self.keep_buffers_on_device or (timestep - start_position) % self.sync_interval == 0:
+                    if done_sequences.all():
+                        break
 
             logits, raw_log_probs = self.compute_logits(
                 timestep=timestep,
@@ -447,7 +751,7 @@ class TransformerDecoder:
                 # Top-p/top-k filtering, the scores here might be different from log_probs
                 # Must make sure that there are at least num_beams each node to sample from
                 # shape: (batch_size * num_beams, vocab_size)
-                logits = top_k_top_p_filtering(logits, top_k=self.top_k, top_p=self.top_p, min_tokens_to_keep=self.num_beams)
+                logits = self.filter_logits(logits, min_tokens_to_keep=self.num_beams)
 
                 # shape: (batch_size * num_beams, vocab_size)
                 log_probs = torch.log_softmax(logits, dim=-1)
@@ -484,9 +788,10 @@ class TransformerDecoder:
                 )
 
             # shape (batch_size, num_beams)
-            beam_indices = torch.div(predicted_tokens, vocab_size).cpu()
+            beam_indices = torch.div(predicted_tokens, vocab_size).to(buffer_device)
             beam_indices_1d = (
-                beam_indices + (torch.arange(self.batch_size) * self.num_beams).unsqueeze(1).expand(-1, self.num_beams)
+                beam_indices + (torch.arange(self.batch_size, device=buffer_device) *
+                                self.num_beams).unsqueeze(1).expand(-1, self.num_beams)
             )
             # shape (batch_size * num_beams)
             beam_indices_1d = beam_indices_1d.reshape(-1)
@@ -508,7 +813,7 @@ class TransformerDecoder:
             beam_log_prob_scores_1d = cur_log_prob_scores.reshape(self.batch_size * self.num_beams, 1)
 
             # fill in the new predicted token
-            beam_token_sequences_buffer[:, :, timestep] = predicted_tokens.cpu()
+            beam_token_sequences_buffer[:, :, timestep] = predicted_tokens.to(buffer_device)
             # fill in the log_probs
             if self.output_log_probs:
                 # be careful about the beam_indices here
@@ -518,12 +823,18 @@ class TransformerDecoder:
                 # shape (batch_size, num_beams)
                 raw_log_probs = raw_log_probs.reshape(self.batch_size, self.num_beams)
 
-                beam_log_prob_sequences_buffer[:, :, timestep] = raw_log_probs.cpu()
+                beam_log_prob_sequences_buffer[:, :, timestep] = raw_log_probs.to(buffer_device)
 
             # Reorder `model_inputs`!
             model_inputs = self.reorder_model_inputs(model_inputs, predicted_tokens, beam_indices_1d)
 
-        generated_hyps = [sorted(item.beams, key=lambda beam: beam[0], reverse=True) for item in generated_hyps]
+        # single transfer of the results
+        num_hyps = generated_hyps.num_hyps.tolist()
+        hyp_scores = generated_hyps.scores.tolist()
+        hyp_tokens = generated_hyps.tokens.cpu()
+        if self.output_log_probs:
+            hyp_log_probs = generated_hyps.log_probs.cpu()
+
         results = {}
         results["tokens"] = []
         results["beam_scores"] = []
@@ -531,17 +842,19 @@ class TransformerDecoder:
         if self.output_log_probs:
             results["log_probs"] = []
 
-        for batch in generated_hyps:
+        for batch_idx in range(self.batch_size):
             batch_tokens = []
             beam_scores = []
             if self.output_log_probs:
                 batch_log_probs = []
-            for beam in batch:
-                batch_tokens.append(beam[1]["tokens"])
-                beam_scores.append(beam[0])
+            # hypotheses are already sorted by score
+            for beam_idx in range(num_hyps[batch_idx]):
+                token_sequence = hyp_tokens[batch_idx, beam_idx]
+                batch_tokens.append(token_sequence[token_sequence != -1])
+                beam_scores.append(hyp_scores[batch_idx][beam_idx])
 
                 if self.output_log_probs:
-                    batch_log_probs.append(beam[1]["log_probs"])
+                    batch_log_probs.append(hyp_log_probs[batch_idx, beam_idx][token_sequence != -1])
 
             results["tokens"].append(batch_tokens)
             results["beam_scores"].append(beam_scores)
@@ -551,6 +864,78 @@ class TransformerDecoder:
 
         return results
 
+    def get_buffer_device(self, model_inputs: Dict[str, torch.Tensor]) -> torch.device:
+        "Where to keep the generated tokens and log probs during decoding"
+        if self.keep_buffers_on_device:
+            return model_inputs["input_ids"].device
+        return torch.device("cpu")
+
+    def apply_prefix_cache(self, model_inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """Reuse the cached `past` of the longest prompt prefix shared by the whole batch
+            The prompts are cached after the first forward pass
+           Overrides this function when necessary
+        """
+        input_ids = model_inputs["input_ids"]
+        self._pending_prefixes = input_ids
+
+        # keep at least one token to compute the logits of the next token
+        prefix_length = input_ids.shape[1] - 1
+        cached_pasts = []
+        for token_ids in input_ids.cpu():
+            length, past = self._prefix_cache.lookup(token_ids, max_length=prefix_length, record_stats=False)
+            prefix_length = min(prefix_length, length)
+            if prefix_length == 0:
+                break
+            cached_pasts.append(past)
+
+        # one hit or miss for the batch, since the prefix is shared by all rows
+        self._prefix_cache.record_lookup(prefix_length > 0)
+
+        if prefix_length > 0:
+            model_inputs["past"] = [
+                torch.stack([past[layer_idx][:, :, :prefix_length] for past in cached_pasts], dim=1)
+                for layer_idx in range(len(cached_pasts[0]))
+            ]
+            model_inputs["input_ids"] = input_ids[:, prefix_length:]
+            if "position_ids" in model_inputs:
+                model_inputs["position_ids"] = model_inputs["position_ids"][:, prefix_length:]
+        return model_inputs
+
+    def cache_prefixes(self, input_ids: torch.Tensor, past: List[torch.Tensor]):
+        "Store the `past` of each prompt. Overrides this function when necessary"
+        for row_idx, token_ids in enumerate(input_ids.cpu()):
+            self._prefix_cache.insert(token_ids, [past[layer_idx][:, row_idx] for layer_idx in range(len(past))])
+
+    def init_static_cache(self, model_inputs: Dict[str, torch.Tensor], max_length: int) -> StaticKVCache:
+        """Preallocate the key/value cache used by the generator
+           The default reads a GPT-2 style config from the generator.
+           Overrides this function when necessary
+        """
+        if model_inputs.get("past") is not None:
+            return StaticKVCache.from_past(model_inputs["past"], max_length)
+
+        config = self._generator.config
+        input_ids = model_inputs["input_ids"]
+        batch_size = input_ids.shape[0]
+        dtype = next(self._generator.parameters()).dtype
+
+        # reuse the buffers of the previous generation
+        cache = getattr(self, "_static_cache", None)
+        if cache is not None and cache.is_compatible(batch_size, max_length, dtype, input_ids.device):
+            cache.reset(batch_size)
+            return cache
+
+        self._static_cache = StaticKVCache(
+            num_layers=config.n_layer,
+            batch_size=batch_size,
+            num_heads=config.n_head,
+            max_length=max_length,
+            head_features=config.n_embd // config.n_head,
+            dtype=dtype,
+            device=input_ids.device
+        )
+        return self._static_cache
+
     def expand_model_inputs(
         self, model_inputs: Dict[str, torch.Tensor], predicted_tokens: torch.Tensor, num_beams: int
     ) -> Dict[str, torch.Tensor]:
@@ -561,7 +946,9 @@ class TransformerDecoder:
         """
         # Expand input_ids
         for key, value in model_inputs.items():
-            if key == "past":
+            if key == "past" and isinstance(value, StaticKVCache):
+                model_inputs["past"] = value.expand_(num_beams)
+            elif key == "past":
                 new_past = []
                 for item in model_inputs["past"]:
                     item = item.unsqueeze(2).expand(-1, -1, num_beams, -1, -1, -1)
@@ -585,7 +972,9 @@ class TransformerDecoder:
            Overrides this function when necessary
         """
         for key, value in model_inputs.items():
-            if key == "past":
+            if key == "past" and isinstance(value, StaticKVCache):
+                model_inputs["past"] = value.index_select_(beam_indices_1d)
+            elif key == "past":
                 model_inputs["past"] = [item[:, beam_indices_1d] for item in model_inputs["past"]]
             elif key == "input_ids":
                 model_inputs["input_ids"] = predicted_tokens.reshape(-1, 1)
@@ -596,19 +985,104 @@ class TransformerDecoder:
     def filter_finished_model_inputs(self, model_inputs, keeped_indices: List[int]):
         "Overrides this function whenever necessary"
         for key, value in model_inputs.items():
-            if key == "past":
+            if key == "past" and isinstance(value, StaticKVCache):
+                model_inputs["past"] = value.index_select_(keeped_indices)
+            elif key == "past":
                 model_inputs["past"] = [item[:, keeped_indices] for item in value]
             else:
                 model_inputs[key] = value[keeped_indices]
         return model_inputs
 
+    def concat_model_inputs(self, model_inputs_list: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        """Merge the `model_inputs` of several running batches into one batch
+            Shorter `past` and attention masks are left padded, so that every row ends at the current step
+           Overrides this function when necessary
+        """
+        past_lengths = [model_inputs["past"][0].shape[3] for model_inputs in model_inputs_list]
+        max_past_length = max(past_lengths)
+
+        merged_model_inputs = {}
+        for key in model_inputs_list[0].keys():
+            values = [model_inputs[key] for model_inputs in model_inputs_list]
+            if key == "past":
+                merged_model_inputs["past"] = [
+                    torch.cat(
+                        [
+                            F.pad(past[layer_idx], (0, 0, max_past_length - past_length, 0))
+                            for past, past_length in zip(values, past_lengths)
+                        ],
+                        dim=1
+                    ) for layer_idx in range(len(values[0]))
+                ]
+            elif key == self.mask_key:
+                merged_model_inputs[key] = torch.cat(
+                    [
+                        F.pad(mask, (max_past_length - past_length, 0), 'constant', False)
+                        for mask, past_length in zip(values, past_lengths)
+                    ],
+                    dim=0
+                )
+            else:
+                merged_model_inputs[key] = torch.cat(values, dim=0)
+        return merged_model_inputs
+
+    def extend_model_inputs(self, model_inputs: Dict[str, torch.Tensor], input_ids: torch.Tensor):
+        """Append more tokens to be fed in the same forward pass
+           Overrides this function when necessary
+        """
+        num_tokens = input_ids.shape[1]
+        model_inputs["input_ids"] = torch.cat([model_inputs["input_ids"], input_ids], dim=1)
+
+        if self.mask_key in model_inputs:
+            model_inputs[self.mask_key] = F.pad(model_inputs[self.mask_key], (0, num_tokens), 'constant', True)
+
+        if "position_ids" in model_inputs:
+            position_ids = model_inputs["position_ids"]
+            new_position_ids = position_ids[:, -1:] + 1 + torch.arange(num_tokens, device=position_ids.device)
+            model_inputs["position_ids"] = torch.cat([position_ids, new_position_ids], dim=1)
+        return model_inputs
+
+    def advance_model_inputs(
+        self,
+        model_inputs: Dict[str, torch.Tensor],
+        past: List[torch.Tensor],
+        input_ids: torch.Tensor,
+        num_dropped: int = 0
+    ) -> Dict[str, torch.Tensor]:
+        """Prepare to feed `input_ids` after a forward pass, which can have several tokens
+            The last `num_dropped` positions in `past` are discarded
+           Overrides this function when necessary
+        """
+        num_tokens = input_ids.shape[1]
+
+        if num_dropped > 0:
+            if isinstance(past, StaticKVCache):
+                past = past.rewind_(num_dropped)
+            else:
+                past = [item[:, :, :, :item.shape[3] - num_dropped] for item in past]
+        model_inputs["past"] = past
+        model_inputs["input_ids"] = input_ids
+
+        if self.mask_key in model_inputs:
+            mask = model_inputs[self.mask_key]
+            mask = mask[:, :mask.shape[1] - num_dropped]
+            model_inputs[self.mask_key] = F.pad(mask, (0, num_tokens), 'constant', True)
+
+        if "position_ids" in model_inputs:
+            last_position_ids = model_inputs["position_ids"][:, -1:] - num_dropped
+            model_inputs["position_ids"] = last_position_ids + 1 + torch.arange(
+                num_tokens, device=last_position_ids.device
+            )
+        return model_inputs
+
     def increment_model_inputs(self, model_inputs):
         "Overrides this function whenever necessary"
-        if "attention_mask" in model_inputs:
-            model_inputs["attention_mask"] = F.pad(model_inputs["attention_mask"], (0, 1), 'constant', True)
+        if self.mask_key in model_inputs:
+            model_inputs[self.mask_key] = F.pad(model_inputs[self.mask_key], (0, 1), 'constant', True)
 
         if "position_ids" in model_inputs:
-            model_inputs["position_ids"] = model_inputs["position_ids"] + 1
+            # the prompt can have several positions, while the next step only has one
+            model_inputs["position_ids"] = model_inputs["position_ids"][:, -1:] + 1
         return model_inputs
 
     def pop_finished_sequences(self, timestep, current_sequence_indices, generated_token_sequences):
@@ -11,31 +11,13 @@ from omegaconf import DictConfig
 import logging
 import atexit
 
+from torchfly.common import get_rank, get_world_size
 from torchfly.training.callbacks import Callback, Events, handle_event
 
 logger = logging.getLogger("torchfly.training.logger")
 Trainer = Any
 
 
-def get_rank():
-    """
-    We use environment variables to pass the rank info
-    Returns:
-        rank: rank in the multi-node system 
-        local_rank: local rank on a node
-    """
-    if "RANK" not in os.environ or "LOCAL_RANK" not in os.environ:
-        rank = 0
-        local_rank = 0
-        os.environ["RANK"] = str(0)
-        os.environ["LOCAL_RANK"] = str(0)
-    else:
-        rank = int(os.environ["RANK"])
-        local_rank = int(os.environ["LOCAL_RANK"])
-
-    return rank, local_rank
-
-
 class TextRLLogHandler(Callback):
     """
     Callback that handles all Tensorboard logging.
@@ -160,7 +142,7 @@ class TextRLLogHandler(Callback):
         iter_elapsed_time = time.time() - self.last_log_time
         elapsed_steps = trainer.global_step_count - self.last_log_global_step
 
-        speed = elapsed_steps * trainer.ppo_buffer_size * self.config.training.num_gpus_per_node / iter_elapsed_time
+        speed = elapsed_steps * trainer.ppo_buffer_size * get_world_size() / iter_elapsed_time
         self.cumulative_time += iter_elapsed_time
 
         if not self.training_in_epoch:
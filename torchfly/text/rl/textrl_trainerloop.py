@@ -117,6 +117,10 @@ class TextRLTrainerLoop(TrainerLoop):
 
             self.callback_handler.fire_event(Events.BATCH_END)
             self.replay_buffer.clear()
+
+            # cached prompts are stale once the policy is updated
+            if getattr(self.decoder, "_prefix_cache", None) is not None:
+                self.decoder._prefix_cache.clear()
             self.global_step_count += 1
             self.local_step_count += 1
 
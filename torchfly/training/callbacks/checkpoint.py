@@ -7,6 +7,7 @@ import logging
 from omegaconf import DictConfig
 from apex import amp
 
+from torchfly.common import get_rank
 from ..checkpointer import Checkpointer
 from .events import Events
 from .callback import Callback, handle_event
@@ -17,25 +18,6 @@ __all__ = ["Checkpoint"]
 Trainer = Any
 
 
-def get_rank():
-    """
-    We use environment variables to pass the rank info
-    Returns:
-        rank: rank in the multi-node system 
-        local_rank: local rank on a node
-    """
-    if "RANK" not in os.environ or "LOCAL_RANK" not in os.environ:
-        rank = 0
-        local_rank = 0
-        os.environ["RANK"] = str(0)
-        os.environ["LOCAL_RANK"] = str(0)
-    else:
-        rank = int(os.environ["RANK"])
-        local_rank = int(os.environ["LOCAL_RANK"])
-
-    return rank, local_rank
-
-
 @Callback.register("checkpoint")
 class Checkpoint(Callback):
     """
@@ -54,13 +36,33 @@ class Checkpoint(Callback):
         if self.config.training.checkpointing.async_save is None:
             self.config.training.checkpointing.async_save = False
 
+        if self.config.training.checkpointing.save_format is None:
+            self.config.training.checkpointing.save_format = "torch"
+
+        if self.config.training.checkpointing.num_save_workers is None:
+            self.config.training.checkpointing.num_save_workers = 4
+
+        if self.config.training.checkpointing.verify_checksums is None:
+            self.config.training.checkpointing.verify_checksums = False
+
+        if self.config.training.checkpointing.delta_every is None:
+            self.config.training.checkpointing.delta_every = 0
+
+        if self.config.training.checkpointing.delta_encoding is None:
+            self.config.training.checkpointing.delta_encoding = "raw"
+
         # Initialize Checkpointer
         self.checkpointer = Checkpointer(
             sync_every_save=True,
             async_save=self.config.training.checkpointing.async_save,
             num_checkpoints_to_keep=self.config.training.checkpointing.num_checkpoints_to_keep,
             keep_checkpoint_every_num_seconds=(self.config.training.checkpointing.keep_checkpoint_every_num_seconds),
-            storage_dir=self.checkpoint_dir
+            storage_dir=self.checkpoint_dir,
+            save_format=self.config.training.checkpointing.save_format,
+            num_save_workers=self.config.training.checkpointing.num_save_workers,
+            verify_checksums=self.config.training.checkpointing.verify_checksums,
+            delta_every=self.config.training.checkpointing.delta_every,
+            delta_encoding=self.config.training.checkpointing.delta_encoding
         )
 
         # checkpointed states contain two parts: model and training progress
@@ -153,6 +155,12 @@ class Checkpoint(Callback):
                 if (trainer.global_step_count + 1) % self.config.training.checkpointing.steps_interval == 0:
                     self._save_trainer_state(trainer)
 
+    @handle_event(Events.TRAIN_END)
+    def wait_for_saving(self, trainer: Trainer):
+        # make sure the last checkpoint is completely written
+        if self.rank == 0:
+            self.checkpointer.wait()
+
     def _save_trainer_state(self, trainer: Trainer):
         trainer_state_dict = trainer.get_trainer_state()
         self.checkpointer.save_checkpoint(
@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Union
 import os
 import sys
 import time
@@ -11,6 +11,8 @@ from omegaconf import DictConfig
 from colorlog import colorlog
 import atexit
 
+from torchfly.common import get_rank, get_world_size
+from torchfly.common.log_accumulator import LogAccumulator
 from .events import Events
 from .callback import Callback, handle_event
 import logging
@@ -43,25 +45,6 @@ if IN_NOTEBOOK:
         IN_NOTEBOOK = False
 
 
-def get_rank():
-    """
-    We use environment variables to pass the rank info
-    Returns:
-        rank: rank in the multi-node system 
-        local_rank: local rank on a node
-    """
-    if "RANK" not in os.environ or "LOCAL_RANK" not in os.environ:
-        rank = 0
-        local_rank = 0
-        os.environ["RANK"] = str(0)
-        os.environ["LOCAL_RANK"] = str(0)
-    else:
-        rank = int(os.environ["RANK"])
-        local_rank = int(os.environ["LOCAL_RANK"])
-
-    return rank, local_rank
-
-
 @Callback.register("log_handler")
 class LogHandler(Callback):
     """
@@ -74,6 +57,8 @@ class LogHandler(Callback):
 
         self.history_log_dict = {}
         self.smooth_coef = 0.95
+        # values stay on the device until they are logged
+        self.log_accumulator = LogAccumulator()
 
         # Log in seconds or steps
         if config.training.logging.steps_interval > 0:
@@ -147,18 +132,20 @@ class LogHandler(Callback):
     @handle_event(Events.BATCH_END)
     def on_batch_end(self, trainer: Trainer):
         if self.rank == 0:
+            self.log_accumulator.update(trainer.tmp_vars["log_dict"])
+
             if self.resume_training:
-                self.log(trainer, trainer.tmp_vars["log_dict"])
+                self.log(trainer, self.log_accumulator)
                 self.resume_training = False
             elif self.log_in_seconds:
                 current_time = time.time()
                 iter_elapsed_time = current_time - self.last_log_time
 
                 if iter_elapsed_time > self.config.training.logging.seconds_interval:
-                    self.log(trainer, trainer.tmp_vars["log_dict"])
+                    self.log(trainer, self.log_accumulator)
             else:
                 if (trainer.global_step_count + 1) % self.config.training.logging.steps_interval == 0:
-                    self.log(trainer, trainer.tmp_vars["log_dict"])
+                    self.log(trainer, self.log_accumulator)
 
     @handle_event(Events.EPOCH_END, priority=100)
     def on_epoch_end(self, trainer: Trainer):
@@ -199,12 +186,16 @@ class LogHandler(Callback):
                 if isinstance(value, float):
                     self.tensorboard.add_scalar("validate/" + metric_name, value, global_step=trainer.global_step_count)
 
-    def log(self, trainer: Trainer, log_dict: Dict[str, float]):
+    def log(self, trainer: Trainer, log_dict: Union[Dict[str, float], LogAccumulator]):
         """
         Args:
             trainer: Trainer class
-            log_dict: Dict
+            log_dict: Dict, or LogAccumulator whose means since the last log are used
         """
+        if isinstance(log_dict, LogAccumulator):
+            # the only device synchronization for logging
+            log_dict = log_dict.materialize()
+
         updated_steps = trainer.global_step_count // self.config.training.optimization.gradient_accumulation_steps
 
         if not self.training_in_epoch:
@@ -215,7 +206,7 @@ class LogHandler(Callback):
         iter_elapsed_time = time.time() - self.last_log_time
         elapsed_steps = trainer.global_step_count - self.last_log_global_step
 
-        speed = elapsed_steps * self.config.training.batch_size * self.config.training.num_gpus_per_node / iter_elapsed_time
+        speed = elapsed_steps * self.config.training.batch_size * get_world_size() / iter_elapsed_time
         self.cumulative_time += iter_elapsed_time
 
         if not self.training_in_epoch:
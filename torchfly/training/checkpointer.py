@@ -1,6 +1,7 @@
 import os
 import glob
 import time
+import shutil
 import datetime
 import torch
 import pickle
@@ -8,6 +9,9 @@ import logging
 import torchfly
 from typing import Any, List, Dict, Iterator, Tuple
 
+from torchfly.common.sharded_checkpoint import ShardedCheckpointWriter, load_sharded_checkpoint, \
+    is_sharded_checkpoint, MANIFEST_NAME
+
 logger = logging.getLogger(__name__)
 
 
@@ -17,6 +21,14 @@ class Checkpointer:
         num_checkpoints_to_keep: Total number of checkpoints to keep
         keep_checkpoint_every_num_seconds: Keep checkpoints every x number of seconds without removing them
         storage_dir: Location to store the checkpoints
+        save_format: "torch" saves two `torch.save` files per checkpoint.
+            "sharded" saves a directory with one file per tensor, written by a background thread pool
+        num_save_workers: Number of writer threads for the "sharded" format
+        verify_checksums: Check the crc32 of every tensor file when restoring a "sharded" checkpoint.
+            Otherwise only the file sizes and the pickled states are checked, and tensors are memory-mapped
+        delta_every: With the "sharded" format, save up to this number of delta checkpoints after each full one.
+            A delta checkpoint only writes the tensors changed since the previous checkpoint. 0 disables it
+        delta_encoding: "raw" or "xor_zlib", how the changed tensors of a delta checkpoint are stored
     """
     def __init__(
         self,
@@ -24,8 +36,18 @@ class Checkpointer:
         async_save=False,
         num_checkpoints_to_keep: int = 1000,
         keep_checkpoint_every_num_seconds: float = 3600,
-        storage_dir: str = "Checkpoints"
+        storage_dir: str = "Checkpoints",
+        save_format: str = "torch",
+        num_save_workers: int = 4,
+        verify_checksums: bool = False,
+        delta_every: int = 0,
+        delta_encoding: str = "raw"
     ):
+        if save_format not in ["torch", "sharded"]:
+            raise NotImplementedError(f"Unknown checkpoint format {save_format}")
+        if delta_every > 0 and save_format != "sharded":
+            raise NotImplementedError("Delta checkpoints require the sharded format")
+
         self.sync_every_save = sync_every_save
         self.async_save = async_save
         self.num_checkpoints_to_keep = num_checkpoints_to_keep
@@ -34,6 +56,17 @@ class Checkpointer:
         self._saved_checkpoint_paths: List[Tuple[float, str]] = []
         self._last_checkpoint_time = datetime.datetime.now()
         self.background_tasks = []
+        self.save_format = save_format
+        self.verify_checksums = verify_checksums
+        self.sharded_writer = ShardedCheckpointWriter(num_save_workers) if save_format == "sharded" else None
+        self.delta_every = delta_every
+        self.delta_encoding = delta_encoding
+        # sharded checkpoint path -> the checkpoint it is a delta of, None for full checkpoints
+        self._checkpoint_parents: Dict[str, str] = {}
+        # checkpoints out of retention which other checkpoints still depend on
+        self._pending_removals: List[str] = []
+        self._last_checkpoint_path = None
+        self._num_deltas = 0
 
         os.makedirs(storage_dir, exist_ok=True)
 
@@ -45,21 +78,41 @@ class Checkpointer:
         """
         # synchronize background tasks
         if self.sync_every_save and self.async_save:
-            for process in self.background_tasks:
-                torchfly.async_wait(process)
-                logger.debug("Waiting for history job to finish!")
-            self.background_tasks = []
+            self.wait()
 
-        model_state_path = os.path.join(self.storage_dir, f"{stamp}_model_state.pth")
-        trainer_state_path = os.path.join(self.storage_dir, f"{stamp}_trainer_state.pth")
+        if self.save_format == "sharded":
+            checkpoint_paths = (os.path.join(self.storage_dir, f"{stamp}_checkpoint"), )
+        else:
+            model_state_path = os.path.join(self.storage_dir, f"{stamp}_model_state.pth")
+            trainer_state_path = os.path.join(self.storage_dir, f"{stamp}_trainer_state.pth")
+            checkpoint_paths = (model_state_path, trainer_state_path)
 
         # remove the old one
         if self.num_checkpoints_to_keep >= 0:
-            self._saved_checkpoint_paths.append((datetime.datetime.now(), model_state_path, trainer_state_path))
+            self._saved_checkpoint_paths.append((datetime.datetime.now(), *checkpoint_paths))
+            if self.save_format == "sharded":
+                # a parent whose save fails makes it a full checkpoint, which still keeps the parent until it is removed
+                parent_path = self._get_delta_parent()
+                self._checkpoint_parents[checkpoint_paths[0]] = parent_path
+                self._last_checkpoint_path = checkpoint_paths[0]
+                self._num_deltas = 0 if parent_path is None else self._num_deltas + 1
             trainer_state_dict["checkpointer_state_dict"] = self.state_dict()
 
             # save the states
-            if self.async_save:
+            if self.save_format == "sharded":
+                # only the snapshot to host memory blocks training
+                self.sharded_writer.save(
+                    {
+                        "model": model_state_dict,
+                        "trainer": trainer_state_dict
+                    },
+                    checkpoint_paths[0],
+                    parent_path=parent_path,
+                    delta_encoding=self.delta_encoding
+                )
+                if not self.async_save:
+                    self.sharded_writer.wait()
+            elif self.async_save:
                 process1 = torchfly.async_save(model_state_dict, model_state_path)
                 process2 = torchfly.async_save(trainer_state_dict, trainer_state_path)
                 self.background_tasks.append(process1)
@@ -84,9 +137,67 @@ class Checkpointer:
 
                     if remove_path:
                         for fname in path_to_remove[1:]:
-                            if os.path.isfile(fname):
+                            if fname in self._checkpoint_parents:
+                                # delta checkpoints may still depend on it
+                                self._pending_removals.append(fname)
+                            elif os.path.isfile(fname):
                                 logger.debug(f"Removing {fname}!")
                                 os.remove(fname)
+                            elif os.path.isdir(fname):
+                                logger.debug(f"Removing {fname}!")
+                                shutil.rmtree(fname, ignore_errors=True)
+
+            self._remove_pending_checkpoints()
+
+    def _get_delta_parent(self) -> [str, None]:
+        "Returns the checkpoint to save a delta against, or None for a full checkpoint"
+        if self.delta_every <= 0 or self._num_deltas >= self.delta_every:
+            return None
+        if self._last_checkpoint_path is None or self._last_checkpoint_path in self._pending_removals:
+            return None
+        # the writer compares with the previous save once it is written, without blocking training
+        if not is_sharded_checkpoint(self._last_checkpoint_path) and \
+                not self.sharded_writer.is_writing(self._last_checkpoint_path):
+            return None
+        return self._last_checkpoint_path
+
+    def _get_dependencies(self, exclude: str = None) -> set:
+        "All checkpoints that the other checkpoints are built on"
+        dependencies = set()
+        for path, parent in self._checkpoint_parents.items():
+            if path == exclude:
+                continue
+            while parent is not None and parent not in dependencies:
+                dependencies.add(parent)
+                parent = self._checkpoint_parents.get(parent)
+        return dependencies
+
+    def _remove_pending_checkpoints(self):
+        # a chain is removed from its newest delta to its full checkpoint
+        removed = True
+        while removed:
+            removed = False
+            for path in list(self._pending_removals):
+                if path in self._get_dependencies(exclude=path):
+                    continue
+                # removed by a later save once it is written
+                if self.sharded_writer is not None and self.sharded_writer.is_writing(path):
+                    continue
+                logger.debug(f"Removing {path}!")
+                shutil.rmtree(path, ignore_errors=True)
+                self._pending_removals.remove(path)
+                self._checkpoint_parents.pop(path, None)
+                removed = True
+
+    def wait(self):
+        "Block until all background saves are finished"
+        for process in self.background_tasks:
+            torchfly.async_wait(process)
+            logger.debug("Waiting for history job to finish!")
+        self.background_tasks = []
+
+        if self.sharded_writer is not None:
+            self.sharded_writer.wait()
 
     def restore_latest_checkpoint(self) -> [Dict, None]:
         """
@@ -94,9 +205,17 @@ class Checkpointer:
             state_dict: return the checkpoint's state dict. None if there is nothing.
         """
         files = glob.glob(os.path.join(self.storage_dir, "*model_state.pth"))
+        # sharded checkpoints are complete once their manifest is written
+        files += glob.glob(os.path.join(self.storage_dir, "*_checkpoint", MANIFEST_NAME))
         sorted_files = sorted(files, key=os.path.getctime, reverse=True)
 
         for latest_file_path in sorted_files:
+            if latest_file_path.endswith(MANIFEST_NAME):
+                states = self._restore_sharded_checkpoint(os.path.dirname(latest_file_path))
+                if states is None:
+                    continue
+                return states
+
             trainer_state_file = latest_file_path.split("model_state.pth")[0] + "trainer_state.pth"
             model_state_file = latest_file_path
 
@@ -120,20 +239,82 @@ class Checkpointer:
         # if there is nothing to restore, return None
         return None
 
+    def _restore_sharded_checkpoint(self, checkpoint_path: str) -> [Tuple, None]:
+        try:
+            # tensors are read lazily when `load_state_dict` copies them
+            states = load_sharded_checkpoint(
+                checkpoint_path, map_location="cpu", mmap=True, verify_checksums=self.verify_checksums
+            )
+            model_state_dict = states["model"]
+            trainer_state_dict = states["trainer"]
+
+            trainer_state_dict["file_path"] = checkpoint_path
+            logger.info(f"Loading checkpoint {checkpoint_path}")
+            return (model_state_dict, trainer_state_dict)
+        except (pickle.UnpicklingError, RuntimeError, TypeError, ValueError, KeyError, OSError) as e:
+            # a missing base of a delta or a transient read error may be recoverable, so nothing is deleted
+            quarantine_path = self._quarantine_checkpoint(checkpoint_path)
+            self._drop_checkpoint_chain(checkpoint_path)
+            logger.warning(f"Cannot load checkpoint {checkpoint_path}: {e!r}. Trying the previous checkpoint.")
+            if quarantine_path != checkpoint_path:
+                logger.warning(f"The checkpoint is kept as {quarantine_path}")
+            return None
+
+    def _quarantine_checkpoint(self, checkpoint_path: str) -> str:
+        "Rename an unloadable checkpoint, so that it is neither restored nor overwritten by a later save"
+        quarantine_path = checkpoint_path + ".invalid"
+        index = 1
+        while os.path.exists(quarantine_path):
+            quarantine_path = f"{checkpoint_path}.invalid{index}"
+            index += 1
+        try:
+            os.rename(checkpoint_path, quarantine_path)
+        except OSError:
+            # e.g. a read-only storage, it is skipped in place
+            return checkpoint_path
+        return quarantine_path
+
+    def _drop_checkpoint_chain(self, checkpoint_path: str):
+        "Forget a checkpoint which cannot be loaded, and the delta checkpoints built on it"
+        dropped = {checkpoint_path}
+        added = True
+        while added:
+            added = False
+            for path, parent in self._checkpoint_parents.items():
+                if parent in dropped and path not in dropped:
+                    dropped.add(path)
+                    added = True
+
+        for path in dropped:
+            self._checkpoint_parents.pop(path, None)
+        # its deltas are no longer depended on, and are removed as usual
+        if checkpoint_path in self._pending_removals:
+            self._pending_removals.remove(checkpoint_path)
+        if self._last_checkpoint_path in dropped:
+            # the next save is a full checkpoint
+            self._last_checkpoint_path = None
+            self._num_deltas = 0
+
     def state_dict(self):
         states = {
             "_saved_checkpoint_paths":
-                [
-                    (str(saved_time), model_path, trainer_path)
-                    for saved_time, model_path, trainer_path in self._saved_checkpoint_paths
-                ],
-            "_last_checkpoint_time": str(self._last_checkpoint_time)
+                [(str(saved_time), *paths) for saved_time, *paths in self._saved_checkpoint_paths],
+            "_last_checkpoint_time": str(self._last_checkpoint_time),
+            "_checkpoint_parents": dict(self._checkpoint_parents),
+            "_pending_removals": list(self._pending_removals),
+            "_last_checkpoint_path": self._last_checkpoint_path,
+            "_num_deltas": self._num_deltas
         }
         return states
 
     def load_state_dict(self, states: Dict[str, Any]):
         self._saved_checkpoint_paths = [
-            (datetime.datetime.strptime(saved_time, '%Y-%m-%d %H:%M:%S.%f'), model_path, trainer_path)
-            for saved_time, model_path, trainer_path in states["_saved_checkpoint_paths"]
+            (datetime.datetime.strptime(saved_time, '%Y-%m-%d %H:%M:%S.%f'), *paths)
+            for saved_time, *paths in states["_saved_checkpoint_paths"]
         ]
-        self._last_checkpoint_time = datetime.datetime.strptime(states["_last_checkpoint_time"], '%Y-%m-%d %H:%M:%S.%f')
\ No newline at end of file
+        self._last_checkpoint_time = datetime.datetime.strptime(states["_last_checkpoint_time"], '%Y-%m-%d %H:%M:%S.%f')
+        # states saved before delta checkpoints
+        self._checkpoint_parents = dict(states.get("_checkpoint_parents", {}))
+        self._pending_removals = list(states.get("_pending_removals", []))
+        self._last_checkpoint_path = states.get("_last_checkpoint_path", None)
+        self._num_deltas = states.get("_num_deltas", 0)
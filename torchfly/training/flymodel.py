@@ -5,6 +5,7 @@ import apex
 from apex.parallel import DistributedDataParallel, Reducer
 # from torch.nn.parallel import DistributedDataParallel
 
+from torchfly.metrics import Metric
 from torchfly.training.optimization import ConstantLRSchedule, WarmupConstantSchedule, WarmupCosineSchedule, \
     WarmupLinearSchedule, WarmupCosineWithHardRestartsSchedule
 
@@ -31,6 +32,27 @@ class FlyModel(nn.Module):
     def get_metrics(self, reset):
         return {}
 
+    def get_metric_objects(self) -> List[Metric]:
+        """
+        All `Metric` attributes of the model and its submodules, also inside lists and dicts.
+        Overrides this function if metrics are stored elsewhere
+        """
+        metrics = []
+        for module in self.modules():
+            for value in module.__dict__.values():
+                if isinstance(value, Metric):
+                    metrics.append(value)
+                elif isinstance(value, dict):
+                    metrics.extend(item for item in value.values() if isinstance(item, Metric))
+                elif isinstance(value, (list, tuple)):
+                    metrics.extend(item for item in value if isinstance(item, Metric))
+        return metrics
+
+    def reduce_distributed_metrics(self, device=None):
+        "Sum the metric states of all processes before `get_metrics` in distributed validation"
+        for metric in self.get_metric_objects():
+            metric.reduce_distributed(device)
+
     def get_optimizer_parameters(self):
         """
         This function is used to set parameters with different weight decays
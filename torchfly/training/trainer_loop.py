@@ -1,5 +1,6 @@
 from typing import Any, List, Dict, Iterator, Callable, Iterable
 import os
+import contextlib
 import random
 import numpy as np
 import torch
@@ -13,7 +14,8 @@ from apex.parallel import DistributedDataParallel, Reducer
 # local imports
 from torchfly.training.callbacks import Callback, CallbackHandler, Events
 from torchfly.training.callbacks import LogHandler, GradientClipNorm, Checkpoint
-from torchfly.common import move_to_device, get_rank
+from torchfly.common import move_to_device, get_rank, get_world_size, get_distributed_config, DevicePrefetcher, \
+    shard_dataloader
 from torchfly.training import FlyModel
 
 import logging
@@ -42,13 +44,16 @@ class TrainerLoop:
 
         self.config = config
         self.rank, self.local_rank = get_rank()
+        self.world_size = get_world_size()
 
         # Distributed
-        if self.config.training.num_gpus_per_node > 1:
-            # Init distributed
-            # TODO: multi-node multi-gpu training
+        if self.world_size > 1:
+            # MASTER_ADDR and MASTER_PORT are set by `launch_distributed`
             torch.distributed.init_process_group(
-                backend="nccl", rank=self.rank, world_size=self.config.training.num_gpus_per_node * 1
+                backend=get_distributed_config(config)["backend"],
+                init_method="env://",
+                rank=self.rank,
+                world_size=self.world_size
             )
 
         # configure distributed training
@@ -58,6 +63,11 @@ class TrainerLoop:
         self.validation_dataloader: Iterable = valid_dataloader_fn(config) if valid_dataloader_fn else None
         self.test_dataloader = test_dataloader_fn(config) if test_dataloader_fn else None
 
+        # every process validates a shard of the validation set
+        self.distributed_validation = self.world_size > 1 and config.training.validation.distributed is not False
+        if self.distributed_validation and self.validation_dataloader is not None:
+            self.validation_dataloader = shard_dataloader(self.validation_dataloader, self.rank, self.world_size)
+
         self.callback_handler = CallbackHandler(
             config, trainer=self, callbacks=[], verbose=config.training.logging.level == "DEBUG"
         )
@@ -69,6 +79,14 @@ class TrainerLoop:
         self.fp16_opt_level = config.training.optimization.fp16_opt_level
         self.distributed_training = False
 
+        # Move the next batches to the device in the background
+        prefetch_config = config.training.prefetch
+        self.prefetch = prefetch_config is not None and bool(prefetch_config.enabled)
+        if self.prefetch:
+            self.prefetch_num_batches = prefetch_config.num_batches if prefetch_config.num_batches is not None else 2
+            self.prefetch_pin_memory = prefetch_config.pin_memory if prefetch_config.pin_memory is not None else True
+            self.prefetch_coalesce = prefetch_config.coalesce if prefetch_config.coalesce is not None else False
+
         self.total_num_update_steps = int(config.training.total_num.update_steps)
         self.total_num_steps = self.total_num_update_steps * int(self.gradient_accumulation_steps)
         self.total_num_epochs = int(self.config.training.total_num.epochs)
@@ -107,10 +125,10 @@ class TrainerLoop:
         self.local_step_count = 0
 
         # set cuda device
-        if config.training.num_gpus_per_node > 1:
-            torch.cuda.set_device(self.rank)
+        if config.training.num_gpus_per_node > 0 and self.world_size > 1:
+            torch.cuda.set_device(self.local_rank)
             self.device = torch.device("cuda", self.local_rank)
-        elif config.training.num_gpus_per_node == 1:
+        elif config.training.num_gpus_per_node > 0:
             self.device = torch.device("cuda")
         else:
             self.device = torch.device("cpu")
@@ -127,7 +145,7 @@ class TrainerLoop:
             self.configure_fp16()
 
         # Distributed Training
-        if self.config.training.num_gpus_per_node > 1:
+        if self.world_size > 1:
             self.configure_ddp()
 
         self.configure_callbacks()
@@ -137,7 +155,7 @@ class TrainerLoop:
         self.callback_handler.fire_event(Events.INITIALIZE)
 
         # make sure the model has access to trainer info
-        self.model.set_trainer(self)
+        unwrap_model(self.model).set_trainer(self)
 
     def update_log_keys(self, keys: List[str]):
         self.log_keys.update(keys)
@@ -166,7 +184,29 @@ class TrainerLoop:
     def configure_ddp(self):
         # Distributed training (should be after apex fp16 initialization)
         self.distributed_training = True
-        self.model = DistributedDataParallel(self.model, delay_allreduce=True)
+        if self.device.type == "cuda" and self.gradient_accumulation_steps == 1:
+            self.model = DistributedDataParallel(self.model, delay_allreduce=True)
+        else:
+            # apex only supports CUDA, so CPU processes use the native DDP with gloo.
+            # apex DDP also reduces in every backward, while the native DDP can skip accumulation steps with
+            # `no_sync`. It reduces inside the backward of the update step, before amp unscales the gradients
+            # and checks them for overflow, so every process makes the same decision to skip the step.
+            distributed_config = self.config.training.distributed
+            bucket_cap_mb = 25
+            find_unused_parameters = False
+            if distributed_config is not None:
+                if distributed_config.bucket_cap_mb is not None:
+                    bucket_cap_mb = distributed_config.bucket_cap_mb
+                if distributed_config.find_unused_parameters is not None:
+                    find_unused_parameters = distributed_config.find_unused_parameters
+
+            device_ids = [self.local_rank] if self.device.type == "cuda" else None
+            self.model = torch.nn.parallel.DistributedDataParallel(
+                self.model,
+                device_ids=device_ids,
+                bucket_cap_mb=bucket_cap_mb,
+                find_unused_parameters=find_unused_parameters
+            )
         # trainer.model = torch.nn.parallel.DistributedDataParallel(
         #     trainer.model, device_ids=[trainer.rank], output_device=trainer.rank, find_unused_parameters=True
         # )
@@ -176,10 +216,10 @@ class TrainerLoop:
         self.callback_handler.fire_event(Events.TRAIN_BEGIN)
 
         # Start validation at the begining
-        if self.rank == 0:
+        if self.rank == 0 or self.distributed_validation:
             if self.validation_dataloader is not None:
                 self.model.eval()
-                self.model.is_training = False
+                unwrap_model(self.model).is_training = False
                 # BEGIN
                 self.callback_handler.fire_event(Events.VALIDATE_BEGIN)
 
@@ -187,7 +227,7 @@ class TrainerLoop:
 
                 self.callback_handler.fire_event(Events.VALIDATE_END)
                 self.model.train()
-                self.model.is_training = True
+                unwrap_model(self.model).is_training = True
 
         while True:
             self.callback_handler.fire_event(Events.EPOCH_BEGIN)
@@ -219,26 +259,45 @@ class TrainerLoop:
 
         self.local_step_count = 0
 
-        for batch in self.train_dataloader:
+        if self.prefetch:
+            train_dataloader = DevicePrefetcher(
+                self.train_dataloader,
+                self.device,
+                num_prefetch=self.prefetch_num_batches,
+                pin_memory=self.prefetch_pin_memory,
+                coalesce=self.prefetch_coalesce
+            )
+        else:
+            train_dataloader = self.train_dataloader
+
+        for batch in train_dataloader:
             self.callback_handler.fire_event(Events.BATCH_BEGIN)
 
-            batch = move_to_device(batch, self.device)
-            self.tmp_vars["log_dict"] = self.train_step(batch)
+            if not self.prefetch:
+                batch = move_to_device(batch, self.device, use_plan=True)
+
+            is_update_step = (self.global_step_count + 1) % self.gradient_accumulation_steps == 0
+            with self.gradient_sync_context(is_update_step):
+                self.tmp_vars["log_dict"] = self.train_step(batch)
+
+            if self.prefetch:
+                # seconds spent waiting for the batch
+                self.tmp_vars["log_dict"]["_data_wait"] = train_dataloader.pop_wait_time()
 
             # Update the model
-            if (self.global_step_count + 1) % self.gradient_accumulation_steps == 0:
+            if is_update_step:
                 self.step_update()
 
             self.callback_handler.fire_event(Events.BATCH_END)
 
-            # Only rank 0 can run the validation dataset
-            if self.rank == 0:
+            # Only rank 0 runs the validation dataset, unless it is sharded
+            if self.rank == 0 or self.distributed_validation:
                 if self.global_step_count > self.validation_after_num_steps and \
                     ((self.global_step_count + 1) % self.validation_steps_interval == 0):
 
                     if self.validation_dataloader is not None:
                         self.model.eval()
-                        self.model.is_training = False
+                        unwrap_model(self.model).is_training = False
                         # BEGIN
                         self.callback_handler.fire_event(Events.VALIDATE_BEGIN)
 
@@ -246,9 +305,9 @@ class TrainerLoop:
 
                         self.callback_handler.fire_event(Events.VALIDATE_END)
                         self.model.train()
-                        self.model.is_training = True
+                        unwrap_model(self.model).is_training = True
 
-            if self.config.training.num_gpus_per_node > 1:
+            if self.world_size > 1:
                 torch.distributed.barrier()
             if self.global_step_count >= self.total_num_steps:
                 break
@@ -256,6 +315,15 @@ class TrainerLoop:
             self.global_step_count += 1
             self.local_step_count += 1
 
+    def gradient_sync_context(self, sync: bool):
+        """
+        Skip the gradient all-reduce of the native DDP during gradient accumulation steps.
+        Gradients are accumulated locally and reduced in the backward pass of the update step.
+        """
+        if not sync and isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
     def step_update(self):
         self.callback_handler.fire_event(Events.STEP_BEGIN)
         self.optimizer.step()
@@ -276,7 +344,8 @@ class TrainerLoop:
         self.callback_handler.fire_event(Events.BACKWARD_END)
         # return the results
 
-        log_dict = {"loss": loss.item() * self.gradient_accumulation_steps}
+        # scalars stay on the device until LogHandler logs them
+        log_dict = {"loss": loss.detach() * self.gradient_accumulation_steps}
         log_dict["_lr"] = get_lr(self.optimizer)
 
         for key in self.log_keys:
@@ -301,29 +370,20 @@ class TrainerLoop:
                 # send to cuda device
                 batch = move_to_device(batch, self.device)
 
-                if self.distributed_training:
-                    self.model.module.predict(batch)
-                else:
-                    self.model.predict(batch)
+                unwrap_model(self.model).predict(batch)
         # END
+        # sum the metric states over all shards
+        if self.distributed_validation:
+            unwrap_model(self.model).reduce_distributed_metrics(self.device)
         # get metrics
-        if self.distributed_training:
-            metrics = self.model.module.get_metrics(reset=True)
-        else:
-            metrics = self.model.get_metrics(reset=True)
+        metrics = unwrap_model(self.model).get_metrics(reset=True)
         return metrics
 
     def set_model_state(self, model_state_dict):
-        if self.distributed_training:
-            self.model.module.load_state_dict(model_state_dict)
-        else:
-            self.model.load_state_dict(model_state_dict)
+        unwrap_model(self.model).load_state_dict(model_state_dict)
 
     def get_model_state(self):
-        if self.distributed_training:
-            return self.model.module.state_dict()
-        else:
-            return self.model.state_dict()
+        return unwrap_model(self.model).state_dict()
 
     def set_trainer_state(self, trainer_state_dict):
         self.epochs_trained = trainer_state_dict["epochs_trained"]
@@ -398,7 +458,16 @@ def get_lr(optimizer):
 
 def get_log_variable(x):
     if isinstance(x, torch.Tensor):
-        x = x.detach()
-        return x.item()
+        return x.detach()
+    elif isinstance(x, (int, float)):
+        return x
     else:
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    "Returns the model inside a DistributedDataParallel wrapper"
+    if isinstance(model, (DistributedDataParallel, torch.nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+